@@ -0,0 +1,195 @@
+"""Benchmark harness for the filters and segmenters of NiftiViewer (no GUI required)
+
+Examples:
+    python benchmark.py --sizes 64 --output results.json
+    python benchmark.py --sizes 64 128 --ops mean_filter kmeans_segmentation --repeat 3
+    python benchmark.py --sizes 64 --output new.json --baseline results.json --threshold 0.2
+    python benchmark.py --compare new.json results.json
+"""
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from headless import headless_viewer, make_phantom
+
+
+def _center(viewer):
+    return (viewer.width // 2, viewer.height // 2, viewer.depth // 2)
+
+
+# Operation name -> (runner, parameter grid). Each grid entry maps a parameter to its candidate values.
+OPERATIONS = {
+    "mean_filter": (
+        lambda v, p: v.mean_filter(v.image_data, p["kernel_size"]),
+        {"kernel_size": [3, 5]}),
+    "median_filter": (
+        lambda v, p: v.median_filter(v.image_data, p["kernel_size"]),
+        {"kernel_size": [3]}),
+    "bilateral_filter": (
+        lambda v, p: v.bilateral_filter(v.image_data, p["window_size"], p["sigma_space"], p["sigma_range"]),
+        {"window_size": [3, 5], "sigma_space": [1.5], "sigma_range": [50.0]}),
+    "anisotropic_diffusion": (
+        lambda v, p: v.anisotropic_diffusion(v.image_data, p["iterations"], p["kappa"], p["lambda_val"]),
+        {"iterations": [5], "kappa": [50.0], "lambda_val": [0.25]}),
+    "edge_detection": (
+        lambda v, p: v.edge_detection(p["low_threshold"], p["high_threshold"], p["kernel_size"], v.image_data),
+        {"low_threshold": [0.1], "high_threshold": [0.3], "kernel_size": [3, 5]}),
+    "non_local_means": (
+        lambda v, p: v.non_local_means(p["patch_size"], p["search_radius"], p["h_param"], v.image_data),
+        {"patch_size": [3], "search_radius": [5], "h_param": [0.1]}),
+    "roberts_edge_detection": (
+        lambda v, p: v.roberts_edge_detection(v.image_data, p["threshold"]),
+        {"threshold": [0.1]}),
+    "laplacian_of_gaussian": (
+        lambda v, p: v.laplacian_of_gaussian(v.image_data, p["sigma"], p["kernel_size"]),
+        {"sigma": [1.0], "kernel_size": [7]}),
+    "region_growing": (
+        lambda v, p: v.region_growing(_center(v), p["tolerance"]),
+        {"tolerance": [0.1]}),
+    "kmeans_segmentation": (
+        lambda v, p: v.kmeans_segmentation(p["k"], p["max_iterations"]),
+        {"k": [3, 5], "max_iterations": [100]}),
+}
+
+
+def expand_grid(grid):
+    """Expand a parameter grid into the list of every parameter combination"""
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[n] for n in names))]
+
+
+def result_key(entry):
+    """Key used to match a result against the baseline"""
+    return (entry["op"], entry["size"], json.dumps(entry["params"], sort_keys=True))
+
+
+def measure(runner, viewer, params, repeat, memory=True):
+    """Time an operation and, optionally, record its peak traced memory"""
+    peak = None
+    if memory:
+        # Separate run: tracemalloc slows down allocation-heavy code
+        tracemalloc.start()
+        runner(viewer, params)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        runner(viewer, params)
+        times.append(time.perf_counter() - start)
+    return times, peak
+
+
+def run_benchmarks(sizes, ops, repeat=1, seed=0, memory=True, log=print):
+    """Run every operation over every phantom size and parameter combination"""
+    results = []
+    for size in sizes:
+        volume = make_phantom(size, seed=seed)
+        for op in ops:
+            runner, grid = OPERATIONS[op]
+            for params in expand_grid(grid):
+                # Fresh viewer each time so no state leaks between operations
+                viewer = headless_viewer(volume)
+                times, peak = measure(runner, viewer, params, repeat, memory)
+                entry = {
+                    "op": op,
+                    "size": size,
+                    "params": params,
+                    "times": times,
+                    "best": min(times),
+                    "mean": sum(times) / len(times),
+                    "peak_memory_bytes": peak,
+                }
+                results.append(entry)
+                mem = f", peak {peak / 2**20:.1f} MiB" if peak is not None else ""
+                log(f"{op:24s} {size:4d}^3 {json.dumps(params, sort_keys=True)}: best {entry['best']:.3f} s{mem}")
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Return the entries whose best time grew more than threshold (fraction) over the baseline"""
+    base = {result_key(entry): entry for entry in baseline}
+    regressions = []
+    for entry in results:
+        reference = base.get(result_key(entry))
+        if reference is None or reference["best"] <= 0:
+            continue
+        ratio = entry["best"] / reference["best"]
+        if ratio > 1.0 + threshold:
+            regressions.append({**entry, "baseline_best": reference["best"], "ratio": ratio})
+    return regressions
+
+
+def load_results(path):
+    with open(path, "r") as f:
+        return json.load(f)["results"]
+
+
+def report_regressions(regressions, threshold, log=print):
+    if not regressions:
+        log(f"No regressions above {threshold:.0%}")
+        return
+    log(f"{len(regressions)} regression(s) above {threshold:.0%}:")
+    for entry in regressions:
+        log(f"  {entry['op']} {entry['size']}^3 {json.dumps(entry['params'], sort_keys=True)}: "
+            f"{entry['baseline_best']:.3f} s -> {entry['best']:.3f} s (x{entry['ratio']:.2f})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark NiftiViewer filters and segmenters on synthetic phantoms")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64], help="Phantom edge sizes (e.g. 64 128 256 512)")
+    parser.add_argument("--ops", nargs="+", default=sorted(OPERATIONS), choices=sorted(OPERATIONS), metavar="OP",
+                        help="Operations to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=1, help="Timed runs per configuration")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the phantom noise")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the peak memory run")
+    parser.add_argument("--output", help="Write the results as JSON")
+    parser.add_argument("--baseline", help="Compare against a stored results file")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Regression threshold as a fraction (default 0.2)")
+    parser.add_argument("--compare", nargs=2, metavar=("NEW", "BASELINE"), help="Only compare two results files")
+    parser.add_argument("--list", action="store_true", help="List the operations and their parameter grids")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for op in sorted(OPERATIONS):
+            print(f"{op}: {OPERATIONS[op][1]}")
+        return 0
+
+    if args.compare:
+        regressions = compare(load_results(args.compare[0]), load_results(args.compare[1]), args.threshold)
+        report_regressions(regressions, args.threshold)
+        return 1 if regressions else 0
+
+    results = run_benchmarks(args.sizes, args.ops, args.repeat, args.seed, not args.no_memory)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "meta": {
+                    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "python": sys.version.split()[0],
+                    "numpy": np.__version__,
+                    "platform": platform.platform(),
+                    "seed": args.seed,
+                    "repeat": args.repeat,
+                },
+                "results": results,
+            }, f, indent=2)
+        print(f"Results saved to {args.output}")
+
+    if args.baseline:
+        regressions = compare(results, load_results(args.baseline), args.threshold)
+        report_regressions(regressions, args.threshold)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+"""Binary volumes stored one bit per voxel
+
+A PackedMask keeps np.packbits words along the last volume axis: a
+(X, Y, Z) mask is a (X, Y, ceil(Z / 8)) uint8 array, 8x smaller than a
+uint8 mask and 64x smaller than a float64 one. Slices unpack on demand in
+any orientation (a last-axis slice reads one bit of every word, the other
+two unpack one row of words), slabs along the first axis are packed and
+unpacked one at a time, and AND / OR / XOR / NOT / count work directly on
+the packed words. Unused bits at the end of each row are always zero.
+
+Reading a mask as an array (np.asarray, indexing) gives uint8 0/1 values,
+the same as the uint8 masks it replaces.
+"""
+import numpy as np
+
+# Voxels packed or unpacked per slab along the first axis
+SLAB_VOXELS = 8 * 1024 ** 2
+
+# Set bits of every byte value (fallback for numpy without bitwise_count)
+POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def slab_regions(shape, voxels=SLAB_VOXELS):
+    """Index tuples of consecutive slabs along the first axis, about voxels each"""
+    step = max(1, voxels // max(1, int(np.prod(shape[1:]))))
+    for start in range(0, shape[0], step):
+        yield (slice(start, start + step),)
+
+
+class PackedMask:
+    """Binary volume packed 8 voxels per byte along its last axis"""
+    dtype = np.dtype(np.uint8)
+    itemsize = 1
+
+    def __init__(self, words, shape):
+        self.words = words
+        self.shape = tuple(shape)
+
+    @classmethod
+    def from_slabs(cls, shape, compute):
+        """Mask of a shape built slab by slab: compute(region) gives the boolean block of each first-axis region"""
+        words = np.empty(tuple(shape[:-1]) + (-(-shape[-1] // 8),), dtype=np.uint8)
+        for region in slab_regions(shape):
+            words[region] = np.packbits(compute(region), axis=-1)
+        return cls(words, shape)
+
+    @classmethod
+    def from_array(cls, mask):
+        """Pack the non-zero voxels of an array"""
+        return cls.from_slabs(mask.shape, lambda region: mask[region] != 0)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.words.nbytes
+
+    def __array__(self, dtype=None, copy=None):
+        return self.astype(dtype or self.dtype)
+
+    def astype(self, dtype):
+        """Unpacked copy as an array of dtype, filled slab by slab"""
+        out = np.empty(self.shape, dtype=dtype)
+        for region in slab_regions(self.shape):
+            out[region] = self[region]
+        return out
+
+    def __getitem__(self, key):
+        """Unpacked uint8 values; integer or unit-step slices along the last axis never unpack more than needed"""
+        key = key if isinstance(key, tuple) else (key,)
+        if Ellipsis in key or len(key) > self.ndim:
+            return np.asarray(self)[key]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        *outer, last = key
+        words = self.words[tuple(outer)]
+
+        if isinstance(last, (int, np.integer)):
+            bit = int(last) + self.shape[-1] if last < 0 else int(last)
+            if not 0 <= bit < self.shape[-1]:
+                raise IndexError(f"index {last} is out of bounds for axis {self.ndim - 1}")
+            # One bit of every word of the row (packbits stores the first voxel in the high bit)
+            return (words[..., bit >> 3] >> (7 - (bit & 7))) & 1
+
+        start, stop, step = last.indices(self.shape[-1])
+        if step != 1:
+            return self[tuple(outer)][..., last]
+        stop = max(start, stop)
+        first = start >> 3
+        bits = np.unpackbits(words[..., first:-(-stop // 8)], axis=-1)
+        return bits[..., start - 8 * first:stop - 8 * first]
+
+    def _combine(self, other, operation):
+        if not isinstance(other, PackedMask) or other.shape != self.shape:
+            return NotImplemented
+        return PackedMask(operation(self.words, other.words), self.shape)
+
+    def __and__(self, other):
+        return self._combine(other, np.bitwise_and)
+
+    def __or__(self, other):
+        return self._combine(other, np.bitwise_or)
+
+    def __xor__(self, other):
+        return self._combine(other, np.bitwise_xor)
+
+    def __invert__(self):
+        words = np.invert(self.words)
+        # Keep the padding bits of the last word of each row at zero
+        spare = -self.shape[-1] % 8
+        if spare:
+            words[..., -1] &= (0xFF << spare) & 0xFF
+        return PackedMask(words, self.shape)
+
+    def count(self):
+        """Number of set voxels"""
+        if hasattr(np, "bitwise_count"):
+            return int(np.bitwise_count(self.words).sum(dtype=np.int64))
+        return int(POPCOUNT[self.words].sum(dtype=np.int64))
+
+    def any(self):
+        return bool(self.words.any())
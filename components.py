@@ -0,0 +1,186 @@
+"""3D connected components of label volumes, with size filtering
+
+Each axial slice is labeled in 2D by OpenCV (4- or 8-connected), which
+also returns the area, bounding box and centroid of every slice component
+in the same pass. Slices are processed in blocks: the provisional slice
+components of a block are joined to those of the previous slice (inside
+the block and across the block boundary) by a vectorized union-find over
+the deduplicated pairs of touching components, so the work per block is
+proportional to the number of components, not voxels. 6-connectivity
+joins only voxels stacked on top of each other, 18 adds the in-plane face
+neighbours of the next slice and 26 all nine. Voxels only connect to
+voxels with the same label value, so multi-label results (K-Means) are
+handled per label value.
+
+Component statistics are reduced from the per-slice ones, without another
+pass over the volume.
+"""
+import cv2
+import numpy as np
+
+import bitmask
+
+CONNECTIVITY = (6, 18, 26)
+
+# Slices labeled per block before their merges are resolved
+BLOCK_SLICES = 32
+
+# In-plane connectivity of the 2D labeling and (dx, dy) offsets reaching the next slice
+_IN_PLANE = {6: 4, 18: 8, 26: 8}
+_NEXT_SLICE = {
+    6: [(0, 0)],
+    18: [(0, 0), (-1, 0), (1, 0), (0, -1), (0, 1)],
+    26: [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)],
+}
+
+
+def _compress(parent):
+    # Point every node straight at its root (roots always have the smallest index of their set)
+    while True:
+        grand = parent[parent]
+        if np.array_equal(grand, parent):
+            return parent
+        parent[:] = grand
+
+
+def _union(parent, a, b):
+    """Merge the sets of the node pairs (a[i], b[i])"""
+    while a.size:
+        _compress(parent)
+        root_a, root_b = parent[a], parent[b]
+        differ = root_a != root_b
+        if not differ.any():
+            return
+        a, b = a[differ], b[differ]
+        low = np.minimum(root_a[differ], root_b[differ])
+        high = np.maximum(root_a[differ], root_b[differ])
+        np.minimum.at(parent, high, low)
+
+
+def _touching(previous, current, previous_values, current_values, offsets):
+    """Unique (previous id, current id) pairs of same-valued components touching across two slices"""
+    rows, cols = current.shape
+    pairs = []
+    for dx, dy in offsets:
+        first = (slice(max(0, dx), rows + min(0, dx)), slice(max(0, dy), cols + min(0, dy)))
+        second = (slice(max(0, -dx), rows + min(0, -dx)), slice(max(0, -dy), cols + min(0, -dy)))
+        a, b = previous[first], current[second]
+        both = (a > 0) & (previous_values[first] == current_values[second])
+        pairs.append((a[both].astype(np.int64) << 32) | b[both])
+    keys = np.unique(np.concatenate(pairs))
+    return keys >> 32, keys & 0xFFFFFFFF
+
+
+class Components:
+    """Connected components of a label volume: provisional ids per voxel and per-component statistics"""
+    def __init__(self, ids, root, values, sizes, bbox_min, bbox_max, centroids):
+        self.ids = ids                # int32 volume of provisional ids (0 = background)
+        self.root = root              # component index (-1 for background) of each provisional id
+        self.values = values          # label value of each component
+        self.sizes = sizes            # voxels of each component
+        self.bbox_min = bbox_min      # (n, 3) first voxel index along x, y, z
+        self.bbox_max = bbox_max      # (n, 3) last voxel index along x, y, z
+        self.centroids = centroids    # (n, 3) mean voxel position
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def select(self, labels, keep):
+        """Labels with only the components where keep (bool per component) is set"""
+        lut = np.zeros(len(self.root), dtype=bool)
+        lut[self.root >= 0] = keep[self.root[self.root >= 0]]
+        if isinstance(labels, bitmask.PackedMask):
+            return bitmask.PackedMask.from_slabs(labels.shape, lambda region: lut[self.ids[region]])
+        result = np.zeros(labels.shape, dtype=labels.dtype)
+        for region in bitmask.slab_regions(labels.shape):
+            block = np.asarray(labels[region])
+            result[region] = np.where(lut[self.ids[region]], block, 0)
+        return result
+
+
+def label_components(labels, connectivity=26, block=BLOCK_SLICES):
+    """Connected components of the non-zero voxels of an integer [x, y, z] volume (or PackedMask)"""
+    if connectivity not in CONNECTIVITY:
+        raise ValueError(f"connectivity must be one of {CONNECTIVITY}")
+    shape = labels.shape
+    ids = np.zeros(shape, dtype=np.int32, order="F")
+    offsets = _NEXT_SLICE[connectivity]
+
+    # Per provisional id (index 0 is the background): value, area, bounds and coordinate sums
+    stats = [np.zeros((1, 10))]
+    parent = np.zeros(1, dtype=np.int64)
+    count = 1
+    previous_values = None
+
+    for start in range(0, shape[2], block):
+        stop = min(start + block, shape[2])
+        pairs_a, pairs_b = [], []
+        for z in range(start, stop):
+            values = np.asarray(labels[:, :, z])
+            slice_ids = ids[:, :, z]
+            present = np.flatnonzero(np.bincount(values.ravel(), minlength=2))
+            for value in present[present > 0]:
+                n, local, slice_stats, centroids = cv2.connectedComponentsWithStats(
+                    (values == value).astype(np.uint8), connectivity=_IN_PLANE[connectivity], ltype=cv2.CV_32S)
+                if n <= 1:
+                    continue
+                mask = local > 0
+                slice_ids[mask] = local[mask] + (count - 1)
+
+                # OpenCV columns are volume y, rows are volume x
+                area = slice_stats[1:, cv2.CC_STAT_AREA].astype(np.float64)
+                left, top = slice_stats[1:, cv2.CC_STAT_LEFT], slice_stats[1:, cv2.CC_STAT_TOP]
+                stats.append(np.column_stack([
+                    np.full(n - 1, value), area,
+                    top, left, np.full(n - 1, z),
+                    top + slice_stats[1:, cv2.CC_STAT_HEIGHT] - 1, left + slice_stats[1:, cv2.CC_STAT_WIDTH] - 1,
+                    np.full(n - 1, z),
+                    area * centroids[1:, 1], area * centroids[1:, 0]]))
+                count += n - 1
+
+            if z > 0:
+                a, b = _touching(ids[:, :, z - 1], slice_ids, previous_values, values, offsets)
+                pairs_a.append(a)
+                pairs_b.append(b)
+            previous_values = values
+
+        # Resolve the merges of this block (and with the block before it)
+        parent = np.concatenate([parent, np.arange(len(parent), count, dtype=np.int64)])
+        if pairs_a:
+            _union(parent, np.concatenate(pairs_a), np.concatenate(pairs_b))
+
+    _compress(parent)
+    stats = np.concatenate(stats)
+    roots, root = np.unique(parent[1:], return_inverse=True)
+    root = np.concatenate([[-1], root])
+    n = len(roots)
+    provisional = stats[1:]
+    index = root[1:]
+
+    sizes = np.bincount(index, weights=provisional[:, 1], minlength=n).astype(np.int64)
+    bbox_min = np.full((n, 3), np.iinfo(np.int64).max)
+    bbox_max = np.full((n, 3), -1, dtype=np.int64)
+    np.minimum.at(bbox_min, index, provisional[:, 2:5].astype(np.int64))
+    np.maximum.at(bbox_max, index, provisional[:, 5:8].astype(np.int64))
+    sums = np.column_stack([np.bincount(index, weights=provisional[:, 8], minlength=n),
+                            np.bincount(index, weights=provisional[:, 9], minlength=n),
+                            np.bincount(index, weights=provisional[:, 1] * provisional[:, 4], minlength=n)])
+    centroids = sums / np.maximum(sizes, 1)[:, None]
+    values = np.zeros(n, dtype=np.int64)
+    values[index] = provisional[:, 0]
+    return Components(ids, root, values, sizes, bbox_min, bbox_max, centroids)
+
+
+def keep_largest(labels, connectivity=26):
+    """(filtered labels, components) keeping only the largest component"""
+    components = label_components(labels, connectivity)
+    keep = np.zeros(len(components), dtype=bool)
+    if len(components):
+        keep[np.argmax(components.sizes)] = True
+    return components.select(labels, keep), components
+
+
+def remove_small(labels, min_size, connectivity=26):
+    """(filtered labels, components) without the components of fewer than min_size voxels"""
+    components = label_components(labels, connectivity)
+    return components.select(labels, components.sizes >= min_size), components
@@ -0,0 +1,65 @@
+"""Label-to-color lookup tables and in-place alpha compositing for the 2D views
+
+Label slices are colored with one LUT gather and blended into the frame in a
+single vectorized expression, restricted to the bounding box of the labelled
+pixels so frames without annotations cost nothing.
+"""
+import cv2
+import numpy as np
+
+
+def label_lut(labels, alpha=150):
+    """BGR + alpha LUT indexed by label value, built from the global label set of a volume
+
+    Non-zero labels get evenly spaced OpenCV hues in sorted order, so a label keeps
+    its color on every slice; label 0 (background) is transparent.
+    """
+    values = np.unique(labels)
+    values = values[values > 0]
+    size = int(values[-1]) + 1 if values.size else 1
+    lut = np.zeros((size, 4), dtype=np.uint8)
+    if values.size:
+        hues = np.arange(values.size) / max(1, values.size) * 180  # OpenCV hues span 0-180
+        hsv = np.stack([hues, np.full(values.size, 255), np.full(values.size, 255)], axis=-1)
+        lut[values, :3] = cv2.cvtColor(hsv.astype(np.uint8)[None], cv2.COLOR_HSV2BGR)[0]
+        lut[values, 3] = alpha
+    return lut
+
+
+def palette_lut(colors, alpha):
+    """RGBA LUT from a palette list (index 0 is the transparent background)"""
+    lut = np.zeros((max(1, len(colors)), 4), dtype=np.uint8)
+    for index, color in enumerate(colors):
+        if index > 0:
+            lut[index, :3] = color
+            lut[index, 3] = alpha
+    return lut
+
+
+def bounding_box(mask):
+    """(row slice, column slice) around the non-zero pixels of a 2D array, or None"""
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)
+
+
+def blend_labels(frame, labels, lut):
+    """Alpha-blend lut[labels] into an HxWx3 uint8 frame in place (labels has the frame's HxW)"""
+    box = bounding_box(labels)
+    if box is None:
+        return frame
+    region = frame[box]
+    region_labels = labels[box]
+    mask = region_labels > 0
+
+    colors = lut[region_labels[mask]]
+    alpha = colors[:, 3:4] / 255.0
+    region[mask] = (region[mask] * (1 - alpha) + colors[:, :3] * alpha).astype(np.uint8)
+    return frame
+
+
+def resize_labels(labels, size, out=None):
+    """Nearest-neighbour resize of a label slice (labels never mix)"""
+    return cv2.resize(labels, size, dst=out, interpolation=cv2.INTER_NEAREST)
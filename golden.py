@@ -0,0 +1,192 @@
+"""Golden-output harness: reference loop kernels vs. the vectorized engine
+
+The loop implementations in imagenProc.py are the oracles. `--update` runs them
+on small phantoms and stores their outputs in golden/golden_outputs.npz; a normal
+run checks every engine against those outputs with per-case tolerances
+(bit-exact for binary maps, rtol/atol for smoothing).
+
+Examples:
+    python golden.py --update
+    python golden.py
+    python golden.py --engine fast --cases nlm_2d edge_detection
+    python golden.py --precision-report
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+from headless import headless_viewer, make_phantom
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden", "golden_outputs.npz")
+
+# Small phantoms (one cubic, one anisotropic so axis mix-ups show up)
+PHANTOMS = {
+    "cube16": lambda: make_phantom(16, seed=1),
+    "box14x12x10": lambda: make_phantom((14, 12, 10), seed=2),
+}
+
+EXACT = {"rtol": 0.0, "atol": 0.0}
+SMOOTH = {"rtol": 1e-9, "atol": 1e-9}
+
+
+def _axial(viewer, volume):
+    """Normalized middle axial slice, the input the 2D kernels see inside the filters"""
+    return viewer.normalize_0_1(volume[:, :, volume.shape[2] // 2])
+
+
+def _gradients(viewer, volume):
+    smoothed = viewer.gaussian_blur(_axial(viewer, volume), 5)
+    gx, gy = viewer.sobel_gradients(smoothed)
+    return np.sqrt(gx**2 + gy**2), np.arctan2(gy, gx)
+
+
+def _suppressed(viewer, volume):
+    return viewer.non_maximum_suppression(*_gradients(viewer, volume))
+
+
+def _hysteresis(viewer, volume):
+    suppressed = _suppressed(viewer, volume)
+    low = suppressed.min() + 0.1 * (suppressed.max() - suppressed.min())
+    high = suppressed.min() + 0.3 * (suppressed.max() - suppressed.min())
+    return viewer.hysteresis_threshold(suppressed, low, high)
+
+
+# Case name -> (runner(viewer, volume), tolerance). Binary maps must match exactly.
+CASES = {
+    "mean_filter": (lambda v, vol: v.mean_filter(vol, 3), SMOOTH),
+    "median_filter": (lambda v, vol: v.median_filter(vol, 3), SMOOTH),
+    "bilateral_filter": (lambda v, vol: v.bilateral_filter(vol, 5, 1.5, 50.0), SMOOTH),
+    "anisotropic_diffusion": (lambda v, vol: v.anisotropic_diffusion(vol, 3, 50.0, 0.25), SMOOTH),
+    "gaussian_blur": (lambda v, vol: v.gaussian_blur(_axial(v, vol), 5), SMOOTH),
+    "sobel_gradients": (lambda v, vol: np.stack(v.sobel_gradients(_axial(v, vol))), SMOOTH),
+    "non_maximum_suppression": (_suppressed, SMOOTH),
+    "hysteresis_threshold": (_hysteresis, EXACT),
+    "convolution2d": (lambda v, vol: v.convolution2d(_axial(v, vol), v.gaussian_kernel(5, 1.0)), SMOOTH),
+    "nlm_2d": (lambda v, vol: v.nlm_2d(_axial(v, vol), 3, 3, 0.1), SMOOTH),
+    "edge_detection": (lambda v, vol: v.edge_detection(0.1, 0.3, 3, vol), EXACT),
+    "non_local_means": (lambda v, vol: v.non_local_means(3, 2, 0.1, vol), SMOOTH),
+    "roberts_edge_detection": (lambda v, vol: v.roberts_edge_detection(vol, 0.1), EXACT),
+    "laplacian_of_gaussian": (lambda v, vol: v.laplacian_of_gaussian(vol, 1.0, 5), EXACT),
+    "threshold_segmentation": (lambda v, vol: v.threshold_segmentation(400.0, 800.0), EXACT),
+    "region_growing": (lambda v, vol: v.region_growing(tuple(s // 2 for s in vol.shape), 0.15), EXACT),
+    "kmeans_segmentation": (lambda v, vol: v.kmeans_segmentation(3, 20), EXACT),
+}
+
+ENGINES = ("reference", "fast")
+
+
+def run_case(case, volume, engine):
+    """Run one case on a volume with the given engine"""
+    viewer = headless_viewer(volume)
+    viewer.kernel_engine = engine
+    viewer.float_dtype = volume.dtype.type
+    runner, _ = CASES[case]
+    return np.asarray(runner(viewer, volume.copy()))
+
+
+def update_golden(path=GOLDEN_PATH, log=print):
+    """Recompute every golden output with the reference engine"""
+    arrays = {}
+    for name, build in PHANTOMS.items():
+        volume = build()
+        arrays[f"{name}/input"] = volume
+        for case in CASES:
+            arrays[f"{name}/{case}"] = run_case(case, volume, "reference")
+            log(f"{name}/{case}: stored {arrays[f'{name}/{case}'].shape}")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez_compressed(path, **arrays)
+    log(f"Golden outputs written to {path}")
+
+
+def compare(output, expected, tolerance):
+    """Return (passed, max_abs_error, mismatched_fraction)"""
+    if output.shape != expected.shape:
+        return False, float("inf"), 1.0
+    if output.size == 0:
+        return True, 0.0, 0.0
+    diff = np.abs(output.astype(np.float64) - expected.astype(np.float64))
+    close = np.isclose(output, expected, rtol=tolerance["rtol"], atol=tolerance["atol"])
+    return bool(close.all()), float(diff.max()), float(1.0 - close.mean())
+
+
+def check(engines=ENGINES, cases=None, path=GOLDEN_PATH, log=print):
+    """Check the selected engines against the stored golden outputs; return the failures"""
+    golden = np.load(path)
+    failures = []
+    for name in PHANTOMS:
+        volume = golden[f"{name}/input"]
+        for case in cases or CASES:
+            expected = golden[f"{name}/{case}"]
+            for engine in engines:
+                output = run_case(case, volume, engine)
+                passed, max_error, mismatched = compare(output, expected, CASES[case][1])
+                status = "ok" if passed else "FAIL"
+                log(f"{status:4s} {name:12s} {case:24s} {engine:9s} max|err|={max_error:.3g} "
+                    f"mismatched={mismatched:.2%}")
+                if not passed:
+                    failures.append((name, case, engine))
+    return failures
+
+
+def precision_report(engine="fast", dtype=np.float32, cases=None, path=GOLDEN_PATH, log=print):
+    """Compare an engine run on reduced-precision inputs against the float64 golden outputs
+
+    Continuous outputs report the max absolute error and the max error relative to
+    the golden output range; binary maps and label volumes report the fraction of
+    voxels that flipped.
+    """
+    golden = np.load(path)
+    report = []
+    for name in PHANTOMS:
+        volume = golden[f"{name}/input"].astype(dtype)
+        for case in cases or CASES:
+            expected = golden[f"{name}/{case}"].astype(np.float64)
+            output = run_case(case, volume, engine)
+            if output.shape != expected.shape:
+                entry = {"phantom": name, "case": case, "dtype": None,
+                         "max_abs": float("inf"), "max_rel": float("inf"), "mismatched": 1.0}
+            else:
+                diff = np.abs(output.astype(np.float64) - expected)
+                value_range = float(expected.max() - expected.min()) or 1.0
+                entry = {"phantom": name, "case": case, "dtype": output.dtype.name,
+                         "max_abs": float(diff.max()) if diff.size else 0.0,
+                         "max_rel": float(diff.max()) / value_range if diff.size else 0.0,
+                         "mismatched": float((diff > 0).mean()) if diff.size else 0.0}
+            report.append(entry)
+            if CASES[case][1] is EXACT:
+                log(f"{name:12s} {case:24s} {entry['dtype'] or '-':8s} flipped={entry['mismatched']:.3%}")
+            else:
+                log(f"{name:12s} {case:24s} {entry['dtype'] or '-':8s} max|err|={entry['max_abs']:.3g} "
+                    f"rel={entry['max_rel']:.3g}")
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check NiftiViewer kernels against golden outputs")
+    parser.add_argument("--update", action="store_true", help="Regenerate the golden outputs with the reference engine")
+    parser.add_argument("--engine", choices=ENGINES, action="append", help="Engine(s) to check (default: all)")
+    parser.add_argument("--cases", nargs="+", choices=sorted(CASES), metavar="CASE", help="Cases to check (default: all)")
+    parser.add_argument("--golden", default=GOLDEN_PATH, help="Golden outputs file")
+    parser.add_argument("--precision-report", action="store_true",
+                        help="Report the error of float32 inputs against the float64 golden outputs")
+    args = parser.parse_args(argv)
+
+    if args.precision_report:
+        for engine in args.engine or ("fast",):
+            print(f"float32 vs float64 golden outputs ({engine} engine)")
+            precision_report(engine, np.float32, args.cases, args.golden)
+        return 0
+
+    if args.update:
+        update_golden(args.golden)
+        return 0
+
+    failures = check(args.engine or ENGINES, args.cases, args.golden)
+    print(f"{len(failures)} failure(s)" if failures else "All engines match the golden outputs")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
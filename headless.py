@@ -0,0 +1,92 @@
+"""Helpers to run the NiftiViewer processing code without a Tk display"""
+import numpy as np
+
+import history
+import pyramid
+from imagenProc import NiftiViewer
+
+
+class NullVar:
+    """Stand-in for tk.StringVar when no window exists"""
+    def __init__(self, value=None):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+
+class NullRoot:
+    """Stand-in for the Tk root used by the progress updates inside the filters"""
+    def update_idletasks(self):
+        pass
+
+    def after(self, ms, func=None, *args):
+        return None
+
+    def after_idle(self, func, *args):
+        return None
+
+
+def headless_viewer(volume, spacing=(1.0, 1.0, 1.0)):
+    """Create a NiftiViewer bound to a volume (voxel size in mm), without building any widget"""
+    viewer = NiftiViewer.__new__(NiftiViewer)
+    viewer.root = NullRoot()
+    viewer.status_var = NullVar("Ready")
+    viewer.kernel_engine = "fast"
+    viewer.float_dtype = volume.dtype.type if volume.dtype.kind == "f" else np.float64
+    viewer.nii_image = None
+    viewer.image_modified = False
+    viewer.file_path = None
+    viewer.image_data = volume
+    viewer.width, viewer.height, viewer.depth = volume.shape
+    viewer.voxel_spacing = tuple(spacing)
+    viewer.corte_actual = "Axial"
+    viewer.indice_corte = viewer.depth // 2
+    viewer.cursor = [viewer.width // 2, viewer.height // 2, viewer.depth // 2]
+    viewer.triplanar_active = False
+    viewer.export_jobs = []
+    viewer.scene_3d = None
+    viewer.volume_3d_base = viewer.volume_3d_buffer = viewer.overlay_3d_mask = None
+    viewer.overlay_3d_count = 0
+    viewer.oblique_active = False
+    viewer.oblique_angles = [0.0, 0.0]
+    viewer.oblique_drag = None
+    viewer.oblique_cache = None
+    viewer.range_cache = (None, 0.0, 0.0)
+    viewer.draw_color = (255, 0, 0)
+    viewer.draw_radius = 3
+    viewer.view_buffers = {}
+    viewer.history = history.History()
+    viewer.pyramid = pyramid.SlicePyramid()
+    viewer.zoom = 1.0
+    viewer.view_center = None
+    viewer.reset_overlay()
+    return viewer
+
+
+def make_phantom(size, seed=0, noise=0.05):
+    """Build a deterministic head-like phantom: nested ellipsoids plus Gaussian noise"""
+    if np.isscalar(size):
+        size = (int(size),) * 3
+    width, height, depth = size
+
+    # Normalized coordinates in [-1, 1] (broadcast grids, no full meshgrid)
+    x = np.linspace(-1.0, 1.0, width)[:, None, None]
+    y = np.linspace(-1.0, 1.0, height)[None, :, None]
+    z = np.linspace(-1.0, 1.0, depth)[None, None, :]
+
+    volume = np.zeros(size, dtype=np.float64)
+
+    # Skull, brain, ventricles and a bright lesion
+    volume[(x / 0.9) ** 2 + (y / 0.8) ** 2 + (z / 0.85) ** 2 <= 1.0] = 1000.0
+    volume[(x / 0.8) ** 2 + (y / 0.7) ** 2 + (z / 0.75) ** 2 <= 1.0] = 600.0
+    volume[((x - 0.15) / 0.12) ** 2 + (y / 0.3) ** 2 + (z / 0.2) ** 2 <= 1.0] = 200.0
+    volume[((x + 0.15) / 0.12) ** 2 + (y / 0.3) ** 2 + (z / 0.2) ** 2 <= 1.0] = 200.0
+    volume[(x - 0.3) ** 2 + (y + 0.35) ** 2 + (z - 0.2) ** 2 <= 0.1 ** 2] = 900.0
+
+    rng = np.random.default_rng(seed)
+    volume += rng.normal(0.0, noise * 1000.0, size)
+    return volume
@@ -0,0 +1,199 @@
+"""Undo/redo history with compact deltas and a memory budget
+
+Annotation edits are stored as the sorted flat indices of the changed voxels
+(delta-encoded) with their old and new values, zlib-compressed. Replaced
+volumes are kept as plain array snapshots. Everything held in RAM counts
+against a budget; past it, the oldest entries are spilled to a temporary
+directory (raw .npy files read back through a memory map, compressed deltas
+as-is), so a long history costs disk space instead of multiplying RAM use.
+"""
+import os
+import shutil
+import tempfile
+import zlib
+
+import numpy as np
+
+# Default RAM budget for the whole history and maximum number of undo steps
+DEFAULT_BUDGET = 512 * 1024 ** 2
+MAX_STEPS = 100
+
+
+class AnnotationDelta:
+    """Changed voxels of a label volume region, as compressed (indices, old values, new values)"""
+    def __init__(self, region, indices, old, new):
+        self.region = region
+        self.count = len(indices)
+        # Sorted indices are delta-encoded so runs of changed voxels compress to almost nothing
+        steps = np.diff(indices, prepend=0).astype(np.uint32)
+        self.payload = zlib.compress(steps.tobytes() + old.tobytes() + new.tobytes(), 1)
+        self.path = None
+
+    @classmethod
+    def between(cls, region, before, after):
+        """Delta turning before into after (same-shape arrays), or None if nothing changed"""
+        changed = np.flatnonzero(before != after)
+        if changed.size == 0:
+            return None
+        return cls(region, changed, np.ravel(before)[changed], np.ravel(after)[changed])
+
+    @property
+    def nbytes(self):
+        return 0 if self.payload is None else len(self.payload)
+
+    def _decode(self):
+        if self.payload is not None:
+            payload = self.payload
+        else:
+            with open(self.path, "rb") as f:
+                payload = f.read()
+        data = np.frombuffer(zlib.decompress(payload), dtype=np.uint8)
+        split = self.count * 4
+        indices = np.cumsum(data[:split].view(np.uint32), dtype=np.int64)
+        return indices, data[split:split + self.count], data[split + self.count:]
+
+    def apply(self, volume, undo):
+        """Write the old (undo) or new (redo) values into volume[region]"""
+        indices, old, new = self._decode()
+        volume[self.region].flat[indices] = old if undo else new
+
+    def spill(self, directory):
+        if self.payload is None:
+            return
+        fd, self.path = tempfile.mkstemp(suffix=".delta", dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(self.payload)
+        self.payload = None
+
+    def discard(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ArraySnapshot:
+    """A whole array, in RAM or spilled to a memory-mapped .npy file"""
+    def __init__(self, array):
+        self.array = array
+        self.path = None
+
+    @property
+    def nbytes(self):
+        return 0 if self.path is not None else self.array.nbytes
+
+    def take(self):
+        """The stored array as an in-memory array (the spill file is removed)"""
+        array = self.array
+        if self.path is not None:
+            array = np.array(array)
+            self.array = None
+            self.discard()
+        return array
+
+    def put(self, array):
+        self.discard()
+        self.array = array
+
+    def spill(self, directory):
+        if self.path is not None:
+            return
+        fd, path = tempfile.mkstemp(suffix=".npy", dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, self.array)
+        self.array = np.load(path, mmap_mode="r")
+        self.path = path
+
+    def discard(self):
+        if self.path is not None:
+            self.array = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.path = None
+
+
+class HistoryEntry:
+    """One undoable step: an annotation delta, a replaced volume and/or swapped attributes"""
+    def __init__(self, label, annotation=None, volume=None, state=None):
+        self.label = label
+        self.annotation = annotation
+        self.volume = ArraySnapshot(volume) if volume is not None else None
+        # Attribute values to swap with the owner's on undo/redo
+        self.state = state or {}
+
+    @property
+    def nbytes(self):
+        return sum(part.nbytes for part in (self.annotation, self.volume) if part is not None)
+
+    def spill(self, directory):
+        for part in (self.annotation, self.volume):
+            if part is not None:
+                part.spill(directory)
+
+    def discard(self):
+        for part in (self.annotation, self.volume):
+            if part is not None:
+                part.discard()
+
+
+class History:
+    """Undo and redo stacks of HistoryEntry, kept within a RAM budget"""
+    def __init__(self, budget=DEFAULT_BUDGET, max_steps=MAX_STEPS):
+        self.budget = budget
+        self.max_steps = max_steps
+        self.undo_stack = []
+        self.redo_stack = []
+        self.directory = None
+
+    def push(self, entry):
+        """Record a new step (discards the redo stack)"""
+        for stale in self.redo_stack:
+            stale.discard()
+        self.redo_stack = []
+        self.undo_stack.append(entry)
+        while len(self.undo_stack) > self.max_steps:
+            self.undo_stack.pop(0).discard()
+        self.enforce_budget()
+
+    def undo(self):
+        """Entry to undo, moved to the redo stack, or None"""
+        if not self.undo_stack:
+            return None
+        entry = self.undo_stack.pop()
+        self.redo_stack.append(entry)
+        return entry
+
+    def redo(self):
+        """Entry to redo, moved back to the undo stack, or None"""
+        if not self.redo_stack:
+            return None
+        entry = self.redo_stack.pop()
+        self.undo_stack.append(entry)
+        return entry
+
+    @property
+    def nbytes(self):
+        return sum(entry.nbytes for entry in self.undo_stack + self.redo_stack)
+
+    def enforce_budget(self):
+        """Spill the entries farthest from the current state until the RAM use fits the budget"""
+        if self.nbytes <= self.budget:
+            return
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix="nifti_viewer_history_")
+        # Oldest undo steps and the deepest redo steps are the least likely to be needed
+        for entry in self.undo_stack + self.redo_stack:
+            if self.nbytes <= self.budget:
+                break
+            entry.spill(self.directory)
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self.enforce_budget()
+
+    def clear(self):
+        for entry in self.undo_stack + self.redo_stack:
+            entry.discard()
+        self.undo_stack = []
+        self.redo_stack = []
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
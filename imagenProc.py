@@ -1,7 +1,5 @@
 import nibabel as nib
 import numpy as np
-import vtk
-from vtkmodules.util.numpy_support import numpy_to_vtk
 import tkinter as tk
 from tkinter import filedialog, ttk, messagebox, colorchooser
 from PIL import Image, ImageTk
@@ -9,6 +7,52 @@ import cv2
 import os
 import sys
 import json
+import time
+import multiprocessing
+
+import kernels
+import annotations
+import bitmask
+import components
+import morphology
+import history
+import pyramid
+import reslice
+import compositing
+import vtk_volume
+import scene3d
+import surfaces
+import nifti_export
+from profiling import profiler
+
+# Size (width, height) of the 2D slice display
+DISPLAY_SIZE = (512, 512)
+
+# Size of each panel of the tri-planar layout
+TRI_DISPLAY_SIZE = (256, 256)
+
+# Overlay opacity in the 2D views
+OVERLAY_ALPHA = 0.7
+
+# Zoom range of the 2D view (1 = whole slice fits the display) and wheel step
+MIN_ZOOM, MAX_ZOOM = 1.0, 32.0
+ZOOM_STEP = 1.25
+
+# Rotation of the oblique plane per pixel of mouse drag
+OBLIQUE_DEGREES_PER_PIXEL = 0.5
+
+# Thick-slab projection modes of the 2D views
+SLAB_MODES = {"Off": None, "MIP": "max", "MinIP": "min", "Mean": "mean"}
+
+# Morphological post-processing of segmentation results (labels shown -> morphology names)
+MORPHOLOGY_OPERATIONS = {"Erosión": "erode", "Dilatación": "dilate", "Apertura": "open", "Cierre": "close"}
+MORPHOLOGY_STRUCTURES = {"Caja": "box", "Cruz": "cross"}
+
+# 2D filters that process each slice on its own, and the axis of those slices
+SLICE_FILTER_AXES = {"Bordes": 2, "NLM": 2, "LoG": 2, "Roberts": 0}
+
+# Volume axes of each view: (slice axis, axis shown as rows, axis shown as columns)
+VIEW_AXES = {"Axial": (2, 0, 1), "Sagittal": (0, 1, 2), "Coronal": (1, 0, 2)}
 
 class NiftiViewer:
     def __init__(self, root):
@@ -19,9 +63,19 @@ class NiftiViewer:
         # Variables
         self.image_data = None
         self.nii_image = None
+        self.image_modified = False  # image_data no longer matches the file (e.g. preprocessing applied)
         self.width, self.height, self.depth = 0, 0, 0
+        self.voxel_spacing = (1.0, 1.0, 1.0)  # Voxel size (mm) along x, y, z
         self.corte_actual = "Axial"
         self.indice_corte = 0
+        self.cursor = [0, 0, 0]  # Linked [x, y, z] position shared by all views
+        self.triplanar_active = False
+        self.tri_indices = {}  # Slice index currently rendered in each tri-planar panel
+        self.oblique_active = False
+        self.oblique_angles = [0.0, 0.0]  # Pitch and yaw (degrees) of the oblique plane
+        self.oblique_drag = None  # Last mouse position while rotating the plane
+        self.oblique_cache = None  # (pose key, volume, voxel grid) of the last oblique plane
+        self.range_cache = (None, 0.0, 0.0)  # (volume, min, max) used to normalize oblique planes
         self.file_path = None
         
         # Drawing variables
@@ -30,11 +84,39 @@ class NiftiViewer:
         self.last_y = 0
         self.draw_radius = 3
         self.draw_color = (255, 0, 0)  # Red by default
-        self.draw_points = []  # List to store (x, y, z, slice_type) of drawn points
-        self.overlay_data = None  # 3D array for drawn overlay
+        self.strokes = []  # Brush strokes: view, slice index, path in slice coordinates, radii, color
+        self.current_stroke = None
+        self.overlay_data = None  # 3D array for drawn overlay (index into overlay_palette per voxel)
+        self.overlay_palette = [(0, 0, 0), self.draw_color]  # RGB per overlay index, 0 is empty
+        self.overlay_lut = compositing.palette_lut(self.overlay_palette, round(OVERLAY_ALPHA * 255))
         self.current_display_img = None  # Store current displayed image
+        self.history = history.History()  # Undo/redo of drawings, overlays and preprocessing
+        self.view_buffers = {}  # Preallocated gray/frame/label buffers per view
+        self.pyramid = pyramid.SlicePyramid()  # Normalized slices and downsampled levels
+        self.zoom = 1.0
+        self.view_center = None  # Slice (row, column) at the canvas centre, None = slice centre
+        self.pan_last = None
         self.seed_selection_mode = False
         
+        # Processing engine: "fast" (vectorized kernels) or "reference" (original loops)
+        self.kernel_engine = "fast"
+        
+        # Floating point type used to load and process volumes (masks are always uint8)
+        self.float_dtype = np.float64
+        
+        # Persistent 3D scene for the loaded volume and the buffers it renders.
+        # Scenes run in child processes; volume_3d_buffer is shared memory read by the child.
+        self.scene_3d = None
+        self.segmentation_scenes = []
+        self.pump_3d_active = False
+        self.volume_3d_base = None     # Normalized volume without overlay
+        self.volume_3d_buffer = None   # Volume shown in 3D (base + blended overlay)
+        self.overlay_3d_mask = None    # Overlay mask currently blended into the buffer
+        self.overlay_3d_count = 0      # Voxels set in overlay_3d_mask
+        
+        # NIfTI files being written on background threads: (job, done message, error message)
+        self.export_jobs = []
+        
         # UI Elements
         self.create_ui()
         
@@ -65,15 +147,61 @@ class NiftiViewer:
         filemenu.add_command(label="Save Drawings", command=self.save_drawings, state="disabled")
         filemenu.add_command(label="Load Drawings", command=self.load_drawings, state="disabled")
         filemenu.add_separator()
+        
+        # Submenu for processing precision
+        precisionmenu = tk.Menu(filemenu, tearoff=0)
+        self.precision_var = tk.StringVar(value="float64")
+        precisionmenu.add_radiobutton(label="float64 (exact)", variable=self.precision_var, value="float64",
+                                      command=lambda: self.set_precision("float64"))
+        precisionmenu.add_radiobutton(label="float32 (half memory)", variable=self.precision_var, value="float32",
+                                      command=lambda: self.set_precision("float32"))
+        filemenu.add_cascade(label="Precision", menu=precisionmenu)
+        
+        # Submenu for the compression and data type of exported NIfTI files
+        exportmenu = tk.Menu(filemenu, tearoff=0)
+        self.export_level_var = tk.IntVar(value=nifti_export.DEFAULT_LEVEL)
+        for label, level in (("Uncompressed (.nii)", 0), ("gzip Fast (1)", 1),
+                             ("gzip Default (6)", 6), ("gzip Best (9)", 9)):
+            exportmenu.add_radiobutton(label=label, variable=self.export_level_var, value=level)
+        exportmenu.add_separator()
+        self.export_quantize_var = tk.BooleanVar(value=False)
+        exportmenu.add_checkbutton(label="Quantize Continuous Data (int16)", variable=self.export_quantize_var)
+        filemenu.add_cascade(label="Export", menu=exportmenu)
+        filemenu.add_separator()
         filemenu.add_command(label="Exit", command=self.root.quit)
         menubar.add_cascade(label="File", menu=filemenu)
         
+        editmenu = tk.Menu(menubar, tearoff=0)
+        editmenu.add_command(label="Undo", command=self.undo, accelerator="Ctrl+Z")
+        editmenu.add_command(label="Redo", command=self.redo, accelerator="Ctrl+Y")
+        editmenu.add_separator()
+        
+        # Submenu for the RAM used by the history (older steps spill to disk)
+        budgetmenu = tk.Menu(editmenu, tearoff=0)
+        self.history_budget_var = tk.IntVar(value=self.history.budget // 1024 ** 2)
+        for megabytes in (128, 512, 2048):
+            budgetmenu.add_radiobutton(label=f"{megabytes} MB", variable=self.history_budget_var, value=megabytes,
+                                       command=lambda: self.history.set_budget(self.history_budget_var.get() * 1024 ** 2))
+        editmenu.add_cascade(label="History Memory", menu=budgetmenu)
+        menubar.add_cascade(label="Edit", menu=editmenu)
+        self.root.bind("<Control-z>", lambda event: self.undo())
+        self.root.bind("<Control-y>", lambda event: self.redo())
+        
         viewmenu = tk.Menu(menubar, tearoff=0)
         viewmenu.add_command(label="Axial View", command=lambda: self.change_slice_type("Axial"), state="disabled")
         viewmenu.add_command(label="Sagittal View", command=lambda: self.change_slice_type("Sagittal"), state="disabled")
         viewmenu.add_command(label="Coronal View", command=lambda: self.change_slice_type("Coronal"), state="disabled")
+        viewmenu.add_command(label="Reset Zoom", command=self.reset_zoom, state="disabled")
+        self.triplanar_var = tk.BooleanVar(value=False)
+        viewmenu.add_checkbutton(label="Tri-planar View", variable=self.triplanar_var,
+                                 command=lambda: self.set_triplanar(self.triplanar_var.get()), state="disabled")
+        self.oblique_var = tk.BooleanVar(value=False)
+        viewmenu.add_checkbutton(label="Oblique Reslice", variable=self.oblique_var,
+                                 command=lambda: self.set_oblique(self.oblique_var.get()), state="disabled")
         viewmenu.add_separator()
         viewmenu.add_command(label="3D Visualization", command=self.visualize_3d, state="disabled")
+        viewmenu.add_separator()
+        viewmenu.add_command(label="Performance", command=self.show_performance_panel)
         menubar.add_cascade(label="View", menu=viewmenu)
         
         drawmenu = tk.Menu(menubar, tearoff=0)
@@ -107,6 +235,12 @@ class NiftiViewer:
         prepmenu.add_command(label="Non-local Means", command=lambda: self.show_preprocessing_options("NLM"), state="disabled")
         prepmenu.add_command(label="Roberts Edge Detection", command=lambda: self.show_preprocessing_options("Roberts"), state="disabled")
         prepmenu.add_command(label="Laplacian of Gaussian (LoG)", command=lambda: self.show_preprocessing_options("LoG"), state="disabled")
+        prepmenu.add_separator()
+        self.engine_var = tk.StringVar(value=self.kernel_engine)
+        prepmenu.add_radiobutton(label="Motor vectorizado", variable=self.engine_var, value="fast",
+                                 command=lambda: setattr(self, "kernel_engine", self.engine_var.get()))
+        prepmenu.add_radiobutton(label="Motor de referencia (bucles)", variable=self.engine_var, value="reference",
+                                 command=lambda: setattr(self, "kernel_engine", self.engine_var.get()))
         menubar.add_cascade(label="Preprocesamiento", menu=prepmenu)
 
         self.prepmenu = prepmenu
@@ -149,6 +283,11 @@ class NiftiViewer:
         self.btn_3d = ttk.Button(view_frame, text="3D View", command=self.visualize_3d, state="disabled")
         self.btn_3d.grid(row=0, column=3, padx=5, pady=5)
         
+        self.chk_triplanar = ttk.Checkbutton(view_frame, text="Tri-planar", variable=self.triplanar_var,
+                                             command=lambda: self.set_triplanar(self.triplanar_var.get()),
+                                             state="disabled")
+        self.chk_triplanar.grid(row=0, column=4, padx=5, pady=5)
+        
         # Drawing controls
         draw_frame = ttk.LabelFrame(control_frame, text="Drawing Tools")
         draw_frame.grid(row=2, column=0, columnspan=2, padx=5, pady=5, sticky="ew")
@@ -171,13 +310,27 @@ class NiftiViewer:
         slice_frame = ttk.LabelFrame(self.root, text="Slice Navigation")
         slice_frame.pack(fill="x", padx=10, pady=5)
         
-        self.slice_slider = ttk.Scale(slice_frame, from_=0, to=100, orient="horizontal", command=self.update_slice)
+        self.slice_slider = ttk.Scale(slice_frame, from_=0, to=100, orient="horizontal", command=self.on_slider)
         self.slice_slider.pack(fill="x", padx=10, pady=5)
         self.slice_slider.state(["disabled"])
         
         self.slice_label = ttk.Label(slice_frame, text="Slice: 0/0")
         self.slice_label.pack(pady=2)
         
+        # Thick-slab projection around the current slice
+        slab_frame = ttk.Frame(slice_frame)
+        slab_frame.pack(pady=2)
+        ttk.Label(slab_frame, text="Slab:").pack(side="left", padx=5)
+        self.slab_mode_var = tk.StringVar(value="Off")
+        slab_mode = ttk.Combobox(slab_frame, textvariable=self.slab_mode_var, values=list(SLAB_MODES),
+                                 state="readonly", width=7)
+        slab_mode.pack(side="left", padx=5)
+        slab_mode.bind("<<ComboboxSelected>>", lambda event: self.update_slice())
+        ttk.Label(slab_frame, text="Thickness:").pack(side="left", padx=5)
+        self.slab_thickness_var = tk.IntVar(value=10)
+        ttk.Spinbox(slab_frame, from_=1, to=500, textvariable=self.slab_thickness_var, width=5,
+                    command=self.update_slice).pack(side="left", padx=5)
+        
         # Frame for image display
         display_frame = ttk.LabelFrame(self.root, text="Image Display")
         display_frame.pack(fill="both", expand=True, padx=10, pady=5)
@@ -185,11 +338,39 @@ class NiftiViewer:
         self.canvas = tk.Canvas(display_frame)
         self.canvas.pack(fill="both", expand=True, padx=10, pady=10)
         
+        # Tri-planar layout: one panel per orientation with a linked crosshair (hidden by default)
+        self.tri_frame = ttk.Frame(display_frame)
+        self.tri_panels = {}
+        width, height = TRI_DISPLAY_SIZE
+        for column, view in enumerate(VIEW_AXES):
+            label = ttk.Label(self.tri_frame, text=view)
+            label.grid(row=0, column=column, padx=5)
+            canvas = tk.Canvas(self.tri_frame, width=width, height=height, bg="black", highlightthickness=0)
+            canvas.grid(row=1, column=column, padx=5, pady=5)
+            image_item = canvas.create_image(0, 0, anchor=tk.NW)
+            horizontal = canvas.create_line(0, 0, 0, 0, fill="yellow")
+            vertical = canvas.create_line(0, 0, 0, 0, fill="yellow")
+            canvas.bind("<ButtonPress-1>", lambda event, view=view: self.triplanar_click(view, event))
+            canvas.bind("<B1-Motion>", lambda event, view=view: self.triplanar_click(view, event))
+            canvas.bind("<MouseWheel>", lambda event, view=view: self.triplanar_scroll(view, event))
+            canvas.bind("<Button-4>", lambda event, view=view: self.triplanar_scroll(view, event))
+            canvas.bind("<Button-5>", lambda event, view=view: self.triplanar_scroll(view, event))
+            self.tri_panels[view] = {'label': label, 'canvas': canvas, 'image': image_item,
+                                     'lines': (horizontal, vertical), 'photo': None}
+        
         # Bind mouse events for drawing
         self.canvas.bind("<ButtonPress-1>", self.start_draw)
         self.canvas.bind("<B1-Motion>", self.draw)
         self.canvas.bind("<ButtonRelease-1>", self.stop_draw)
         
+        # Zoom with the mouse wheel, pan with the middle or right button
+        self.canvas.bind("<MouseWheel>", self.on_mouse_wheel)
+        self.canvas.bind("<Button-4>", self.on_mouse_wheel)
+        self.canvas.bind("<Button-5>", self.on_mouse_wheel)
+        for button in (2, 3):
+            self.canvas.bind(f"<ButtonPress-{button}>", self.start_pan)
+            self.canvas.bind(f"<B{button}-Motion>", self.pan)
+        
         # Status bar
         self.status_var = tk.StringVar()
         self.status_var.set("Ready")
@@ -216,28 +397,36 @@ class NiftiViewer:
             self.status_var.set("Loading image...")
             self.root.update_idletasks()
             
+            # A new volume gets a new 3D scene and an empty history
+            self.close_3d()
+            self.history.clear()
+            
             self.file_path = file_path
             self.nii_image = nib.load(file_path)
-            self.image_data = self.nii_image.get_fdata()
+            self.image_modified = False
+            self.image_data = self.nii_image.get_fdata(dtype=self.float_dtype)
             
-            # Get dimensions
+            # Get dimensions and voxel size
             self.width, self.height, self.depth = self.image_data.shape
+            self.voxel_spacing = self.header_spacing(self.nii_image)
+            self.cursor = [self.width // 2, self.height // 2, self.depth // 2]
+            self.tri_indices = {}
             
-            # Initialize overlay data
-            self.overlay_data = np.zeros_like(self.image_data)
-            
-            # Clear stored drawn points
-            self.draw_points = []
+            # Initialize overlay data and clear stored drawn points
+            self.reset_overlay()
             
             # Update UI
             filename = os.path.basename(file_path)
-            self.label_info.config(text=f"File: {filename}\nDimensions: {self.width}×{self.height}×{self.depth}")
+            spacing = "×".join(f"{s:g}" for s in self.voxel_spacing)
+            self.label_info.config(text=f"File: {filename}\nDimensions: {self.width}×{self.height}×{self.depth}\n"
+                                        f"Voxel size: {spacing} mm")
             
             # Enable controls
             self.btn_axial.state(["!disabled"])
             self.btn_sagittal.state(["!disabled"])
             self.btn_coronal.state(["!disabled"])
             self.btn_3d.state(["!disabled"])
+            self.chk_triplanar.state(["!disabled"])
             self.slice_slider.state(["!disabled"])
             self.btn_color.state(["!disabled"])
             self.btn_clear.state(["!disabled"])
@@ -247,6 +436,9 @@ class NiftiViewer:
             self.viewmenu.entryconfig("Axial View", state="normal")
             self.viewmenu.entryconfig("Sagittal View", state="normal")
             self.viewmenu.entryconfig("Coronal View", state="normal")
+            self.viewmenu.entryconfig("Reset Zoom", state="normal")
+            self.viewmenu.entryconfig("Tri-planar View", state="normal")
+            self.viewmenu.entryconfig("Oblique Reslice", state="normal")
             self.viewmenu.entryconfig("3D Visualization", state="normal")
             self.segmenu.entryconfig("Umbralización", state="normal")
             self.segmenu.entryconfig("Crecimiento de Regiones", state="normal")
@@ -277,6 +469,26 @@ class NiftiViewer:
             messagebox.showerror("Error", f"Failed to load image: {str(e)}")
             self.status_var.set("Error loading image")
     
+    @staticmethod
+    def header_spacing(nii_image):
+        """Voxel size (mm) along x, y, z from the NIfTI header (1 mm where missing or invalid)"""
+        return vtk_volume.spacing_from_zooms(nii_image.header.get_zooms())
+    
+    def set_precision(self, precision):
+        """Set the floating point type used to load and process volumes"""
+        self.float_dtype = np.float32 if precision == "float32" else np.float64
+        self.precision_var.set(precision)
+        
+        if self.image_data is not None and self.image_data.dtype != self.float_dtype:
+            # Reload from the file when possible so float32 -> float64 recovers full precision
+            if self.nii_image is not None and not self.image_modified:
+                self.image_data = self.nii_image.get_fdata(dtype=self.float_dtype)
+            else:
+                self.image_data = self.image_data.astype(self.float_dtype)
+            self.update_slice()
+            self.refresh_3d(volume_changed=True)
+        self.status_var.set(f"Processing precision set to {precision}")
+    
     def change_slice_type(self, slice_type):
         """Change the slice orientation"""
         if self.image_data is None:
@@ -284,21 +496,94 @@ class NiftiViewer:
         
         self.corte_actual = slice_type
         
-        # Update slider range based on view
-        if slice_type == "Axial":
-            max_slice = self.depth - 1
-            self.indice_corte = self.depth // 2
-        elif slice_type == "Sagittal":
-            max_slice = self.width - 1
-            self.indice_corte = self.width // 2
-        else:  # Coronal
-            max_slice = self.height - 1
-            self.indice_corte = self.height // 2
+        # Update slider range based on view, keeping the linked cursor position
+        slice_axis = VIEW_AXES[slice_type][0]
+        max_slice = self.image_data.shape[slice_axis] - 1
+        self.indice_corte = self.cursor[slice_axis]
         
         self.slice_slider.config(from_=0, to=max_slice)
         self.slice_slider.set(self.indice_corte)
+        if self.triplanar_active:
+            # The panels already show this view; only the slider target changes
+            self.update_triplanar()
+        else:
+            self.reset_zoom()
+    
+    def reset_zoom(self):
+        """Show the whole slice again"""
+        self.zoom = 1.0
+        self.view_center = None
         self.update_slice()
     
+    def zoom_view(self, factor, canvas_x, canvas_y):
+        """Zoom by factor keeping the slice point under the cursor in place"""
+        if self.image_data is None:
+            return
+        row, col = self.canvas_to_slice(canvas_x, canvas_y)
+        self.zoom = min(max(self.zoom * factor, MIN_ZOOM), MAX_ZOOM)
+        scale_row, scale_col = self.view_scale()
+        self.view_center = (row + (DISPLAY_SIZE[1] / 2 - canvas_y) / scale_row,
+                            col + (DISPLAY_SIZE[0] / 2 - canvas_x) / scale_col)
+        self.clamp_view()
+        self.update_slice()
+    
+    def on_mouse_wheel(self, event):
+        """Zoom in or out around the cursor"""
+        zoom_in = event.num == 4 or getattr(event, 'delta', 0) > 0
+        self.zoom_view(ZOOM_STEP if zoom_in else 1 / ZOOM_STEP, event.x, event.y)
+    
+    def start_pan(self, event):
+        self.pan_last = (event.x, event.y)
+    
+    def pan(self, event):
+        """Drag the zoomed slice"""
+        if self.image_data is None or self.pan_last is None:
+            return
+        scale_row, scale_col = self.view_scale()
+        row, col = self.get_view_center()
+        self.view_center = (row - (event.y - self.pan_last[1]) / scale_row,
+                            col - (event.x - self.pan_last[0]) / scale_col)
+        self.pan_last = (event.x, event.y)
+        self.clamp_view()
+        self.update_slice()
+    
+    def clamp_view(self):
+        """Keep the visible window inside the slice (centred along axes that fit in the canvas)"""
+        _, row_axis, col_axis = VIEW_AXES[self.corte_actual]
+        rows, cols = self.image_data.shape[row_axis], self.image_data.shape[col_axis]
+        scale_row, scale_col = self.view_scale()
+        half_rows, half_cols = DISPLAY_SIZE[1] / (2 * scale_row), DISPLAY_SIZE[0] / (2 * scale_col)
+        row, col = self.get_view_center()
+        self.view_center = (min(max(row, half_rows), rows - half_rows) if 2 * half_rows < rows else rows / 2,
+                            min(max(col, half_cols), cols - half_cols) if 2 * half_cols < cols else cols / 2)
+    
+    def get_view_center(self):
+        """Slice (row, column) shown at the canvas centre"""
+        if self.view_center is not None:
+            return self.view_center
+        _, row_axis, col_axis = VIEW_AXES[self.corte_actual]
+        return self.image_data.shape[row_axis] / 2, self.image_data.shape[col_axis] / 2
+    
+    def fit_scale(self, view, size):
+        """Display pixels per slice pixel along rows and columns fitting a whole slice in size with square mm"""
+        _, row_axis, col_axis = VIEW_AXES[view]
+        shape = self.image_data.shape
+        row_mm, col_mm = self.voxel_spacing[row_axis], self.voxel_spacing[col_axis]
+        # One display scale in pixels per mm, set by the axis with the larger physical extent
+        pixels_per_mm = min(size[1] / (shape[row_axis] * row_mm), size[0] / (shape[col_axis] * col_mm))
+        return pixels_per_mm * row_mm, pixels_per_mm * col_mm
+    
+    def view_scale(self):
+        """Display pixels per slice pixel along rows and columns at the current zoom"""
+        scale_row, scale_col = self.fit_scale(self.corte_actual, DISPLAY_SIZE)
+        return scale_row * self.zoom, scale_col * self.zoom
+    
+    def view_origin(self):
+        """Slice (row, column) at the canvas top-left corner"""
+        scale_row, scale_col = self.view_scale()
+        row, col = self.get_view_center()
+        return row - DISPLAY_SIZE[1] / (2 * scale_row), col - DISPLAY_SIZE[0] / (2 * scale_col)
+    
     def normalize_image(self, img):
         """Normalize image to 0-255 range"""
         min_val = np.min(img)
@@ -315,67 +600,370 @@ class NiftiViewer:
         """Resize image to target size"""
         return cv2.resize(img, target_size, interpolation=cv2.INTER_LINEAR)
     
+    def reset_overlay(self):
+        """Empty overlay volume, palette and drawn points for the loaded image"""
+        self.overlay_data = np.zeros(self.image_data.shape, dtype=np.uint8)
+        self.overlay_palette = [(0, 0, 0), self.draw_color]
+        self.overlay_lut = compositing.palette_lut(self.overlay_palette, round(OVERLAY_ALPHA * 255))
+        self.strokes = []
+        self.current_stroke = None
+        self.annotation_reader = None  # Annotation file whose slabs are still streaming in
+    
+    def palette_index(self, color):
+        """Overlay index of a draw color, adding the color to the palette if needed"""
+        color = tuple(int(c) for c in color)
+        if color in self.overlay_palette[1:]:
+            return self.overlay_palette.index(color, 1)
+        if len(self.overlay_palette) < 256:
+            self.overlay_palette.append(color)
+            self.overlay_lut = compositing.palette_lut(self.overlay_palette, round(OVERLAY_ALPHA * 255))
+            return len(self.overlay_palette) - 1
+        # uint8 overlay is full: reuse the closest color
+        distances = np.abs(np.array(self.overlay_palette[1:]) - color).sum(axis=1)
+        return int(np.argmin(distances)) + 1
+    
+    def slice_region(self, index=None, view=None):
+        """Index tuple selecting a slice in a view (current by default)"""
+        index = self.indice_corte if index is None else index
+        slice_axis = VIEW_AXES[view or self.corte_actual][0]
+        return (slice(None),) * slice_axis + (index,)
+    
+    def get_slice(self, volume, index=None, view=None):
+        """Slice of a volume in a view (current by default), as (rows, columns) per VIEW_AXES"""
+        return volume[self.slice_region(index, view)]
+    
+    def canvas_to_slice(self, canvas_x, canvas_y):
+        """Continuous (row, column) slice coordinates of a canvas position of the current view"""
+        scale_row, scale_col = self.view_scale()
+        top, left = self.view_origin()
+        return top + canvas_y / scale_row, left + canvas_x / scale_col
+    
+    def canvas_to_voxel(self, canvas_x, canvas_y):
+        """Volume [x, y, z] index under a canvas position of the current view"""
+        slice_axis, row_axis, col_axis = VIEW_AXES[self.corte_actual]
+        row, col = self.canvas_to_slice(canvas_x, canvas_y)
+        voxel = [0, 0, 0]
+        voxel[slice_axis] = self.indice_corte
+        voxel[row_axis] = int(row)
+        voxel[col_axis] = int(col)
+        # Ensure coordinates are within bounds
+        return tuple(max(0, min(v, n - 1)) for v, n in zip(voxel, self.image_data.shape))
+    
+    def brush_radii(self):
+        """Brush radius (display pixels) in slice rows and columns of the current view"""
+        scale_row, scale_col = self.view_scale()
+        return self.draw_radius / scale_row, self.draw_radius / scale_col
+    
+    def voxel_to_canvas(self, x, y, z):
+        """Canvas position of the centre of a volume [x, y, z] voxel in the current view"""
+        _, row_axis, col_axis = VIEW_AXES[self.corte_actual]
+        scale_row, scale_col = self.view_scale()
+        top, left = self.view_origin()
+        voxel = (x, y, z)
+        return (int((voxel[col_axis] + 0.5 - left) * scale_col),
+                int((voxel[row_axis] + 0.5 - top) * scale_row))
+    
+    def view_transform(self):
+        """(scale_row, scale_col, top, left) of the main canvas at the current zoom and pan"""
+        return (*self.view_scale(), *self.view_origin())
+    
+    def fit_transform(self, view, size):
+        """(scale_row, scale_col, top, left) showing a whole slice of a view centred in a display of size"""
+        _, row_axis, col_axis = VIEW_AXES[view]
+        shape = self.image_data.shape
+        scale_row, scale_col = self.fit_scale(view, size)
+        return (scale_row, scale_col,
+                (shape[row_axis] - size[1] / scale_row) / 2, (shape[col_axis] - size[0] / scale_col) / 2)
+    
+    def get_view_buffers(self, view=None, size=DISPLAY_SIZE):
+        """Frame buffers of a view (current by default) at a display size, allocated once"""
+        key = (view or self.corte_actual, size)
+        buffers = self.view_buffers.get(key)
+        if buffers is None:
+            width, height = size
+            buffers = {
+                "gray": np.empty((height, width), dtype=np.uint8),
+                "frame": np.empty((height, width, 3), dtype=np.uint8),
+                "labels": np.empty((height, width), dtype=np.uint8),
+            }
+            self.view_buffers[key] = buffers
+        return buffers
+    
+    def warp_to_display(self, image, level, out, interpolation, border, transform):
+        """Render the visible window of a slice (or of its pyramid level) into a display buffer"""
+        scale_row, scale_col, top, left = transform
+        size = (out.shape[1], out.shape[0])
+        factor_row, factor_col = 2 ** level[0], 2 ** level[1]
+        rows, cols = image.shape
+        
+        # Level pixel coordinate (centre convention) of each display pixel centre
+        step_row, step_col = 1 / (scale_row * factor_row), 1 / (scale_col * factor_col)
+        offset_row = (top + 0.5 / scale_row) / factor_row - 0.5
+        offset_col = (left + 0.5 / scale_col) / factor_col - 0.5
+        
+        # Only the visible region (plus a pixel for interpolation) is sampled
+        row0 = max(0, int(np.floor(offset_row)) - 1)
+        col0 = max(0, int(np.floor(offset_col)) - 1)
+        row1 = min(rows, int(np.ceil(offset_row + step_row * size[1])) + 2)
+        col1 = min(cols, int(np.ceil(offset_col + step_col * size[0])) + 2)
+        region = np.ascontiguousarray(image[row0:row1, col0:col1])
+        
+        matrix = np.array([[step_col, 0.0, offset_col - col0],
+                           [0.0, step_row, offset_row - row0]])
+        cv2.warpAffine(region, matrix, size, dst=out, flags=interpolation | cv2.WARP_INVERSE_MAP, borderMode=border)
+        
+        # Clear the margins around a slice narrower than the display along one axis
+        y0, y1 = np.clip(np.rint(np.array([-top, rows * factor_row - top]) * scale_row), 0, size[1]).astype(int)
+        x0, x1 = np.clip(np.rint(np.array([-left, cols * factor_col - left]) * scale_col), 0, size[0]).astype(int)
+        out[:y0] = 0
+        out[y1:] = 0
+        out[:, :x0] = 0
+        out[:, x1:] = 0
+        return out
+    
+    def render_view(self, view, index, transform, buffers):
+        """Composite one slice of a view (pyramid level + overlay) into its frame buffer"""
+        frame = buffers["frame"]
+        slice_axis = VIEW_AXES[view][0]
+        
+        # Normalized slice (or slab projection) at the pyramid level matching the zoom (shared by all views)
+        with profiler.span("view:normalize"):
+            level = tuple(pyramid.SlicePyramid.level_for(scale) for scale in transform[:2])
+            level_image = self.pyramid.get(self.image_data, slice_axis, index, level, self.slab_range(view, index))
+        
+        # Resample the visible window and the overlay indices (nearest, so indices never mix)
+        with profiler.span("view:resize"):
+            self.warp_to_display(level_image, level, buffers["gray"], cv2.INTER_LINEAR,
+                                 cv2.BORDER_REPLICATE, transform)
+            self.warp_to_display(self.get_slice(self.overlay_data, index, view), (0, 0), buffers["labels"],
+                                 cv2.INTER_NEAREST, cv2.BORDER_CONSTANT, transform)
+        
+        with profiler.span("view:colormap"):
+            cv2.applyColorMap(buffers["gray"], cv2.COLORMAP_BONE, dst=frame)
+        
+        # Blend the overlay colors in place, only where there is overlay
+        with profiler.span("view:blend"):
+            compositing.blend_labels(frame, buffers["labels"], self.overlay_lut)
+        return frame
+    
+    def slab_range(self, view, index):
+        """(mode, first slice, last slice + 1) of the slab centred on index, or None for a plain slice"""
+        mode_var = getattr(self, 'slab_mode_var', None)
+        mode = SLAB_MODES.get(mode_var.get()) if mode_var is not None else None
+        if mode is None:
+            return None
+        try:
+            thickness = int(self.slab_thickness_var.get())
+        except (tk.TclError, ValueError):
+            return None
+        count = self.image_data.shape[VIEW_AXES[view][0]]
+        thickness = min(max(thickness, 1), count)
+        if thickness == 1:
+            return None
+        start = min(max(index - thickness // 2, 0), count - thickness)
+        return mode, start, start + thickness
+    
+    def on_slider(self, value):
+        """Move the current view to the slider position"""
+        if self.image_data is None:
+            return
+        if self.triplanar_active:
+            self.indice_corte = int(float(value))
+            self.cursor[VIEW_AXES[self.corte_actual][0]] = self.indice_corte
+            self.update_triplanar()
+        else:
+            self.update_slice()
+    
+    def set_triplanar(self, active):
+        """Switch between the single view and the linked tri-planar layout"""
+        self.triplanar_active = bool(active) and self.image_data is not None
+        self.triplanar_var.set(self.triplanar_active)
+        if self.triplanar_active:
+            self.oblique_active = False
+            self.oblique_var.set(False)
+            self.canvas.pack_forget()
+            self.tri_frame.pack(fill="both", expand=True, padx=10, pady=10)
+            self.tri_indices = {}
+            self.update_triplanar()
+        else:
+            self.tri_frame.pack_forget()
+            self.canvas.pack(fill="both", expand=True, padx=10, pady=10)
+            self.change_slice_type(self.corte_actual)
+    
+    def set_oblique(self, active):
+        """Switch the main view between the axis-aligned slice and an oblique plane through it"""
+        if self.triplanar_active and active:
+            self.set_triplanar(False)
+        self.oblique_active = bool(active) and self.image_data is not None
+        self.oblique_var.set(self.oblique_active)
+        self.oblique_angles = [0.0, 0.0]
+        if self.oblique_active:
+            self.status_var.set("Oblique reslice: drag to rotate the plane, the slider moves it")
+        self.update_slice()
+    
+    def rotate_oblique(self, event):
+        """Tilt the oblique plane with the mouse drag"""
+        last_x, last_y = self.oblique_drag
+        self.oblique_angles[0] += (event.y - last_y) * OBLIQUE_DEGREES_PER_PIXEL
+        self.oblique_angles[1] += (event.x - last_x) * OBLIQUE_DEGREES_PER_PIXEL
+        self.oblique_drag = (event.x, event.y)
+        self.coord_var.set(f"Oblique plane: pitch={self.oblique_angles[0]:.1f}°, yaw={self.oblique_angles[1]:.1f}°")
+        self.update_slice()
+    
+    def volume_affine(self):
+        """Voxel to world (mm) affine of the loaded image"""
+        return self.nii_image.affine if self.nii_image is not None else np.eye(4)
+    
+    def value_range(self):
+        """(min, max) of the volume, computed once per volume"""
+        if self.range_cache[0] is not self.image_data:
+            self.range_cache = (self.image_data, float(np.min(self.image_data)), float(np.max(self.image_data)))
+        return self.range_cache[1:]
+    
+    def oblique_grid(self):
+        """Voxel coordinates of the display pixels of the oblique plane, cached per pose"""
+        slice_axis, row_axis, col_axis = VIEW_AXES[self.corte_actual]
+        key = (self.corte_actual, self.indice_corte, tuple(self.oblique_angles))
+        if (self.oblique_cache is not None and self.oblique_cache[0] == key
+                and self.oblique_cache[1] is self.image_data):
+            return self.oblique_cache[2]
+        
+        affine = self.volume_affine()
+        shape = self.image_data.shape
+        _, sizes = reslice.axis_directions(affine)
+        row_dir, col_dir = reslice.plane_directions(affine, row_axis, col_axis, *self.oblique_angles)
+        
+        # Plane through the current slice, centred in the volume, with square pixels in mm
+        # covering the physical extent of the axis-aligned view
+        center_voxel = (np.array(shape, dtype=np.float64) - 1) / 2
+        center_voxel[slice_axis] = self.indice_corte
+        center = affine[:3, :3] @ center_voxel + affine[:3, 3]
+        spacing = max(shape[row_axis] * sizes[row_axis] / DISPLAY_SIZE[1],
+                      shape[col_axis] * sizes[col_axis] / DISPLAY_SIZE[0])
+        grid = reslice.plane_grid(affine, center, row_dir, col_dir, spacing, DISPLAY_SIZE)
+        self.oblique_cache = (key, self.image_data, grid)
+        return grid
+    
+    def render_oblique(self, fast=False):
+        """Composite the oblique plane: nearest samples while dragging, trilinear otherwise"""
+        buffers = self.get_view_buffers("Oblique")
+        frame = buffers["frame"]
+        low, high = self.value_range()
+        
+        with profiler.span("view:reslice"):
+            grid = self.oblique_grid()
+            sample = reslice.sample_nearest if fast else reslice.sample_trilinear
+            values = sample(self.image_data, grid, fill=low)
+            labels = reslice.sample_nearest(self.overlay_data, grid)
+        
+        with profiler.span("view:normalize"):
+            if high > low:
+                np.clip((values - low) * (255.0 / (high - low)), 0, 255, out=values, casting="unsafe")
+                buffers["gray"][...] = values
+            else:
+                buffers["gray"].fill(0)
+            buffers["labels"][...] = labels
+        
+        with profiler.span("view:colormap"):
+            cv2.applyColorMap(buffers["gray"], cv2.COLORMAP_BONE, dst=frame)
+        
+        with profiler.span("view:blend"):
+            compositing.blend_labels(frame, buffers["labels"], self.overlay_lut)
+        return frame
+    
+    @profiler.trace("view:update_triplanar")
+    def update_triplanar(self, force=False):
+        """Re-render the tri-planar panels whose slice changed and move the crosshairs"""
+        if self.image_data is None:
+            return
+        width, height = TRI_DISPLAY_SIZE
+        for view, panel in self.tri_panels.items():
+            slice_axis, row_axis, col_axis = VIEW_AXES[view]
+            index = self.cursor[slice_axis]
+            transform = self.fit_transform(view, TRI_DISPLAY_SIZE)
+            
+            if force or self.tri_indices.get(view) != index:
+                frame = self.render_view(view, index, transform, self.get_view_buffers(view, TRI_DISPLAY_SIZE))
+                with profiler.span("view:photoimage"):
+                    panel['photo'] = ImageTk.PhotoImage(Image.fromarray(frame))
+                panel['canvas'].itemconfig(panel['image'], image=panel['photo'])
+                panel['label'].config(text=f"{view}: {index}/{self.image_data.shape[slice_axis] - 1}")
+                self.tri_indices[view] = index
+            
+            # The crosshair marks the cursor in the two in-plane axes
+            scale_row, scale_col, top, left = transform
+            x = (self.cursor[col_axis] + 0.5 - left) * scale_col
+            y = (self.cursor[row_axis] + 0.5 - top) * scale_row
+            horizontal, vertical = panel['lines']
+            panel['canvas'].coords(horizontal, 0, y, width, y)
+            panel['canvas'].coords(vertical, x, 0, x, height)
+        
+        self.coord_var.set(f"Cursor: x={self.cursor[0]}, y={self.cursor[1]}, z={self.cursor[2]}")
+        self.sync_slider()
+    
+    def sync_slider(self):
+        """Show the cursor's slice of the current view on the slider"""
+        index = self.cursor[VIEW_AXES[self.corte_actual][0]]
+        if index != self.indice_corte:
+            self.indice_corte = index
+            self.slice_slider.set(index)
+        self.slice_label.config(
+            text=f"Slice: {index}/{self.image_data.shape[VIEW_AXES[self.corte_actual][0]] - 1}")
+    
+    def triplanar_click(self, view, event):
+        """Move the linked cursor to the clicked point of a tri-planar panel"""
+        if self.image_data is None:
+            return
+        _, row_axis, col_axis = VIEW_AXES[view]
+        scale_row, scale_col, top, left = self.fit_transform(view, TRI_DISPLAY_SIZE)
+        shape = self.image_data.shape
+        self.cursor[row_axis] = max(0, min(int(top + event.y / scale_row), shape[row_axis] - 1))
+        self.cursor[col_axis] = max(0, min(int(left + event.x / scale_col), shape[col_axis] - 1))
+        self.update_triplanar()
+    
+    def triplanar_scroll(self, view, event):
+        """Step through the slices of one tri-planar panel"""
+        if self.image_data is None:
+            return
+        slice_axis = VIEW_AXES[view][0]
+        step = 1 if event.num == 4 or getattr(event, 'delta', 0) > 0 else -1
+        self.cursor[slice_axis] = max(0, min(self.cursor[slice_axis] + step, self.image_data.shape[slice_axis] - 1))
+        self.update_triplanar()
+    
+    @profiler.trace("view:update_slice")
     def update_slice(self, *args):
         """Update the displayed slice"""
         if self.image_data is None:
             return
         
+        if self.triplanar_active:
+            # Volume or overlay changed: every panel is stale
+            self.update_triplanar(force=True)
+            return
+        
         try:
             self.indice_corte = int(self.slice_slider.get())
+            self.cursor[VIEW_AXES[self.corte_actual][0]] = self.indice_corte
             
-            # Get the correct slice based on orientation
-            if self.corte_actual == "Axial":
-                slice_data = self.image_data[:, :, self.indice_corte]
-                overlay_slice = self.overlay_data[:, :, self.indice_corte]
-                max_slice = self.depth - 1
-            elif self.corte_actual == "Sagittal":
-                slice_data = self.image_data[self.indice_corte, :, :]
-                overlay_slice = self.overlay_data[self.indice_corte, :, :]
-                max_slice = self.width - 1
-            else:  # Coronal
-                slice_data = self.image_data[:, self.indice_corte, :]
-                overlay_slice = self.overlay_data[:, self.indice_corte, :]
-                max_slice = self.height - 1
+            max_slice = self.image_data.shape[VIEW_AXES[self.corte_actual][0]] - 1
             
             # Update slice label
             self.slice_label.config(text=f"Slice: {self.indice_corte}/{max_slice}")
             
-            # Process the image
-            normalized = self.normalize_image(slice_data)
-            colormap = self.apply_colormap(normalized)
-            
-            # Blend with overlay
-            overlay_normalized = (overlay_slice > 0).astype(np.uint8) * 255
-            overlay_rgb = np.zeros((*overlay_normalized.shape, 3), dtype=np.uint8)
-            
-            # Draw the points with their colors
-            for point in self.draw_points:
-                x, y, z = point['x'], point['y'], point['z']
-                color = point.get('color', self.draw_color)  # Get the color for the point
-                if self.corte_actual == "Axial":
-                    overlay_rgb[y, x] = color  # Axial view uses x, y
-                elif self.corte_actual == "Sagittal":
-                    overlay_rgb[y, z] = color  # Sagittal view uses y, z
-                else:  # Coronal
-                    overlay_rgb[x, z] = color  # Coronal view uses x, z
-            
-            # Resize both
-            resized = self.resize_image(colormap)
-            overlay_resized = self.resize_image(overlay_rgb)
-            
-            # Blend images
-            alpha = 0.7
-            mask = (overlay_resized > 0).any(axis=2)
-            mask_3d = np.stack([mask, mask, mask], axis=2)
-            combined = np.where(mask_3d, cv2.addWeighted(resized, 1-alpha, overlay_resized, alpha, 0), resized)
+            if self.oblique_active:
+                frame = self.render_oblique(fast=self.oblique_drag is not None)
+            else:
+                frame = self.render_view(self.corte_actual, self.indice_corte, self.view_transform(),
+                                         self.get_view_buffers())
             
-            # Save current display image for drawing
-            self.current_display_img = combined.copy()
+            # Current display image (rewritten by the next update)
+            self.current_display_img = frame
             
             # Convert to PIL Image and display
-            img = Image.fromarray(combined)
-            #img = img.rotate(90, expand=True)
-            img_tk = ImageTk.PhotoImage(img)
+            with profiler.span("view:photoimage"):
+                img = Image.fromarray(frame)
+                #img = img.rotate(90, expand=True)
+                img_tk = ImageTk.PhotoImage(img)
             
             # Update canvas
             self.canvas.config(width=img.width, height=img.height)
@@ -393,6 +981,10 @@ class NiftiViewer:
         if color[1]:  # color is a tuple ((r,g,b), hexstring)
             self.draw_color = tuple(int(c) for c in color[0])
             self.color_preview.config(bg=color[1])
+            # The overlay is blended with the draw color, so the 3D view has to re-blend it
+            if self.overlay_3d_mask is not None and self.overlay_3d_count:
+                self.overlay_3d_mask = None
+                self.refresh_3d()
             self.status_var.set(f"Draw color set to {color[1]}")
     
     def set_brush_size(self, size):
@@ -402,69 +994,66 @@ class NiftiViewer:
     
     def start_draw(self, event):
         """Start drawing on mouse press"""
+        if self.oblique_active and self.image_data is not None:
+            # The oblique view is rotated with the mouse, not drawn on
+            self.oblique_drag = (event.x, event.y)
+            return
+        
         if not self.draw_mode_var.get() or self.image_data is None:
             return
         
         self.drawing = True
         self.last_x, self.last_y = event.x, event.y
         
+        # Overlay slice and stroke list as they were, for undo
+        self.finish_annotations()
+        self.stroke_before = self.get_slice(self.overlay_data).copy()
+        self.strokes_before = list(self.strokes)
+        
+        # New stroke, rasterized into the overlay segment by segment as the mouse moves
+        self.current_stroke = {
+            'view': self.corte_actual,
+            'index': self.indice_corte,
+            'radii': list(self.brush_radii()),
+            'color': list(self.draw_color),
+            'path': [],
+        }
+        self.strokes.append(self.current_stroke)
+        
         # Draw a single point
         self.draw(event)
     
     def draw(self, event):
         """Draw on the image as mouse moves"""
+        if self.oblique_drag is not None:
+            self.rotate_oblique(event)
+            return
+        
         if not self.drawing or self.current_display_img is None:
             return
     
         # Get current mouse position in canvas coordinates
         canvas_x, canvas_y = event.x, event.y
     
-        # Draw line between last position and current position on display image
-        cv2.line(self.current_display_img, (self.last_x, self.last_y), (canvas_x, canvas_y), 
-                self.draw_color, self.draw_radius * 2)
-    
-        # Update display
-        img = Image.fromarray(self.current_display_img)
-        img_tk = ImageTk.PhotoImage(img)
-        self.canvas.itemconfig(self.img_on_canvas, image=img_tk)
-        self.canvas.image = img_tk  # Keep a reference
-    
-        # Get the dimensions of the current slice
-        if self.corte_actual == "Axial":
-            slice_width, slice_height = self.width, self.height
-        elif self.corte_actual == "Sagittal":
-            slice_width, slice_height = self.depth, self.height
-        else:  # Coronal
-            slice_width, slice_height = self.width, self.depth
-    
-        # Convert canvas coordinates to slice coordinates
-        display_width, display_height = 512, 512  # Your resize dimensions
-        slice_x = int(canvas_x * slice_width / display_width)
-        slice_y = int(canvas_y * slice_height / display_height)
-    
-        # Map to 3D coordinates based on current view
-        if self.corte_actual == "Axial":
-            x_3d, y_3d, z_3d = slice_x, slice_y, self.indice_corte
-        elif self.corte_actual == "Sagittal":
-            x_3d, y_3d, z_3d = self.indice_corte, slice_y, slice_x
-        else:  # Coronal
-            x_3d, y_3d, z_3d = slice_x, self.indice_corte, slice_y
+        # Draw line between last position and current position as a canvas vector item;
+        # the slice image is only recomposited once, when the stroke ends
+        self.canvas.create_line(self.last_x, self.last_y, canvas_x, canvas_y,
+                                fill="#%02x%02x%02x" % tuple(self.draw_color),
+                                width=self.draw_radius * 2, capstyle=tk.ROUND, tags="stroke")
     
-        # Ensure coordinates are within bounds
-        x_3d = max(0, min(x_3d, self.width - 1))
-        y_3d = max(0, min(y_3d, self.height - 1))
-        z_3d = max(0, min(z_3d, self.depth - 1))
+        # Rasterize the segment with the brush footprint into the overlay slice
+        start = self.canvas_to_slice(self.last_x, self.last_y)
+        end = self.canvas_to_slice(canvas_x, canvas_y)
+        annotations.stamp_segment(self.get_slice(self.overlay_data), start, end,
+                                  self.current_stroke['radii'], self.palette_index(self.draw_color))
     
-        # Update overlay data
-        self.overlay_data[x_3d, y_3d, z_3d] = 1
+        # Store the stroke compactly: one path point per motion event
+        path = self.current_stroke['path']
+        if not path or path[-1] != list(end):
+            path.append(list(end))
     
-        # Store drawn point
-        self.draw_points.append({
-            'x': int(x_3d),
-            'y': int(y_3d),
-            'z': int(z_3d),
-            'color': self.draw_color
-        })
+        # Map canvas coordinates to 3D coordinates of the current view
+        x_3d, y_3d, z_3d = self.canvas_to_voxel(canvas_x, canvas_y)
     
         # Update coordinate display
         self.coord_var.set(f"Drawn at: x={x_3d}, y={y_3d}, z={z_3d} (View: {self.corte_actual})")
@@ -474,7 +1063,74 @@ class NiftiViewer:
 
     def stop_draw(self, event):
         """Stop drawing on mouse release"""
+        if self.oblique_drag is not None:
+            # Re-render the final pose with trilinear interpolation
+            self.oblique_drag = None
+            self.update_slice()
+            return
+        
+        if self.drawing:
+            region = self.slice_region(self.current_stroke['index'], self.current_stroke['view'])
+            self.push_history("Stroke", self.stroke_before, region, state={'strokes': self.strokes_before})
+            self.stroke_before = self.strokes_before = None
+            
+            # Replace the vector preview by the composited overlay
+            self.canvas.delete("stroke")
+            self.update_slice()
+            self.refresh_3d(region=region)
         self.drawing = False
+        self.current_stroke = None
+    
+    def overlay_state(self):
+        """Overlay attributes replaced by reset_overlay, for undo"""
+        return {'strokes': self.strokes, 'overlay_palette': self.overlay_palette, 'overlay_lut': self.overlay_lut}
+    
+    def push_history(self, label, before=None, region=(), volume=None, state=None):
+        """Record an undoable step: overlay[region] was before, image_data was volume, attributes were state"""
+        annotation = None
+        if before is not None:
+            annotation = history.AnnotationDelta.between(region, before, self.overlay_data[region])
+        if annotation is None and volume is None:
+            return
+        self.history.push(history.HistoryEntry(label, annotation, volume, state))
+    
+    def apply_history_entry(self, entry, undo):
+        """Move the viewer to the state before (undo) or after (redo) a history entry"""
+        if entry.annotation is not None:
+            entry.annotation.apply(self.overlay_data, undo)
+        # Attributes and volumes are swapped, so the entry always holds the other side
+        for key, value in entry.state.items():
+            entry.state[key] = getattr(self, key)
+            setattr(self, key, value)
+        volume_changed = entry.volume is not None
+        if volume_changed:
+            previous = self.image_data
+            self.image_data = entry.volume.take().astype(self.float_dtype, copy=False)
+            entry.volume.put(previous)
+            self.history.enforce_budget()
+        self.update_slice()
+        self.refresh_3d(volume_changed=volume_changed,
+                        region=entry.annotation.region if entry.annotation is not None else None)
+    
+    def undo(self):
+        """Undo the last stroke, cleared drawing, applied segmentation or preprocessing"""
+        self.finish_annotations()
+        entry = self.history.undo() if self.image_data is not None else None
+        if entry is None:
+            self.status_var.set("Nothing to undo")
+            return
+        self.apply_history_entry(entry, undo=True)
+        self.status_var.set(f"Undone: {entry.label}")
+    
+    def redo(self):
+        """Redo the last undone step"""
+        self.finish_annotations()
+        entry = self.history.redo() if self.image_data is not None else None
+        if entry is None:
+            self.status_var.set("Nothing to redo")
+            return
+        self.apply_history_entry(entry, undo=False)
+        self.status_var.set(f"Redone: {entry.label}")
     
     def clear_drawings(self):
         """Clear all drawings"""
@@ -482,33 +1138,35 @@ class NiftiViewer:
             return
             
         if messagebox.askyesno("Clear Drawings", "Are you sure you want to clear all drawings?"):
-            self.overlay_data = np.zeros_like(self.image_data)
-            self.draw_points = []
+            self.finish_annotations()
+            before, state = self.overlay_data, self.overlay_state()
+            self.reset_overlay()
+            self.push_history("Clear drawings", before, state=state)
             self.update_slice()
+            self.refresh_3d()
             self.status_var.set("Drawings cleared")
     
     def save_drawings(self):
-        """Save drawing points to a JSON file"""
-        if not self.draw_points:
+        """Save the drawings as a compressed annotation file"""
+        self.finish_annotations()
+        if self.overlay_data is None or not self.overlay_data.any():
             messagebox.showinfo("No Drawings", "There are no drawings to save.")
             return
             
         try:
             file_path = filedialog.asksaveasfilename(
-                defaultextension=".json",
-                filetypes=[("JSON Files", "*.json")],
-                title="Save Drawing Points"
+                defaultextension=".ann",
+                filetypes=[("Annotation Files", "*.ann")],
+                title="Save Drawings"
             )
             
             if not file_path:
                 return
                 
-            with open(file_path, 'w') as f:
-                json.dump({
-                    'original_image': os.path.basename(self.file_path),
-                    'dimensions': [self.width, self.height, self.depth],
-                    'points': self.draw_points
-                }, f, indent=2)
+            annotations.save_annotations(file_path, self.overlay_data, self.overlay_palette, {
+                'original_image': os.path.basename(self.file_path) if self.file_path else None,
+                'strokes': self.strokes
+            })
                 
             self.status_var.set(f"Drawings saved to {os.path.basename(file_path)}")
             
@@ -516,47 +1174,115 @@ class NiftiViewer:
             messagebox.showerror("Error", f"Failed to save drawings: {str(e)}")
     
     def load_drawings(self):
-        """Load drawing points from a JSON file"""
+        """Load drawings from an annotation file or a legacy JSON point list"""
         try:
             file_path = filedialog.askopenfilename(
-                filetypes=[("JSON Files", "*.json")],
-                title="Load Drawing Points"
+                filetypes=[("Annotation Files", "*.ann"), ("JSON Files", "*.json")],
+                title="Load Drawings"
             )
             
             if not file_path:
                 return
-                
-            with open(file_path, 'r') as f:
-                data = json.load(f)
-                
+            
+            if file_path.lower().endswith(".json"):
+                self.load_legacy_drawings(file_path)
+                return
+            
+            reader = annotations.AnnotationReader(file_path)
+            
             # Verify dimensions match
-            if data['dimensions'] != [self.width, self.height, self.depth]:
+            if reader.shape != self.image_data.shape:
+                reader.close()
                 messagebox.showwarning(
                     "Dimension Mismatch",
                     "The dimensions of the saved drawings do not match the current image."
                 )
                 return
-                
-            # Load points
-            self.draw_points = data['points']
             
-            # Recreate overlay data
-            self.overlay_data = np.zeros_like(self.image_data)
-            self.overlay_colors = {}
-
-            for point in self.draw_points:
-                x, y, z = point['x'], point['y'], point['z']
-                color = point.get('color', self.draw_color)
-                if 0 <= x < self.width and 0 <= y < self.height and 0 <= z < self.depth:
-                    self.overlay_data[x, y, z] = 1
-                    self.overlay_colors[(x,y,z)] = color
-                    
-            # Update display
-            self.update_slice()
-            self.status_var.set(f"Drawings loaded from {os.path.basename(file_path)}")
+            # Loaded drawings replace the overlay the history refers to
+            self.history.clear()
+            self.reset_overlay()
+            self.overlay_palette = list(reader.palette)
+            self.overlay_lut = compositing.palette_lut(self.overlay_palette, round(OVERLAY_ALPHA * 255))
+            self.strokes = reader.metadata.get('strokes', [])
+            
+            # Stream the slabs in, starting with the one around the current axial slice
+            self.annotation_reader = reader
+            first = reader.slab_of(self.indice_corte) if self.corte_actual == "Axial" else 0
+            order = sorted(range(len(reader)), key=lambda index: abs(index - first))
+            self.status_var.set(f"Loading drawings from {os.path.basename(file_path)}...")
+            self.stream_annotations(reader, order)
             
         except Exception as e:
             messagebox.showerror("Error", f"Failed to load drawings: {str(e)}")
+    
+    def stream_annotations(self, reader, order):
+        """Decode the next annotation slab and schedule the rest, keeping the UI responsive"""
+        if reader is not self.annotation_reader:
+            # Superseded by a new image, a cleared overlay or another file
+            reader.close()
+            return
+        
+        if not order:
+            reader.close()
+            self.annotation_reader = None
+            self.refresh_3d()
+            self.status_var.set("Drawings loaded")
+            return
+        
+        index = order.pop(0)
+        reader.read_slab(index, out=self.overlay_data)
+        z0, z1 = reader.slab_range(index)
+        if self.corte_actual != "Axial" or z0 <= self.indice_corte < z1:
+            self.update_slice()
+        self.root.after(1, self.stream_annotations, reader, order)
+    
+    def finish_annotations(self):
+        """Load the slabs still streaming in right away, before the overlay is edited, undone or saved"""
+        reader = self.annotation_reader
+        if reader is None:
+            return
+        # A later slab would overwrite the edit and leave its history delta stale
+        reader.read(out=self.overlay_data)
+        reader.close()
+        self.annotation_reader = None
+        self.update_slice()
+        self.refresh_3d()
+        self.status_var.set("Drawings loaded")
+    
+    def load_legacy_drawings(self, file_path):
+        """Import a JSON point list saved by earlier versions"""
+        with open(file_path, 'r') as f:
+            data = json.load(f)
+            
+        # Verify dimensions match
+        if data['dimensions'] != [self.width, self.height, self.depth]:
+            messagebox.showwarning(
+                "Dimension Mismatch",
+                "The dimensions of the saved drawings do not match the current image."
+            )
+            return
+        
+        # Recreate overlay data in one vectorized assignment
+        overlay, palette = annotations.import_legacy_json(data, self.image_data.shape, self.draw_color)
+        
+        # Loaded drawings replace the overlay the history refers to
+        self.history.clear()
+        self.reset_overlay()
+        self.overlay_data, self.overlay_palette = overlay, palette
+        self.overlay_lut = compositing.palette_lut(self.overlay_palette, round(OVERLAY_ALPHA * 255))
+        
+        # Replay brush strokes into their slices
+        self.strokes = data.get('strokes', [])
+        for stroke in self.strokes:
+            labels = self.get_slice(self.overlay_data, stroke['index'], stroke['view'])
+            annotations.rasterize_stroke(labels, stroke['path'], stroke['radii'],
+                                         self.palette_index(stroke['color']))
+                
+        # Update display
+        self.update_slice()
+        self.refresh_3d()
+        self.status_var.set(f"Drawings loaded from {os.path.basename(file_path)}")
 
     def show_about(self):
         """Show the about dialog"""
@@ -571,177 +1297,251 @@ class NiftiViewer:
             "- Save/load drawing coordinates\n"
             "- CT-like colormap visualization"
         )
-    
+
+    def show_performance_panel(self):
+        """Show the profiling panel with per-stage timings"""
+        if getattr(self, 'perf_window', None) is not None and self.perf_window.winfo_exists():
+            self.perf_window.lift()
+            return
+
+        self.perf_window = tk.Toplevel(self.root)
+        self.perf_window.title("Performance")
+        self.perf_window.geometry("700x400")
+
+        control_frame = ttk.Frame(self.perf_window)
+        control_frame.pack(fill="x", padx=10, pady=5)
+
+        self.profiling_var = tk.BooleanVar(value=profiler.enabled)
+        self.profile_memory_var = tk.BooleanVar(value=profiler.track_memory or not profiler.enabled)
+        ttk.Checkbutton(control_frame, text="Enable profiling", variable=self.profiling_var,
+                        command=self.toggle_profiling).pack(side="left", padx=5)
+        ttk.Checkbutton(control_frame, text="Track peak memory", variable=self.profile_memory_var,
+                        command=self.toggle_profiling).pack(side="left", padx=5)
+        ttk.Button(control_frame, text="Clear", command=self.clear_profiling).pack(side="left", padx=5)
+        ttk.Button(control_frame, text="Export Chrome Trace", command=self.export_profiling_trace).pack(side="left", padx=5)
+
+        columns = ("calls", "total", "mean", "max", "peak")
+        self.perf_tree = ttk.Treeview(self.perf_window, columns=columns)
+        self.perf_tree.heading("#0", text="Stage")
+        self.perf_tree.column("#0", width=250)
+        for column, title in zip(columns, ("Calls", "Total (ms)", "Mean (ms)", "Max (ms)", "Peak (MiB)")):
+            self.perf_tree.heading(column, text=title)
+            self.perf_tree.column(column, width=80, anchor="e")
+        self.perf_tree.pack(fill="both", expand=True, padx=10, pady=5)
+
+        self.refresh_performance_panel()
+
+    def toggle_profiling(self):
+        """Enable or disable the profiler from the panel checkboxes"""
+        profiler.disable()
+        if self.profiling_var.get():
+            profiler.enable(track_memory=self.profile_memory_var.get())
+            self.status_var.set("Profiling enabled")
+        else:
+            self.status_var.set("Profiling disabled")
+
+    def clear_profiling(self):
+        """Discard the recorded spans"""
+        profiler.clear()
+        self.refresh_performance_panel(reschedule=False)
+
+    def refresh_performance_panel(self, reschedule=True):
+        """Refresh the timings table (once per second while the panel is open)"""
+        if self.perf_window is None or not self.perf_window.winfo_exists():
+            return
+
+        self.perf_tree.delete(*self.perf_tree.get_children())
+        summary = sorted(profiler.summary().items(), key=lambda item: item[1]["total"], reverse=True)
+        for name, entry in summary:
+            peak = f"{entry['peak_bytes'] / 2**20:.1f}" if entry["peak_bytes"] is not None else "-"
+            self.perf_tree.insert("", "end", text=name, values=(
+                entry["calls"],
+                f"{entry['total'] * 1000:.1f}",
+                f"{entry['mean'] * 1000:.2f}",
+                f"{entry['max'] * 1000:.2f}",
+                peak,
+            ))
+
+        if reschedule:
+            self.perf_window.after(1000, self.refresh_performance_panel)
+
+    def export_profiling_trace(self):
+        """Export the recorded spans as Chrome-trace JSON"""
+        try:
+            file_path = filedialog.asksaveasfilename(
+                defaultextension=".json",
+                filetypes=[("Chrome Trace", "*.json")],
+                title="Export Chrome Trace"
+            )
+
+            if not file_path:
+                return
+
+            profiler.export_chrome_trace(file_path)
+            self.status_var.set(f"Trace exported to {os.path.basename(file_path)}")
+
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to export trace: {str(e)}")
+
+    @profiler.trace("view3d:visualize_3d")
     def visualize_3d(self):
         """Create a 3D visualization of the NIfTI data using VTK"""
         if self.image_data is None:
             messagebox.showinfo("No Data", "Please load a NIfTI image first.")
             return
     
+        # The scene persists while its window is open: just bring it up to date
+        if self.scene_3d is not None and not self.scene_3d.closed:
+            self.refresh_3d()
+            return
+    
         try:
             self.status_var.set("Creating 3D visualization...")
             self.root.update_idletasks()
         
-            # Create a copy of the data for processing
-            volume_data = self.image_data.copy()
-        
-            # Normalize data to 0-255 range
-            volume_min = np.min(volume_data)
-            volume_max = np.max(volume_data)
-            volume_data = ((volume_data - volume_min) / (volume_max - volume_min) * 255).astype(np.uint8)
-        
-            # Create a VTK image data
-            volume = vtk.vtkImageData()
-            volume.SetDimensions(self.width, self.height, self.depth)
-            volume.SetSpacing(1.0, 1.0, 1.0)
-            volume.SetOrigin(0.0, 0.0, 0.0)
-            volume.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
-        
-            # Fill the VTK image with data
-            vtk_data = numpy_to_vtk(volume_data.flatten(), deep=True, array_type=vtk.VTK_UNSIGNED_CHAR)
-            volume.GetPointData().GetScalars().DeepCopy(vtk_data)
-        
-            # Add overlay data if available (drawn regions)
-            if np.any(self.overlay_data > 0):
-                # Create a mask of the drawn regions
-                overlay_mask = (self.overlay_data > 0).astype(np.uint8) * 255
-                # Dilate slightly to make it more visible in 3D
-                kernel = np.ones((3, 3, 3), np.uint8)
-                overlay_mask = np.array([cv2.dilate(overlay_mask[:, :, i], kernel[:, :, 1], iterations=1) 
-                                        for i in range(overlay_mask.shape[2])]).transpose(1, 2, 0)
-            
-                # Blend overlay with volume data
-                r, g, b = self.draw_color
-                color_factor = 0.8  # Strength of coloring
-                for i in range(overlay_mask.shape[0]):
-                    for j in range(overlay_mask.shape[1]):
-                        for k in range(overlay_mask.shape[2]):
-                            if overlay_mask[i, j, k] > 0:
-                                # Blend color with original intensity
-                                orig_val = volume_data[i, j, k]
-                                volume_data[i, j, k] = int(orig_val * (1 - color_factor) + 
-                                                        (r + g + b) / 3 * color_factor)
-            
-                # Update volume data with overlay
-                vtk_data = numpy_to_vtk(volume_data.flatten(), deep=True, array_type=vtk.VTK_UNSIGNED_CHAR)
-                volume.GetPointData().GetScalars().DeepCopy(vtk_data)
-        
-            # Create a volume mapper and property
-            volume_mapper = vtk.vtkSmartVolumeMapper()
-            volume_mapper.SetInputData(volume)
-        
-            volume_property = vtk.vtkVolumeProperty()
-            volume_property.ShadeOn()
-            volume_property.SetInterpolationTypeToLinear()
-        
-            # Create and set transfer functions for CT-like appearance
-            color_function = vtk.vtkColorTransferFunction()
-            opacity_function = vtk.vtkPiecewiseFunction()
-        
-            # Setup color transfer function (CT-like grayscale)
-            color_function.AddRGBPoint(0, 0.0, 0.0, 0.0)      # Black for air/background
-            color_function.AddRGBPoint(50, 0.3, 0.3, 0.3)     # Dark gray for soft tissue
-            color_function.AddRGBPoint(150, 0.8, 0.8, 0.8)    # Light gray for bone
-            color_function.AddRGBPoint(255, 1.0, 1.0, 1.0)    # White for dense bone
-        
-            # Add color for overlay (if any drawn regions)
-            if np.any(self.overlay_data > 0):
-                # Add a color hint for the drawn regions
-                r, g, b = self.draw_color
-                color_function.AddRGBPoint(200, r/255, g/255, b/255)
-        
-            # Setup opacity transfer function
-            opacity_function.AddPoint(0, 0.0)     # Fully transparent for background
-            opacity_function.AddPoint(40, 0.0)    # Still transparent for air
-            opacity_function.AddPoint(80, 0.2)    # Slightly visible for soft tissue
-            opacity_function.AddPoint(150, 0.4)   # More opaque for bone
-            opacity_function.AddPoint(255, 0.8)   # Most opaque for dense bone
-        
-            # If there are drawn regions, make them more visible
-            if np.any(self.overlay_data > 0):
-                opacity_function.AddPoint(200, 0.9)  # Make drawn regions very visible
-        
-            # Set the color and opacity functions
-            volume_property.SetColor(color_function)
-            volume_property.SetScalarOpacity(opacity_function)
-        
-            # Set the gradient opacity for edge enhancement
-            gradient_opacity = vtk.vtkPiecewiseFunction()
-            gradient_opacity.AddPoint(0, 0.0)
-            gradient_opacity.AddPoint(90, 0.5)
-            gradient_opacity.AddPoint(255, 1.0)
-            volume_property.SetGradientOpacity(gradient_opacity)
-        
-            # Create the volume
-            actor_volume = vtk.vtkVolume()
-            actor_volume.SetMapper(volume_mapper)
-            actor_volume.SetProperty(volume_property)
-        
-            # Create a rendering window and renderer
-            renderer = vtk.vtkRenderer()
-            renderer.SetBackground(0.1, 0.1, 0.1)  # Dark background
-        
-            render_window = vtk.vtkRenderWindow()
-            render_window.AddRenderer(renderer)
-            render_window.SetSize(800, 600)
-            render_window.SetWindowName(f"3D Visualization: {os.path.basename(self.file_path)}")
-        
-            # Add the volume to the renderer
-            renderer.AddVolume(actor_volume)
-        
-            # Set up camera for a good initial view
-            camera = renderer.GetActiveCamera()
-            camera.SetPosition(0, -400, 0)
-            camera.SetFocalPoint(0, 0, 0)
-            camera.SetViewUp(0, 0, 1)
-            renderer.ResetCamera()
-        
-            # Create interaction
-            interactor = vtk.vtkRenderWindowInteractor()
-            interactor.SetRenderWindow(render_window)
-        
-            # Add orientation marker (axes)
-            axes = vtk.vtkAxesActor()
-            axes.SetTotalLength(50, 50, 50)
-            axes.SetXAxisLabelText("X")
-            axes.SetYAxisLabelText("Y")
-            axes.SetZAxisLabelText("Z")
-            axes.GetXAxisCaptionActor2D().GetTextActor().SetTextScaleModeToNone()
-            axes.GetYAxisCaptionActor2D().GetTextActor().SetTextScaleModeToNone()
-            axes.GetZAxisCaptionActor2D().GetTextActor().SetTextScaleModeToNone()
-        
-            axes_widget = vtk.vtkOrientationMarkerWidget()
-            axes_widget.SetOrientationMarker(axes)
-            axes_widget.SetInteractor(interactor)
-            axes_widget.SetViewport(0.0, 0.0, 0.2, 0.2)
-            axes_widget.SetEnabled(1)
-            axes_widget.InteractiveOff()
-        
-            # Setup interaction style
-            style = vtk.vtkInteractorStyleTrackballCamera()
-            interactor.SetInteractorStyle(style)
-        
-            # Add a text display for information
-            text_actor = vtk.vtkTextActor()
-            text_actor.SetInput(f"File: {os.path.basename(self.file_path)}\n"
-                                f"Dimensions: {self.width}x{self.height}x{self.depth}\n"
-                                f"Use mouse to rotate, Ctrl+mouse to pan, Scroll to zoom")
-            text_actor.GetTextProperty().SetFontSize(12)
-            text_actor.GetTextProperty().SetColor(1.0, 1.0, 1.0)
-            text_actor.SetPosition(10, 10)
-            renderer.AddActor2D(text_actor)
-        
-            # Initialize and start the interactor
-            interactor.Initialize()
-            render_window.Render()
-        
-            self.status_var.set("3D visualization ready")
-            interactor.Start()
+            # The child process renders straight from the shared buffer the viewer writes into
+            self.scene_3d = scene3d.SceneProcess(
+                "volume", self.image_data.shape,
+                title=f"3D Visualization: {os.path.basename(self.file_path)}",
+                info=(f"File: {os.path.basename(self.file_path)}\n"
+                      f"Dimensions: {self.width}x{self.height}x{self.depth}\n"
+                      f"Use mouse to rotate, Ctrl+mouse to pan, Scroll to zoom"),
+                spacing=self.voxel_spacing)
+            self.volume_3d_buffer = self.scene_3d.buffer
+            self.volume_3d_base = None
+            self.prepare_volume_3d(volume_changed=True)
+        
+            with profiler.span("view3d:launch"):
+                self.scene_3d.start(overlay_color=self.overlay_3d_color())
+        
+            self.status_var.set("3D visualization opened in a separate window")
+            self.start_pump_3d()
         
         except Exception as e:
+            self.close_3d()
             messagebox.showerror("Error", f"Failed to create 3D visualization: {str(e)}")
             self.status_var.set("Error creating 3D visualization")
 
+    def overlay_mask_3d(self, box=None):
+        """Drawn regions (of a box of the volume, all by default) slightly dilated so they are visible in 3D"""
+        # 3x3x3 box dilation as three separable 1D passes
+        if box is None:
+            return morphology.dilate(self.overlay_data > 0, 1)
+        # The box depends on the voxel around it too
+        shape = self.overlay_data.shape
+        source = tuple(slice(max(0, side.start - 1), min(n, side.stop + 1)) for side, n in zip(box, shape))
+        mask = morphology.dilate(self.overlay_data[source] > 0, 1)
+        return mask[tuple(slice(side.start - src.start, side.stop - src.start) for side, src in zip(box, source))]
+
+    def overlay_3d_color(self):
+        """Color hint for the transfer functions, None when nothing is drawn"""
+        return self.draw_color if self.overlay_3d_mask is not None and self.overlay_3d_count else None
+
+    def edited_box_3d(self, region):
+        """Box of the 3D overlay mask affected by an edit of overlay_data[region]: the region plus a 1-voxel halo"""
+        box = []
+        for axis, n in enumerate(self.overlay_data.shape):
+            index = region[axis] if axis < len(region) else slice(None)
+            if isinstance(index, slice):
+                start, stop, _ = index.indices(n)
+            else:
+                start, stop = int(index), int(index) + 1
+            box.append(slice(max(0, start - 1), min(n, stop + 1)))
+        return tuple(box)
+
+    def prepare_volume_3d(self, volume_changed=False, region=None):
+        """Bring the 3D buffer up to date, touching only what changed; return True if it was reallocated
+
+        region is the index tuple of overlay_data edited since the last call, None if the edit may be anywhere.
+        """
+        reallocated = False
+        shape = self.image_data.shape
+        if volume_changed or self.volume_3d_base is None or self.volume_3d_base.shape != shape:
+            with profiler.span("view3d:normalize"):
+                if self.volume_3d_buffer is None or self.volume_3d_buffer.shape != shape:
+                    # The scene process maps the buffer, so it has to hand out the new one
+                    reallocated = True
+                    if self.scene_3d is not None:
+                        self.volume_3d_buffer = self.scene_3d.resize(shape)
+                    else:
+                        self.volume_3d_buffer = np.empty(shape, dtype=np.uint8, order="F")
+                reuse = self.volume_3d_base is not None and self.volume_3d_base.shape == shape
+                self.volume_3d_base = vtk_volume.to_uint8(self.image_data, out=self.volume_3d_base if reuse else None)
+                self.volume_3d_buffer[...] = self.volume_3d_base
+                self.overlay_3d_mask = None
+        
+        with profiler.span("view3d:overlay"):
+            if self.overlay_3d_mask is None or region is None:
+                # Whole volume (the buffer holds no overlay when there is no previous mask)
+                box = (slice(0, shape[0]), slice(0, shape[1]), slice(0, shape[2]))
+                mask = self.overlay_mask_3d()
+                changed = mask if self.overlay_3d_mask is None else mask ^ self.overlay_3d_mask
+                self.overlay_3d_mask = mask
+                self.overlay_3d_count = int(np.count_nonzero(mask))
+            else:
+                # Only the edited region and the voxels its dilation reaches
+                box = self.edited_box_3d(region)
+                mask = self.overlay_mask_3d(box)
+                previous = self.overlay_3d_mask[box]
+                changed = mask ^ previous
+                self.overlay_3d_count += int(np.count_nonzero(mask)) - int(np.count_nonzero(previous))
+                previous[...] = mask
+            
+            # Only the bounding box of the voxels whose overlay state changed is re-blended
+            bounds = []
+            for axis in range(3):
+                hit = np.flatnonzero(changed.any(axis=tuple(a for a in range(3) if a != axis)))
+                if hit.size == 0:
+                    return reallocated
+                bounds.append(slice(box[axis].start + hit[0], box[axis].start + hit[-1] + 1))
+            bbox = tuple(bounds)
+            
+            self.volume_3d_buffer[bbox] = self.volume_3d_base[bbox]
+            vtk_volume.blend_overlay(self.volume_3d_buffer[bbox], self.overlay_3d_mask[bbox],
+                                     self.draw_color, color_factor=0.8)
+        return reallocated
+
+    def refresh_3d(self, volume_changed=False, region=None):
+        """Propagate image or annotation changes (to overlay_data[region] if given) to the open 3D scene"""
+        if self.scene_3d is None or self.scene_3d.closed or self.image_data is None:
+            return
+        with profiler.span("view3d:refresh"):
+            self.prepare_volume_3d(volume_changed, region)
+            self.scene_3d.set_overlay_color(self.overlay_3d_color())
+            self.scene_3d.modified()
+
+    def close_3d(self):
+        """Close the 3D scene and release its buffers (e.g. when another volume is loaded)"""
+        # Drop the views of the shared memory first so the block can be closed
+        self.volume_3d_base = self.volume_3d_buffer = self.overlay_3d_mask = None
+        if self.scene_3d is not None:
+            self.scene_3d.close()
+        self.scene_3d = None
+
+    def close_all_3d(self):
+        """Close every 3D window (volume and segmentations)"""
+        self.close_3d()
+        for scene in self.segmentation_scenes:
+            scene.close()
+        self.segmentation_scenes = []
+
+    def start_pump_3d(self):
+        if not self.pump_3d_active:
+            self.pump_3d_active = True
+            self.root.after(50, self.pump_3d)
+
+    def pump_3d(self):
+        """Watch the 3D processes and forget the ones whose window was closed"""
+        if self.scene_3d is not None and not self.scene_3d.poll():
+            self.scene_3d = None
+            self.volume_3d_base = self.volume_3d_buffer = self.overlay_3d_mask = None
+        self.segmentation_scenes = [scene for scene in self.segmentation_scenes if scene.poll()]
+        
+        if self.scene_3d is None and not self.segmentation_scenes:
+            self.pump_3d_active = False
+            return
+        self.root.after(50, self.pump_3d)
+
 #Segmentación y preprocesamiento 
 
     def show_segmentation_options(self, algorithm):
@@ -808,6 +1608,11 @@ class NiftiViewer:
     def enable_seed_selection(self):
         """Habilita la selección de punto semilla para el crecimiento de regiones"""
         self.seg_window.withdraw()  # Oculta la ventana de opciones temporalmente
+        # La semilla se elige sobre la vista única, sin reformateo oblicuo
+        if self.triplanar_active:
+            self.set_triplanar(False)
+        if self.oblique_active:
+            self.set_oblique(False)
         self.status_var.set("Haga clic para seleccionar un punto semilla...")
         self.root.update_idletasks()
 
@@ -823,26 +1628,8 @@ class NiftiViewer:
         # Convertir coordenadas del canvas a coordenadas del volumen
         canvas_x, canvas_y = event.x, event.y
     
-        # Obtener dimensiones de la visualización actual
-        if self.corte_actual == "Axial":
-            slice_width, slice_height = self.width, self.height
-        elif self.corte_actual == "Sagittal":
-            slice_width, slice_height = self.depth, self.height
-        else:  # Coronal
-            slice_width, slice_height = self.width, self.depth
-    
-        # Convertir a coordenadas de la imagen
-        display_width, display_height = 512, 512  # Dimensiones tras el resize
-        slice_x = int(canvas_x * slice_width / display_width)
-        slice_y = int(canvas_y * slice_height / display_height)
-    
-        # Convertir a coordenadas 3D
-        if self.corte_actual == "Axial":
-            x_3d, y_3d, z_3d = slice_x, slice_y, self.indice_corte
-        elif self.corte_actual == "Sagittal":
-            x_3d, y_3d, z_3d = self.indice_corte, slice_y, slice_x
-        else:  # Coronal
-            x_3d, y_3d, z_3d = slice_x, self.indice_corte, slice_y
+        # Convertir a coordenadas 3D (misma correspondencia que el dibujo)
+        x_3d, y_3d, z_3d = self.canvas_to_voxel(canvas_x, canvas_y)
     
         self.seed_point = (x_3d, y_3d, z_3d)
         # Mostrar marcador
@@ -859,15 +1646,7 @@ class NiftiViewer:
     
     def draw_seed_marker(self, x, y, z):
         """Dibuja un marcador en la posición seleccionada"""
-        if self.corte_actual == "Axial":
-            display_x = int(x * 512 / self.width)
-            display_y = int(y * 512 / self.height)
-        elif self.corte_actual == "Sagittal":
-            display_x = int(z * 512 / self.depth)
-            display_y = int(y * 512 / self.height)
-        else:  # Coronal
-            display_x = int(x * 512 / self.width)
-            display_y = int(z * 512 / self.depth)
+        display_x, display_y = self.voxel_to_canvas(x, y, z)
 
         # Dibujar un pequeño círculo rojo
         marker_id = self.canvas.create_oval(
@@ -890,8 +1669,8 @@ class NiftiViewer:
             self.root.update_idletasks()
         
             # Crear una copia de los datos para no modificar los originales
-            segmentation_result = np.zeros_like(self.image_data)
-        
+            segmentation_result = np.zeros(self.image_data.shape, dtype=np.uint8)
+
             # Ejecutar el algoritmo apropiado
             if algorithm == "Umbralización":
                 min_val = np.min(self.image_data)
@@ -912,7 +1691,8 @@ class NiftiViewer:
                 segmentation_result = self.kmeans_segmentation(self.k_var.get(), self.max_iter_var.get())
         
             # Mostrar resultado
-            self.show_segmentation_result(segmentation_result, algorithm)
+            with profiler.span("job:result_window"):
+                self.show_segmentation_result(segmentation_result, algorithm)
         
         except Exception as e:
             messagebox.showerror("Error", f"Error al ejecutar la segmentación: {str(e)}")
@@ -921,13 +1701,15 @@ class NiftiViewer:
         # Cerrar ventana de opciones
         self.seg_window.destroy()
 
+    @profiler.trace("segment:threshold")
     def threshold_segmentation(self, min_threshold, max_threshold):
         """Implementación segmentación por umbralización"""
-        result = np.zeros_like(self.image_data)
-        mask = (self.image_data >= min_threshold) & (self.image_data <= max_threshold)
-        result[mask] = 1
-        return result
+        # La máscara se empaqueta por losas: nunca existe el volumen booleano completo
+        data = self.image_data
+        return bitmask.PackedMask.from_slabs(
+            data.shape, lambda region: (data[region] >= min_threshold) & (data[region] <= max_threshold))
 
+    @profiler.trace("segment:region_growing")
     def region_growing(self, seed_point, tolerance):
         """Implementa segmentación por crecimiento de regiones"""
         # Obtener coordenadas del punto semilla
@@ -942,7 +1724,7 @@ class NiftiViewer:
         tolerance_range = tolerance * (max_val - min_val)
     
         # Crear máscara para el resultado
-        result = np.zeros_like(self.image_data)
+        result = np.zeros(self.image_data.shape, dtype=np.uint8)
     
         # Crear array para controlar los puntos visitados
         processed = np.zeros_like(self.image_data, dtype=bool)
@@ -987,8 +1769,9 @@ class NiftiViewer:
                         not processed[new_x, new_y, new_z]):
                         points_queue.append((new_x, new_y, new_z))
     
-        return result
+        return bitmask.PackedMask.from_array(result)
 
+    @profiler.trace("segment:kmeans")
     def kmeans_segmentation(self, k, max_iterations=100):
         """Implementa segmentación por K-Means"""
         # Aplanar y normalizar datos
@@ -999,19 +1782,21 @@ class NiftiViewer:
     
         # Inicializar centroides aleatoriamente
         np.random.seed(42)
-        centroids = np.random.rand(k)
+        centroids = np.random.rand(k).astype(normalized_data.dtype)
 
         for _ in range(max_iterations):
             old_centroids = centroids.copy()
         
             # Asignar cada punto al centroide más cercano
-            distances = np.abs(normalized_data[:, np.newaxis] - centroids[np.newaxis, :])
-            labels = np.argmin(distances, axis=1)
+            with profiler.span("stage:kmeans_assign"):
+                distances = np.abs(normalized_data[:, np.newaxis] - centroids[np.newaxis, :])
+                labels = np.argmin(distances, axis=1)
         
             # Actualizar centroides
-            for j in range(k):
-                if np.any(labels == j):
-                    centroids[j] = normalized_data[labels == j].mean()
+            with profiler.span("stage:kmeans_update"):
+                for j in range(k):
+                    if np.any(labels == j):
+                        centroids[j] = normalized_data[labels == j].mean()
         
             # Criterio de convergencia
             if np.allclose(centroids, old_centroids, atol=1e-4):
@@ -1036,6 +1821,10 @@ class NiftiViewer:
     
         # Variables para la ventana de resultados
         self.result_data = result
+        # Colores por etiqueta calculados una vez con todas las etiquetas del volumen
+        # (una máscara empaquetada solo tiene la etiqueta 1)
+        labels = np.arange(2) if isinstance(result, bitmask.PackedMask) else result
+        self.result_lut = compositing.label_lut(labels)
         self.result_slice_type = "Axial"
         self.result_slice_index = self.depth // 2 if self.result_slice_type == "Axial" else (
             self.width // 2 if self.result_slice_type == "Sagittal" else self.height // 2)
@@ -1052,7 +1841,13 @@ class NiftiViewer:
         ttk.Button(control_frame, text="Coronal", 
                 command=lambda: self.change_result_view("Coronal", result_window)).pack(side="left", padx=5)
         ttk.Button(control_frame, text="3D View", 
-                command=lambda: self.visualize_segmentation_3d(result)).pack(side="left", padx=5)
+                command=lambda: self.visualize_segmentation_3d(self.result_data)).pack(side="left", padx=5)
+    
+        # Opciones de las superficies 3D
+        self.smooth_3d_var = tk.BooleanVar(value=False)
+        self.decimate_3d_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(control_frame, text="Suavizar", variable=self.smooth_3d_var).pack(side="left", padx=5)
+        ttk.Checkbutton(control_frame, text="Simplificar malla", variable=self.decimate_3d_var).pack(side="left", padx=5)
     
         # Slider para navegación
         slice_frame = ttk.Frame(result_window)
@@ -1072,14 +1867,52 @@ class NiftiViewer:
         self.result_canvas = tk.Canvas(canvas_frame)
         self.result_canvas.pack(fill="both", expand=True)
     
+        # Filtrado por componentes conexas 3D
+        components_frame = ttk.LabelFrame(result_window, text="Componentes conexas")
+        components_frame.pack(fill="x", padx=10, pady=5)
+    
+        ttk.Label(components_frame, text="Conectividad:").pack(side="left", padx=5)
+        self.connectivity_var = tk.IntVar(value=26)
+        ttk.Combobox(components_frame, textvariable=self.connectivity_var, values=components.CONNECTIVITY,
+                     width=4, state="readonly").pack(side="left", padx=5)
+        ttk.Button(components_frame, text="Mantener la mayor",
+                command=lambda: self.filter_components("largest", result_window)).pack(side="left", padx=5)
+        self.min_component_var = tk.IntVar(value=100)
+        ttk.Button(components_frame, text="Eliminar menores de",
+                command=lambda: self.filter_components("small", result_window)).pack(side="left", padx=5)
+        ttk.Spinbox(components_frame, from_=1, to=10 ** 7, textvariable=self.min_component_var,
+                    width=8).pack(side="left", padx=5)
+        ttk.Label(components_frame, text="vóxeles").pack(side="left")
+        self.components_info_var = tk.StringVar(value="")
+        ttk.Label(components_frame, textvariable=self.components_info_var).pack(side="left", padx=10)
+    
+        # Postprocesado morfológico 3D
+        morphology_frame = ttk.LabelFrame(result_window, text="Morfología 3D")
+        morphology_frame.pack(fill="x", padx=10, pady=5)
+    
+        self.morphology_op_var = tk.StringVar(value="Apertura")
+        ttk.Combobox(morphology_frame, textvariable=self.morphology_op_var, values=list(MORPHOLOGY_OPERATIONS),
+                     width=10, state="readonly").pack(side="left", padx=5)
+        ttk.Label(morphology_frame, text="Elemento:").pack(side="left", padx=5)
+        self.morphology_structure_var = tk.StringVar(value="Caja")
+        ttk.Combobox(morphology_frame, textvariable=self.morphology_structure_var,
+                     values=list(MORPHOLOGY_STRUCTURES), width=6, state="readonly").pack(side="left", padx=5)
+        ttk.Label(morphology_frame, text="Radio:").pack(side="left", padx=5)
+        self.morphology_radius_var = tk.IntVar(value=1)
+        ttk.Spinbox(morphology_frame, from_=1, to=50, textvariable=self.morphology_radius_var,
+                    width=4).pack(side="left", padx=5)
+        ttk.Button(morphology_frame, text="Aplicar",
+                command=lambda: self.apply_morphology(result_window)).pack(side="left", padx=5)
+    
         # Botones adicionales
         btn_frame = ttk.Frame(result_window)
         btn_frame.pack(fill="x", padx=10, pady=5)
     
+        # Las acciones usan el resultado vigente (puede haberse filtrado por componentes)
         ttk.Button(btn_frame, text="Aplicar como marcado", 
-                command=lambda: self.apply_segmentation_as_overlay(result)).pack(side="left", padx=5)
+                command=lambda: self.apply_segmentation_as_overlay(self.result_data)).pack(side="left", padx=5)
         ttk.Button(btn_frame, text="Exportar a NIfTI", 
-                command=lambda: self.export_segmentation(result)).pack(side="left", padx=5)
+                command=lambda: self.export_segmentation(self.result_data)).pack(side="left", padx=5)
         ttk.Button(btn_frame, text="Cerrar", 
                 command=result_window.destroy).pack(side="right", padx=5)
     
@@ -1089,6 +1922,50 @@ class NiftiViewer:
         # Mostrar la primera imagen
         self.update_result_slice(self.result_slice_index, result_window)
 
+    @profiler.trace("segment:components")
+    def filter_components(self, mode, window):
+        """Conserva solo la mayor componente conexa del resultado o elimina las menores de N vóxeles"""
+        try:
+            self.status_var.set("Etiquetando componentes conexas...")
+            self.root.update_idletasks()
+            connectivity = int(self.connectivity_var.get())
+            
+            if mode == "largest":
+                filtered, found = components.keep_largest(self.result_data, connectivity)
+                kept = min(1, len(found))
+            else:
+                min_size = int(self.min_component_var.get())
+                filtered, found = components.remove_small(self.result_data, min_size, connectivity)
+                kept = int(np.count_nonzero(found.sizes >= min_size))
+            
+            self.result_data = filtered
+            self.components_info_var.set(f"{kept} de {len(found)} componentes conservadas")
+            self.status_var.set(f"Filtrado por componentes ({connectivity}-conectividad) aplicado")
+            self.update_result_slice(self.result_slice_index, window)
+        
+        except Exception as e:
+            messagebox.showerror("Error", f"Error al filtrar componentes: {str(e)}")
+            self.status_var.set("Error en el filtrado de componentes")
+
+    @profiler.trace("segment:morphology")
+    def apply_morphology(self, window):
+        """Aplica erosión, dilatación, apertura o cierre 3D al resultado de la segmentación"""
+        try:
+            operation = MORPHOLOGY_OPERATIONS[self.morphology_op_var.get()]
+            structure = MORPHOLOGY_STRUCTURES[self.morphology_structure_var.get()]
+            radius = int(self.morphology_radius_var.get())
+            self.status_var.set(f"Aplicando {self.morphology_op_var.get().lower()} 3D...")
+            self.root.update_idletasks()
+            
+            # Cada etiqueta se procesa por separado y conserva su valor
+            self.result_data = morphology.morphology_labels(self.result_data, operation, radius, structure)
+            self.status_var.set(f"{self.morphology_op_var.get()} 3D aplicada (radio {radius})")
+            self.update_result_slice(self.result_slice_index, window)
+        
+        except Exception as e:
+            messagebox.showerror("Error", f"Error en el postprocesado morfológico: {str(e)}")
+            self.status_var.set("Error en el postprocesado morfológico")
+
     def change_result_view(self, view_type, window):
         """Cambia la orientación de visualización del resultado"""
         self.result_slice_type = view_type
@@ -1144,44 +2021,13 @@ class NiftiViewer:
         norm_original = self.normalize_image(original_slice)
         color_original = self.apply_colormap(norm_original)
     
-        # Crear overlay coloreado para la segmentación
-        unique_labels = np.unique(slice_data)
-        num_labels = len(unique_labels)
-    
-        # Crear mapa de colores para la segmentación
-        colormap = {}
-        for i, label in enumerate(unique_labels):
-            if label == 0:  # Fondo es transparente
-                colormap[label] = (0, 0, 0, 0)
-            else:
-                # Crear colores distintos para cada etiqueta
-                hue = (i-1) / max(1, num_labels-1) * 180  # Valores HSV de 0 a 180 para OpenCV
-                sat = 255
-                val = 255
-                bgr = cv2.cvtColor(np.uint8([[[hue, sat, val]]]), cv2.COLOR_HSV2BGR)[0][0]
-                colormap[label] = (*bgr, 150)  # BGR + alpha
-    
-        # Crear imagen de overlay
-        overlay = np.zeros((*slice_data.shape, 4), dtype=np.uint8)
-        for label, color in colormap.items():
-            mask = (slice_data == label)
-            for c in range(3):  # RGB channels
-                overlay[..., c][mask] = color[c]
-            overlay[..., 3][mask] = color[3]  # Alpha channel
-    
-        # Resize ambas imágenes
+        # Resize de la imagen y de las etiquetas (vecino más cercano para no mezclar etiquetas)
         display_size = (512, 512)
-        color_original_resized = cv2.resize(color_original, display_size)
-        overlay_resized = cv2.resize(overlay, display_size)
-    
-        # Mezclar original con overlay
-        result_img = color_original_resized.copy()
-        for y in range(display_size[1]):
-            for x in range(display_size[0]):
-                if overlay_resized[y, x, 3] > 0:  # Si hay algo en el overlay (alpha > 0)
-                    alpha = overlay_resized[y, x, 3] / 255.0
-                    for c in range(3):
-                        result_img[y, x, c] = int(result_img[y, x, c] * (1 - alpha) + overlay_resized[y, x, c] * alpha)
+        result_img = cv2.resize(color_original, display_size)
+        labels_resized = compositing.resize_labels(np.ascontiguousarray(slice_data), display_size)
+    
+        # Mezclar original con el color de cada etiqueta (LUT + alpha en una sola operación)
+        compositing.blend_labels(result_img, labels_resized, self.result_lut)
     
         # Mostrar en el canvas
         img_pil = Image.fromarray(cv2.cvtColor(result_img, cv2.COLOR_BGR2RGB))
@@ -1197,143 +2043,110 @@ class NiftiViewer:
         """Aplica el resultado de la segmentación como una capa de dibujo"""
         if messagebox.askyesno("Aplicar Segmentación", 
                             "¿Desea aplicar la segmentación como marcado en la imagen original?"):
-            # Identificar voxels segmentados
-            segmented_indices = np.where(segmentation > 0)
-        
-            # Convertir a puntos de dibujo
-            for i in range(len(segmented_indices[0])):
-                x, y, z = segmented_indices[0][i], segmented_indices[1][i], segmented_indices[2][i]
-            
-                # Crear un punto con el color actual
-                self.overlay_data[x, y, z] = 1
-                self.draw_points.append({
-                    'x': int(x),
-                    'y': int(y),
-                    'z': int(z),
-                    'color': self.draw_color
-                })
+            # Marcar los voxels segmentados con el color actual (deshacible), sobre el marcado ya cargado
+            self.finish_annotations()
+            index = self.palette_index(self.draw_color)
+            # Por losas, para no desempaquetar nunca una máscara completa ni copiar el marcado entero:
+            # cada losa aporta al historial solo sus voxels cambiados (índices planos en orden C)
+            plane = int(np.prod(self.overlay_data.shape[1:]))
+            indices, old, new = [], [], []
+            for region in bitmask.slab_regions(segmentation.shape):
+                slab = self.overlay_data[region]
+                changed = (np.asarray(segmentation[region]) > 0) & (slab != index)
+                if changed.any():
+                    indices.append(np.flatnonzero(changed) + region[0].start * plane)
+                    old.append(slab[changed])
+                    new.append(np.full(len(old[-1]), index, dtype=np.uint8))
+                    slab[changed] = index
+            if indices:
+                delta = history.AnnotationDelta((), np.concatenate(indices), np.concatenate(old), np.concatenate(new))
+                self.history.push(history.HistoryEntry("Segmentation overlay", delta))
         
             # Actualizar visualización
             self.update_slice()
+            self.refresh_3d()
             self.status_var.set("Segmentación aplicada como marcado")
 
     def export_segmentation(self, segmentation):
         """Exporta el resultado de la segmentación como archivo NIfTI"""
         try:
-            file_path = filedialog.asksaveasfilename(
-                defaultextension=".nii.gz",
-                filetypes=[("NIfTI Files", "*.nii *.nii.gz")],
-                title="Guardar Segmentación como NIfTI"
-            )
-        
+            file_path = self.ask_export_path("Guardar Segmentación como NIfTI")
             if not file_path:
                 return
             
-            # Crear un nuevo objeto NIfTI con los datos de segmentación
-            segmentation_nii = nib.Nifti1Image(segmentation.astype(np.int16), self.nii_image.affine)
-        
-            # Guardar el archivo
-            nib.save(segmentation_nii, file_path)
-        
-            self.status_var.set(f"Segmentación guardada en {os.path.basename(file_path)}")
+            # Las etiquetas se guardan como uint8 (o el menor entero que las contenga)
+            self.start_export(segmentation, file_path, "Segmentación guardada en", "Error al exportar segmentación")
         
         except Exception as e:
             messagebox.showerror("Error", f"Error al exportar segmentación: {str(e)}")
+    
+    def ask_export_path(self, title):
+        """Pide el archivo de destino, con la extensión que corresponde a la compresión elegida"""
+        return filedialog.asksaveasfilename(
+            defaultextension=".nii.gz" if self.export_level_var.get() else ".nii",
+            filetypes=[("NIfTI Files", "*.nii *.nii.gz")],
+            title=title
+        )
+    
+    def start_export(self, data, file_path, done_message, error_message):
+        """Escribe un volumen como NIfTI en segundo plano, con el tipo de dato más pequeño que lo conserva"""
+        affine = self.nii_image.affine if self.nii_image is not None else np.eye(4)
+        header = self.nii_image.header if self.nii_image is not None else None
+        job = nifti_export.ExportJob(
+            file_path, data, affine, header=header,
+            level=self.export_level_var.get(), quantize=self.export_quantize_var.get())
+        self.export_jobs.append((job.start(), done_message, error_message))
+        self.status_var.set(f"Guardando {os.path.basename(file_path)}...")
+        if len(self.export_jobs) == 1:
+            self.root.after(100, self.pump_exports)
+    
+    def pump_exports(self):
+        """Informa del progreso de las exportaciones y de su resultado al terminar"""
+        pending = []
+        for job, done_message, error_message in self.export_jobs:
+            name = os.path.basename(job.path)
+            if not job.done:
+                pending.append((job, done_message, error_message))
+                self.status_var.set(f"Guardando {name}... {job.progress:.0%}")
+            elif job.error is not None:
+                messagebox.showerror("Error", f"{error_message}: {str(job.error)}")
+            else:
+                dtype, slope, _ = job.result
+                scaling = " con scl_slope" if slope != 1.0 else ""
+                self.status_var.set(f"{done_message} {name} ({dtype.name}{scaling})")
+        self.export_jobs = pending
+        if pending:
+            self.root.after(100, self.pump_exports)
 
     def visualize_segmentation_3d(self, segmentation):
         """Crea una visualización 3D del resultado de la segmentación"""
         try:
             self.status_var.set("Creando visualización 3D de la segmentación...")
         
-            # Crear un nuevo volumen para VTK
-            volume = vtk.vtkImageData()
-            volume.SetDimensions(self.width, self.height, self.depth)
-            volume.SetSpacing(1.0, 1.0, 1.0)
-            volume.SetOrigin(0.0, 0.0, 0.0)
-            volume.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
-        
-            # Convertir datos de segmentación a formato VTK
-            segmentation_data = segmentation.flatten().astype(np.uint8)
-            vtk_data = numpy_to_vtk(segmentation_data, deep=True, array_type=vtk.VTK_UNSIGNED_CHAR)
-            volume.GetPointData().GetScalars().DeepCopy(vtk_data)
-        
-            # Crear un mapeador de contorno para mostrar las superficies de segmentación
-            contour = vtk.vtkMarchingCubes()
-            contour.SetInputData(volume)
-        
-            # Encontrar todos los valores únicos de etiquetas (excluyendo 0 que es el fondo)
-            unique_labels = np.unique(segmentation)
-            unique_labels = unique_labels[unique_labels > 0]
-        
-            if len(unique_labels) == 0:
+            # Comprobar que haya etiquetas (excluyendo 0 que es el fondo)
+            if not segmentation.any():
                 messagebox.showinfo("Sin datos", "No hay regiones segmentadas para visualizar en 3D.")
                 return
         
-            # Extraer un contorno por cada etiqueta
-            for i, label in enumerate(unique_labels):
-                contour.SetValue(i, label)
-        
-            # Crear mapeador de superficie
-            mapper = vtk.vtkPolyDataMapper()
-            mapper.SetInputConnection(contour.GetOutputPort())
-            mapper.ScalarVisibilityOn()
-        
-            # Crear mapa de colores
-            lut = vtk.vtkLookupTable()
-            lut.SetNumberOfTableValues(len(unique_labels) + 1)
-            lut.SetTableRange(0, len(unique_labels))
-            lut.Build()
-        
-            # Configurar colores para cada etiqueta
-            for i, label in enumerate(unique_labels):
-                # Usar HSV para generar colores distintos
-                hue = float(i) / len(unique_labels)
-                lut.SetTableValue(i, *[*colorsys.hsv_to_rgb(hue, 1.0, 1.0), 1.0])
-        
-            mapper.SetLookupTable(lut)
-        
-            # Crear actor
-            actor = vtk.vtkActor()
-            actor.SetMapper(mapper)
-        
-            # Configurar propiedades
-            actor.GetProperty().SetOpacity(0.7)
-            actor.GetProperty().SetSpecular(0.3)
-            # Configuración de la escena
-            renderer = vtk.vtkRenderer()
-            renderer.AddActor(actor)
-            renderer.SetBackground(0.2, 0.2, 0.2)  # Fondo gris oscuro
-        
-            # Configurar la ventana de renderizado
-            render_window = vtk.vtkRenderWindow()
-            render_window.AddRenderer(renderer)
-            render_window.SetSize(800, 600)
-            render_window.SetWindowName("Visualización 3D de Segmentación")
-        
-            # Configurar interactor
-            interactor = vtk.vtkRenderWindowInteractor()
-            interactor.SetRenderWindow(render_window)
-        
-            # Configurar estilo de interacción
-            style = vtk.vtkInteractorStyleTrackballCamera()
-            interactor.SetInteractorStyle(style)
-        
-            # Inicializar y ajustar cámara
-            renderer.ResetCamera()
-            camera = renderer.GetActiveCamera()
-            camera.Elevation(30)
-            camera.Azimuth(30)
-            camera.Zoom(1.2)
-        
-            # Iniciar visualización
-            interactor.Initialize()
-            render_window.Render()
+            # Suavizado y simplificación opcionales de las mallas
+            smooth = hasattr(self, 'smooth_3d_var') and self.smooth_3d_var.get()
+            decimate = hasattr(self, 'decimate_3d_var') and self.decimate_3d_var.get()
+        
+            # Las etiquetas se comparten con el proceso de VTK por memoria compartida
+            scene = scene3d.SceneProcess(
+                "segmentation", segmentation.shape,
+                title="Visualización 3D de Segmentación",
+                smoothing_iterations=surfaces.DEFAULT_SMOOTHING_ITERATIONS if smooth else 0,
+                decimation=surfaces.DEFAULT_DECIMATION if decimate else 0.0,
+                spacing=self.voxel_spacing)
+            for region in bitmask.slab_regions(segmentation.shape):
+                scene.buffer[region] = segmentation[region]
+            scene.start()
+            self.segmentation_scenes.append(scene)
+            self.start_pump_3d()
         
             # Mostrar mensaje de estado
-            self.status_var.set("Visualización 3D generada. Cierre la ventana 3D para continuar.")
-        
-            # Iniciar el bucle de eventos
-            interactor.Start()
+            self.status_var.set("Visualización 3D abierta en una ventana independiente.")
         
         except Exception as e:
             messagebox.showerror("Error", f"Error al ejecutar la Visualización 3D: {str(e)}")
@@ -1345,7 +2158,7 @@ class NiftiViewer:
         """Muestra opciones de configuración para el filtro seleccionado"""
         self.prep_window = tk.Toplevel(self.root)
         self.prep_window.title(f"Opciones de Filtro {filter_type}")
-        self.prep_window.geometry("400x300")
+        self.prep_window.geometry("420x640")
         self.prep_window.transient(self.root)
         self.prep_window.grab_set()
     
@@ -1447,11 +2260,35 @@ class NiftiViewer:
                     width=5).grid(row=1, column=1, sticky="w", pady=5)
         
 
+        # Vista previa sobre el corte actual o sobre el volumen reducido
+        preview_frame = ttk.LabelFrame(frame, text="Vista previa")
+        preview_frame.grid(row=5, column=0, columnspan=3, sticky="ew", pady=5)
+    
+        self.preview_mode_var = tk.StringVar(value="Corte actual")
+        ttk.Combobox(preview_frame, textvariable=self.preview_mode_var, state="readonly", width=12,
+                    values=["Corte actual", "Reducido 2×", "Reducido 4×"]).grid(row=0, column=0, padx=5, pady=5)
+        self.preview_auto_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(preview_frame, text="Automática", 
+                    variable=self.preview_auto_var).grid(row=0, column=1, padx=5, pady=5)
+        ttk.Button(preview_frame, text="Vista previa", 
+                command=lambda: self.run_preview(filter_type)).grid(row=0, column=2, padx=5, pady=5)
+    
+        self.preview_canvas = tk.Canvas(preview_frame, width=256, height=256, bg="black")
+        self.preview_canvas.grid(row=1, column=0, columnspan=3, pady=5)
+        self.preview_info_var = tk.StringVar(value="Sin vista previa")
+        ttk.Label(preview_frame, textvariable=self.preview_info_var).grid(row=2, column=0, columnspan=3)
+    
+        # Actualizar la vista previa al mover los controles
+        self.preview_job = None
+        self.preview_cache = {}  # Volumen reducido por factor: (volumen de origen, volumen reducido)
+        for var in self.preprocessing_vars(filter_type) + [self.preview_mode_var]:
+            var.trace_add("write", lambda *args: self.schedule_preview(filter_type))
+    
         # Botones comunes
         button_frame = ttk.Frame(frame)
         button_frame.grid(row=10, column=0, columnspan=3, pady=20)
     
-        ttk.Button(button_frame, text="Aplicar", 
+        ttk.Button(button_frame, text="Ejecutar", 
                 command=lambda: self.run_preprocessing(filter_type)).pack(side="left", padx=10)
         ttk.Button(button_frame, text="Cancelar", 
                 command=self.prep_window.destroy).pack(side="left", padx=10)
@@ -1470,53 +2307,12 @@ class NiftiViewer:
             self.root.update_idletasks()
         
             # Crear una copia de los datos para no modificar los originales
-            preprocessed_data = self.image_data.copy()
-        
-            # Aplicar el filtro apropiado
-            if filter_type == "Media":
-                preprocessed_data = self.mean_filter(preprocessed_data, self.kernel_size_var.get())
-            elif filter_type == "Mediana":
-                preprocessed_data = self.median_filter(preprocessed_data, self.kernel_size_var.get())
-            elif filter_type == "Bilateral":
-                preprocessed_data = self.bilateral_filter(
-                    preprocessed_data, 
-                    self.window_size_var.get(),
-                    self.sigma_space_var.get(),
-                    self.sigma_range_var.get()
-                )
-            elif filter_type == "Anisotropico":
-                preprocessed_data = self.anisotropic_diffusion(
-                    preprocessed_data,
-                    self.iterations_var.get(),
-                    self.kappa_var.get(),
-                    self.lambda_var.get()
-                )
-            
-            elif filter_type == "Bordes":
-                low_threshold = self.edge_low_var.get()
-                high_threshold = self.edge_high_var.get()
-                kernel_size = self.edge_kernel_var.get()
-                preprocessed_data = self.edge_detection(low_threshold, high_threshold, kernel_size)
-        
-            elif filter_type == "NLM":
-                patch_size = self.nlm_patch_size_var.get()
-                search_radius = self.nlm_search_var.get()
-                h_param = self.nlm_h_var.get()
-                preprocessed_data = self.non_local_means(patch_size, search_radius, h_param)
-            
-            elif filter_type == "Roberts":
-                threshold = self.roberts_threshold_var.get()
-                preprocessed_data = self.roberts_edge_detection(preprocessed_data, threshold)
-            
-            elif filter_type == "LoG":
-                sigma = self.log_sigma_var.get()
-                kernel_size = self.log_kernel_size_var.get()
-                if kernel_size % 2 == 0:
-                    kernel_size += 1
-                preprocessed_data=self.laplacian_of_gaussian(preprocessed_data, sigma, kernel_size)
+            with profiler.span("job:preprocessing", filter=filter_type):
+                preprocessed_data = self.compute_filter(filter_type, self.image_data.copy())
             
             # Mostrar resultado
-            self.show_preprocessing_result(preprocessed_data, filter_type)
+            with profiler.span("job:result_window"):
+                self.show_preprocessing_result(preprocessed_data, filter_type)
         
         except Exception as e:
             messagebox.showerror("Error", f"Error al aplicar el filtro: {str(e)}")
@@ -1525,18 +2321,187 @@ class NiftiViewer:
         # Cerrar ventana de opciones
         self.prep_window.destroy()
 
+    def compute_filter(self, filter_type, data):
+        """Aplica el filtro seleccionado a un volumen con los parámetros de la ventana de opciones"""
+        if filter_type == "Media":
+            return self.mean_filter(data, self.kernel_size_var.get())
+        elif filter_type == "Mediana":
+            return self.median_filter(data, self.kernel_size_var.get())
+        elif filter_type == "Bilateral":
+            return self.bilateral_filter(
+                data, 
+                self.window_size_var.get(),
+                self.sigma_space_var.get(),
+                self.sigma_range_var.get()
+            )
+        elif filter_type == "Anisotropico":
+            return self.anisotropic_diffusion(
+                data,
+                self.iterations_var.get(),
+                self.kappa_var.get(),
+                self.lambda_var.get()
+            )
+        elif filter_type == "Bordes":
+            low_threshold = self.edge_low_var.get()
+            high_threshold = self.edge_high_var.get()
+            kernel_size = self.edge_kernel_var.get()
+            return self.edge_detection(low_threshold, high_threshold, kernel_size, data)
+        elif filter_type == "NLM":
+            patch_size = self.nlm_patch_size_var.get()
+            search_radius = self.nlm_search_var.get()
+            h_param = self.nlm_h_var.get()
+            return self.non_local_means(patch_size, search_radius, h_param, data)
+        elif filter_type == "Roberts":
+            threshold = self.roberts_threshold_var.get()
+            return self.roberts_edge_detection(data, threshold)
+        elif filter_type == "LoG":
+            sigma = self.log_sigma_var.get()
+            kernel_size = self.log_kernel_size_var.get()
+            if kernel_size % 2 == 0:
+                kernel_size += 1
+            return self.laplacian_of_gaussian(data, sigma, kernel_size)
+        return data
+
+    def preprocessing_vars(self, filter_type):
+        """Devuelve las variables de Tk que controlan los parámetros de un filtro"""
+        names = {
+            "Media": ["kernel_size_var"],
+            "Mediana": ["kernel_size_var"],
+            "Bilateral": ["window_size_var", "sigma_space_var", "sigma_range_var"],
+            "Anisotropico": ["iterations_var", "kappa_var", "lambda_var"],
+            "Bordes": ["edge_low_var", "edge_high_var", "edge_kernel_var"],
+            "NLM": ["nlm_patch_size_var", "nlm_search_var", "nlm_h_var"],
+            "Roberts": ["roberts_threshold_var"],
+            "LoG": ["log_sigma_var", "log_kernel_size_var"],
+        }
+        return [getattr(self, name) for name in names.get(filter_type, [])]
+
+    def preview_exact(self, filter_type, axis):
+        """Indica si la losa del halo da exactamente el corte central del filtro sobre el volumen completo"""
+        # Un filtro 2D que procesa cortes de otro eje normaliza (y, en Bordes, conecta la histéresis)
+        # sobre cortes enteros, de los que la losa solo contiene una franja
+        return SLICE_FILTER_AXES.get(filter_type, axis) == axis
+
+    def preview_halo(self, filter_type, axis):
+        """Calcula cuántos cortes vecinos necesita un filtro alrededor del corte central"""
+        # Los filtros 2D a lo largo del propio eje del corte no necesitan vecinos
+        if SLICE_FILTER_AXES.get(filter_type) == axis:
+            return 0
+    
+        if filter_type in ("Media", "Mediana"):
+            return self.kernel_size_var.get() // 2
+        elif filter_type == "Bilateral":
+            return self.window_size_var.get() // 2
+        elif filter_type == "Anisotropico":
+            # Cada iteración propaga información un vóxel
+            return self.iterations_var.get()
+        elif filter_type == "Bordes":
+            # Suavizado + Sobel + supresión de no máximos
+            return self.edge_kernel_var.get() // 2 + 2
+        elif filter_type == "NLM":
+            return self.nlm_patch_size_var.get() // 2 + self.nlm_search_var.get()
+        elif filter_type == "Roberts":
+            return 1
+        elif filter_type == "LoG":
+            # Dos convoluciones sucesivas más la búsqueda de cruces por cero
+            return 2 * (self.log_kernel_size_var.get() // 2) + 1
+        return 0
+
+    def downsample_volume(self, data, factor):
+        """Reduce el volumen promediando bloques de factor×factor×factor vóxeles"""
+        if factor <= 1:
+            return data
+        w, h, d = (max(1, n // factor) for n in data.shape)
+        cropped = data[:w * factor, :h * factor, :d * factor]
+        if cropped.shape != (w * factor, h * factor, d * factor):
+            # Ejes más pequeños que el factor: se conservan sin reducir
+            return data[::factor, ::factor, ::factor]
+        return cropped.reshape(w, factor, h, factor, d, factor).mean(axis=(1, 3, 5))
+
+    def reduced_volume(self, factor):
+        """Volumen reducido para la vista previa, calculado una sola vez por factor y volumen cargado"""
+        cached = self.preview_cache.get(factor)
+        if cached is None or cached[0] is not self.image_data:
+            # Los volúmenes reducidos de un volumen anterior ya no sirven
+            self.preview_cache = {key: value for key, value in self.preview_cache.items()
+                                  if value[0] is self.image_data}
+            cached = self.preview_cache[factor] = (self.image_data, self.downsample_volume(self.image_data, factor))
+        return cached[1]
+
+    def compute_preview(self, filter_type, factor=1):
+        """Ejecuta el filtro solo sobre el corte visible (más su halo); devuelve (corte filtrado, exacto)
+
+        exacto indica si el corte coincide con el del filtro aplicado al volumen (a resolución completa).
+        """
+        axis = {"Sagittal": 0, "Coronal": 1}.get(self.corte_actual, 2)
+        data = self.reduced_volume(factor) if factor > 1 else self.image_data
+        index = min(self.indice_corte // factor, data.shape[axis] - 1)
+    
+        # Extraer una losa alrededor del corte actual con el halo que requiere el filtro
+        halo = self.preview_halo(filter_type, axis)
+        start = max(0, index - halo)
+        stop = min(data.shape[axis], index + halo + 1)
+        slab_index = [slice(None)] * 3
+        slab_index[axis] = slice(start, stop)
+        slab = np.array(data[tuple(slab_index)])
+    
+        filtered = self.compute_filter(filter_type, slab)
+        return np.take(filtered, index - start, axis=axis), factor == 1 and self.preview_exact(filter_type, axis)
+
+    def schedule_preview(self, filter_type):
+        """Programa una vista previa tras un breve intervalo mientras se mueven los controles"""
+        if not self.preview_auto_var.get():
+            return
+        if self.preview_job is not None:
+            self.prep_window.after_cancel(self.preview_job)
+        self.preview_job = self.prep_window.after(150, lambda: self.run_preview(filter_type))
+
+    def run_preview(self, filter_type):
+        """Calcula y muestra la vista previa del filtro en la ventana de opciones"""
+        self.preview_job = None
+        if self.image_data is None or not self.prep_window.winfo_exists():
+            return
+    
+        factor = {"Reducido 2×": 2, "Reducido 4×": 4}.get(self.preview_mode_var.get(), 1)
+        try:
+            start_time = time.perf_counter()
+            preview_slice, exact = self.compute_preview(filter_type, factor)
+            elapsed = (time.perf_counter() - start_time) * 1000
+        except Exception as e:
+            self.preview_info_var.set(f"Error en la vista previa: {str(e)}")
+            return
+    
+        norm_preview = self.normalize_image(preview_slice)
+        color_preview = self.apply_colormap(norm_preview)
+        preview_resized = cv2.resize(color_preview, (256, 256))
+    
+        img_pil = Image.fromarray(cv2.cvtColor(preview_resized, cv2.COLOR_BGR2RGB))
+        img_tk = ImageTk.PhotoImage(img_pil)
+        self.preview_canvas.delete("all")
+        self.preview_canvas.create_image(0, 0, anchor=tk.NW, image=img_tk)
+        self.preview_canvas.image = img_tk  # Mantener referencia
+    
+        approximate = "" if exact else " - aproximada"
+        self.preview_info_var.set(f"Corte {self.indice_corte} ({self.corte_actual}){approximate} - {elapsed:.0f} ms")
+        self.status_var.set("Vista previa actualizada")
+
+    @profiler.trace("filter:mean")
     def mean_filter(self, data, kernel_size):
         """Implementa un filtro de media"""
+        if self.kernel_engine == "fast":
+            return kernels.mean_filter(data, kernel_size)
+
         # Crear copia de datos
         result = np.zeros_like(data)
     
         # Calcular el desplazamiento desde el centro (radio)
         radius = kernel_size // 2
+        width, height, depth = data.shape
     
         # Iterar por cada voxel en el volumen
-        for z in range(self.depth):
-            for y in range(self.height):
-                for x in range(self.width):
+        for z in range(depth):
+            for y in range(height):
+                for x in range(width):
                     # Acumuladores para la media
                     sum_values = 0.0
                     count = 0
@@ -1551,9 +2516,9 @@ class NiftiViewer:
                                 nx = x + kx
                             
                                 # Verificar límites
-                                if (0 <= nx < self.width and 
-                                    0 <= ny < self.height and 
-                                    0 <= nz < self.depth):
+                                if (0 <= nx < width and 
+                                    0 <= ny < height and 
+                                    0 <= nz < depth):
                                     # Sumar valor y contar
                                     sum_values += data[nx, ny, nz]
                                     count += 1
@@ -1564,18 +2529,23 @@ class NiftiViewer:
     
         return result
 
+    @profiler.trace("filter:median")
     def median_filter(self, data, kernel_size):
         """Implementa un filtro de mediana"""
+        if self.kernel_engine == "fast":
+            return kernels.median_filter(data, kernel_size)
+
         # Crear copia de datos
         result = np.zeros_like(data)
     
         # Calcular el desplazamiento desde el centro (radio)
         radius = kernel_size // 2
+        width, height, depth = data.shape
     
         # Iterar por cada voxel en el volumen
-        for z in range(self.depth):
-            for y in range(self.height):
-                for x in range(self.width):
+        for z in range(depth):
+            for y in range(height):
+                for x in range(width):
                     # Lista para almacenar valores del vecindario
                     neighborhood = []
                 
@@ -1589,9 +2559,9 @@ class NiftiViewer:
                                 nx = x + kx
                             
                                 # Verificar límites
-                                if (0 <= nx < self.width and 
-                                    0 <= ny < self.height and 
-                                    0 <= nz < self.depth):
+                                if (0 <= nx < width and 
+                                    0 <= ny < height and 
+                                    0 <= nz < depth):
                                     # Añadir valor a la lista
                                     neighborhood.append(data[nx, ny, nz])
                 
@@ -1601,8 +2571,12 @@ class NiftiViewer:
     
         return result
 
+    @profiler.trace("filter:bilateral")
     def bilateral_filter(self, data, window_size, sigma_space, sigma_range):
         """Filtro bilateral."""
+        if self.kernel_engine == "fast":
+            return kernels.bilateral_filter(data, window_size, sigma_space, sigma_range)
+
         result = np.zeros_like(data)
         radius = window_size // 2
         kernel_size = 2 * radius + 1  # Tamaño total del kernel
@@ -1613,22 +2587,23 @@ class NiftiViewer:
         spatial_kernel = np.exp(-0.5 * d_squared / (sigma_space ** 2))
 
         range_gauss_coeff = -0.5 / (sigma_range ** 2)
+        depth, height, width = data.shape
 
-        for z in range(self.depth):
-            self.status_var.set(f"Procesando filtro bilateral: {z+1}/{self.depth}")
+        for z in range(depth):
+            self.status_var.set(f"Procesando filtro bilateral: {z+1}/{depth}")
             self.root.update_idletasks()
 
-            for y in range(self.height):
-                for x in range(self.width):
+            for y in range(height):
+                for x in range(width):
                     center_value = data[z, y, x]
 
                     # Calcular límites para la ventana
                     z_min = max(z - radius, 0)
-                    z_max = min(z + radius + 1, self.depth)
+                    z_max = min(z + radius + 1, depth)
                     y_min = max(y - radius, 0)
-                    y_max = min(y + radius + 1, self.height)
+                    y_max = min(y + radius + 1, height)
                     x_min = max(x - radius, 0)
-                    x_max = min(x + radius + 1, self.width)
+                    x_max = min(x + radius + 1, width)
 
                     # Extraer ventana local
                     local_region = data[z_min:z_max, y_min:y_max, x_min:x_max]
@@ -1668,10 +2643,18 @@ class NiftiViewer:
 
         return result
 
+    @profiler.trace("filter:anisotropic_diffusion")
     def anisotropic_diffusion(self, data, iterations, kappa, lambda_val):
         """Implementación del filtro de difusión anisotrópica (Perona-Malik)"""
+        if self.kernel_engine == "fast":
+            def progress(i):
+                self.status_var.set(f"Iteración de difusión anisotrópica: {i+1}/{iterations}")
+                self.root.update_idletasks()
+            return kernels.anisotropic_diffusion(data, iterations, kappa, lambda_val, progress)
+
         # Crear copia de datos
         result = data.copy()
+        width, height, depth = data.shape
     
         # Función de conducción
         def g(gradient, k):
@@ -1687,9 +2670,9 @@ class NiftiViewer:
             updated = result.copy()
         
             # Iterar por cada voxel en el volumen (excepto bordes)
-            for z in range(1, self.depth-1):
-                for y in range(1, self.height-1):
-                    for x in range(1, self.width-1):
+            for z in range(1, depth-1):
+                for y in range(1, height-1):
+                    for x in range(1, width-1):
                         # Calcular gradientes en las 6 direcciones
                         nabla_n = result[x, y-1, z] - result[x, y, z]
                         nabla_s = result[x, y+1, z] - result[x, y, z]
@@ -1718,15 +2701,19 @@ class NiftiViewer:
     
         return result
 
-    def edge_detection(self, low_threshold, high_threshold, kernel_size):
+    @profiler.trace("filter:edge_detection")
+    def edge_detection(self, low_threshold, high_threshold, kernel_size, data=None):
         """Implementa detección de bordes tipo Canny"""
-        # Crear un resultado 3D
-        result = np.zeros_like(self.image_data)
+        if data is None:
+            data = self.image_data
+
+        # Crear un resultado 3D (mapa binario de bordes)
+        result = np.zeros(data.shape, dtype=np.uint8)
     
         # Procesar cada slice
-        for z in range(self.depth):
+        for z in range(data.shape[2]):
             # Obtener slice
-            slice_data = self.image_data[:, :, z]
+            slice_data = data[:, :, z]
         
             # Normalizar a rango [0-1]
             slice_norm = self.normalize_0_1(slice_data)
@@ -1738,10 +2725,11 @@ class NiftiViewer:
             gx, gy = self.sobel_gradients(smoothed)
         
             # 3. Magnitud del gradiente
-            magnitude = np.sqrt(gx**2 + gy**2)
+            with profiler.span("stage:gradient_polar"):
+                magnitude = np.sqrt(gx**2 + gy**2)
         
-            # 4. Dirección del gradiente
-            direction = np.arctan2(gy, gx)
+                # 4. Dirección del gradiente
+                direction = np.arctan2(gy, gx)
         
             # 5. Supresión de no máximos
             suppressed = self.non_maximum_suppression(magnitude, direction)
@@ -1757,17 +2745,21 @@ class NiftiViewer:
             # Asignar resultado
             result[:, :, z] = edges
     
-        return result
+        return bitmask.PackedMask.from_array(result)
     
-    def non_local_means(self, patch_size, search_radius, h_param):
+    @profiler.trace("filter:non_local_means")
+    def non_local_means(self, patch_size, search_radius, h_param, data=None):
         """Implementa Non-Local Means"""
+        if data is None:
+            data = self.image_data
+
         # Crear un resultado 3D
-        result = np.zeros_like(self.image_data)
+        result = np.zeros_like(data)
     
         # Procesar cada slice (para ahorrar tiempo y memoria)
-        for z in range(self.depth):
+        for z in range(data.shape[2]):
             # Obtener slice
-            slice_data = self.image_data[:, :, z]
+            slice_data = data[:, :, z]
         
             # Normalizar a rango [0-1]
             slice_norm = self.normalize_0_1(slice_data)
@@ -1780,6 +2772,7 @@ class NiftiViewer:
     
         return result
 
+    @profiler.trace("stage:normalize")
     def normalize_0_1(self, data):
         """Normaliza datos al rango [0-1]"""
         min_val = np.min(data)
@@ -1788,8 +2781,12 @@ class NiftiViewer:
             return np.zeros_like(data)
         return (data - min_val) / (max_val - min_val)
 
+    @profiler.trace("stage:gaussian_blur")
     def gaussian_blur(self, image, kernel_size):
         """Implementa desenfoque gaussiano"""
+        if self.kernel_engine == "fast":
+            return kernels.gaussian_blur(image, kernel_size)
+
         # Crear kernel gaussiano
         sigma = 0.3 * ((kernel_size - 1) * 0.5 - 1) + 0.8
         kernel_1d = np.array([np.exp(-(x - kernel_size//2)**2/(2*sigma**2)) for x in range(kernel_size)])
@@ -1821,8 +2818,12 @@ class NiftiViewer:
     
         return result
 
+    @profiler.trace("stage:sobel")
     def sobel_gradients(self, image):
         """Calcula gradientes usando operadores Sobel"""
+        if self.kernel_engine == "fast":
+            return kernels.sobel_gradients(image)
+
         # Kernels de Sobel
         sobel_x = np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]])
         sobel_y = np.array([[-1, -2, -1], [0, 0, 0], [1, 2, 1]])
@@ -1839,8 +2840,12 @@ class NiftiViewer:
     
         return gx, gy
 
+    @profiler.trace("stage:non_maximum_suppression")
     def non_maximum_suppression(self, magnitude, direction):
         """Suprime valores no máximos en la dirección del gradiente"""
+        if self.kernel_engine == "fast":
+            return kernels.non_maximum_suppression(magnitude, direction)
+
         result = np.zeros_like(magnitude)
         height, width = magnitude.shape
     
@@ -1876,8 +2881,12 @@ class NiftiViewer:
     
         return result
 
+    @profiler.trace("stage:hysteresis_threshold")
     def hysteresis_threshold(self, image, low, high):
         """Umbralización con histéresis para detección de bordes"""
+        if self.kernel_engine == "fast":
+            return kernels.hysteresis_threshold(image, low, high)
+
         # Crear máscara de bordes fuertes y débiles
         strong_edges = image >= high
         weak_edges = (image >= low) & (image < high)
@@ -1916,8 +2925,12 @@ class NiftiViewer:
     
         return result
 
+    @profiler.trace("stage:nlm_2d")
     def nlm_2d(self, image, patch_size, search_radius, h_param):
         """Implementación de Non-Local Means para una imagen 2D"""
+        if self.kernel_engine == "fast":
+            return kernels.nlm_2d(image, patch_size, search_radius, h_param)
+
         height, width = image.shape
         result = np.zeros_like(image)
         h_squared = h_param ** 2
@@ -1974,10 +2987,14 @@ class NiftiViewer:
     
         return result
 
+    @profiler.trace("filter:roberts")
     def roberts_edge_detection(self, image_data, threshold):
+        """Detección de bordes con el operador cruzado de Roberts"""
+        if self.kernel_engine == "fast":
+            return bitmask.PackedMask.from_array(kernels.roberts_edge_detection(image_data, threshold))
     
-        # Crear una copia para no modificar la imagen original
-        result = np.zeros_like(image_data, dtype=np.float32)
+        # Crear una copia para no modificar la imagen original (mapa binario)
+        result = np.zeros(image_data.shape, dtype=np.uint8)
     
         # Definir los kernels del operador de Roberts
         roberts_cross_v = np.array([[1, 0], 
@@ -2017,14 +3034,18 @@ class NiftiViewer:
             # Guardar resultado
             result[i, :, :] = gradient_magnitude
     
-        return result
+        return bitmask.PackedMask.from_array(result)
 
+    @profiler.trace("filter:laplacian_of_gaussian")
     def laplacian_of_gaussian(self, preprocessed_data, sigma, kernel_size):
 
         # Crear kernels
         gaussian = self.gaussian_kernel(kernel_size, sigma)
         laplacian = self.laplacian_kernel(kernel_size)
 
+        if self.kernel_engine == "fast":
+            return bitmask.PackedMask.from_array(kernels.laplacian_of_gaussian(preprocessed_data, gaussian, laplacian))
+
         # Crear volumen de salida con mismo shape
         output = np.zeros_like(preprocessed_data, dtype=np.uint8)
 
@@ -2062,7 +3083,7 @@ class NiftiViewer:
 
             output[:, :, z] = zero_crossings
 
-        return output
+        return bitmask.PackedMask.from_array(output)
 
     def gaussian_kernel(self, size, sigma):
         """Crea un kernel gaussiano 2D"""
@@ -2080,8 +3101,12 @@ class NiftiViewer:
             laplacian = np.pad(laplacian, ((pad_size, pad_size), (pad_size, pad_size)), mode='constant', constant_values=0)
         return laplacian
 
+    @profiler.trace("stage:convolution")
     def convolution2d(self, image, kernel):
         """Convolución 2D desde cero"""
+        if self.kernel_engine == "fast":
+            return kernels.convolution2d(image, kernel)
+
         h_image, w_image = image.shape
         h_kernel, w_kernel = kernel.shape
 
@@ -2211,36 +3236,33 @@ class NiftiViewer:
         if messagebox.askyesno("Aplicar Preprocesamiento", 
                         "¿Desea aplicar el resultado como imagen principal?\n" +
                         "Esto reemplazará los datos actuales."):
-            # Actualizar datos de la imagen
-            self.image_data = processed_data.copy()
+            # Guardar el estado anterior en el historial (volumen sin copiar, solo se reemplaza)
+            self.finish_annotations()
+            previous_volume, previous_overlay = self.image_data, self.overlay_data
+            state = dict(self.overlay_state(), image_modified=self.image_modified)
+        
+            # Actualizar datos de la imagen (en la precisión de trabajo)
+            self.image_data = processed_data.astype(self.float_dtype)
+            self.image_modified = True
         
             # Limpiar dibujos previos
-            self.overlay_data = np.zeros_like(self.image_data)
-            self.draw_points = []
+            self.reset_overlay()
+            self.push_history("Preprocessing", previous_overlay, volume=previous_volume, state=state)
         
-            # Actualizar visualización
+            # Actualizar visualización (incluida la escena 3D si está abierta)
             self.update_slice()
+            self.refresh_3d(volume_changed=True)
             self.status_var.set("Preprocesamiento aplicado como imagen principal")
 
     def export_preprocessing(self, result):
         """Exporta el resultado del preprocesamiento como archivo NIfTI"""
         try:
-            file_path = filedialog.asksaveasfilename(
-                defaultextension=".nii.gz",
-                filetypes=[("NIfTI Files", "*.nii *.nii.gz")],
-                title="Guardar Resultado como NIfTI"
-            )
-        
+            file_path = self.ask_export_path("Guardar Resultado como NIfTI")
             if not file_path:
                 return
         
-            # Crear un nuevo objeto NIfTI con los datos procesados
-            processed_nii = nib.Nifti1Image(result, self.nii_image.affine)
-        
-            # Guardar el archivo
-            nib.save(processed_nii, file_path)
-        
-            self.status_var.set(f"Resultado guardado en {os.path.basename(file_path)}")
+            # Datos continuos como float32 (o int16 con scl_slope si se pidió cuantizar)
+            self.start_export(result, file_path, "Resultado guardado en", "Error al exportar resultado")
         
         except Exception as e:
             messagebox.showerror("Error", f"Error al exportar resultado: {str(e)}")
@@ -2248,6 +3270,10 @@ class NiftiViewer:
 
 
 if __name__ == "__main__":
+    # The 3D views run in spawned processes (also inside a PyInstaller bundle)
+    multiprocessing.freeze_support()
     root = tk.Tk()
     app = NiftiViewer(root)
     root.mainloop()
+    app.close_all_3d()
+    app.history.clear()
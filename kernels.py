@@ -0,0 +1,340 @@
+"""Vectorized engine for the NiftiViewer filters
+
+Every function mirrors a loop implementation of imagenProc.py (kept there as the
+reference engine) and reproduces its arithmetic: same dtypes, same summation
+order where the loop uses np.sum, same border handling. golden.py checks both
+engines against stored golden outputs.
+"""
+import cv2
+import numpy as np
+
+
+def _pairwise(term, start, n):
+    """Add term(start) ... term(start+n-1) grouping them like numpy's pairwise float sum"""
+    if n < 8:
+        result = 0.0
+        for i in range(start, start + n):
+            result = result + term(i)
+        return result
+    if n <= 128:
+        acc = [term(start + j) for j in range(8)]
+        i = 8
+        while i < n - n % 8:
+            for j in range(8):
+                acc[j] = acc[j] + term(start + i + j)
+            i += 8
+        result = ((acc[0] + acc[1]) + (acc[2] + acc[3])) + ((acc[4] + acc[5]) + (acc[6] + acc[7]))
+        while i < n:
+            result = result + term(start + i)
+            i += 1
+        return result
+    half = n // 2
+    half -= half % 8
+    return _pairwise(term, start, half) + _pairwise(term, start + half, n - half)
+
+
+def _correlate(padded, kernel, out_shape):
+    """np.sum(region * kernel) for every output pixel of a zero-padded 2D (or stacked 3D) image"""
+    kh, kw = kernel.shape
+    rows, cols = out_shape[:2]
+    flat = kernel.ravel()
+
+    def term(i):
+        r, c = divmod(i, kw)
+        return padded[r:r + rows, c:c + cols] * flat[i]
+
+    return _pairwise(term, 0, kh * kw)
+
+
+# Filtros 3D
+
+def mean_filter(data, kernel_size):
+    """Filtro de media 3D (vecinos fuera del volumen no cuentan)"""
+    radius = kernel_size // 2
+    width, height, depth = data.shape
+    padded = np.pad(data, radius)
+
+    total = np.zeros(data.shape, dtype=np.result_type(data.dtype, 0.0))
+    for kz in range(kernel_size):
+        for ky in range(kernel_size):
+            for kx in range(kernel_size):
+                np.add(total, padded[kx:kx + width, ky:ky + height, kz:kz + depth], out=total)
+
+    # Número de vecinos válidos: producto de los conteos por eje
+    counts = [np.minimum(np.arange(n) + radius, n - 1) - np.maximum(np.arange(n) - radius, 0) + 1
+              for n in data.shape]
+    count = counts[0][:, None, None] * counts[1][None, :, None] * counts[2][None, None, :]
+
+    result = np.zeros_like(data)
+    result[...] = total / count
+    return result
+
+
+def median_filter(data, kernel_size, chunk_bytes=256 * 2**20):
+    """Filtro de mediana 3D (vecinos fuera del volumen no cuentan)"""
+    radius = kernel_size // 2
+    width, height, depth = data.shape
+    dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.float64
+    padded = np.pad(data.astype(dtype), radius, constant_values=np.nan)
+    result = np.zeros_like(data)
+
+    # Procesar por losas para acotar la memoria de las ventanas (kernel_size³ valores por vóxel)
+    per_plane = height * depth * kernel_size ** 3 * padded.itemsize
+    chunk = max(1, int(chunk_bytes // per_plane))
+    for x0 in range(0, width, chunk):
+        x1 = min(width, x0 + chunk)
+        block = padded[x0:x1 + 2 * radius]
+        windows = np.lib.stride_tricks.sliding_window_view(block, (kernel_size,) * 3)
+        windows = np.sort(windows.reshape(x1 - x0, height, depth, -1), axis=-1)  # NaN al final
+
+        count = kernel_size ** 3 - np.isnan(windows).sum(axis=-1)
+        low = np.take_along_axis(windows, ((count - 1) // 2)[..., None], axis=-1)[..., 0]
+        high = np.take_along_axis(windows, (count // 2)[..., None], axis=-1)[..., 0]
+        result[x0:x1] = (low + high) / 2
+    return result
+
+
+def bilateral_filter(data, window_size, sigma_space, sigma_range):
+    """Filtro bilateral 3D con ventana recortada en los bordes"""
+    radius = window_size // 2
+    range_gauss_coeff = -0.5 / (sigma_range ** 2)
+    s0, s1, s2 = data.shape
+
+    padded = np.pad(data, radius)
+    valid = np.pad(np.ones(data.shape, dtype=bool), radius)
+
+    weighted_sum = np.zeros(data.shape, dtype=np.result_type(data.dtype, 0.0))
+    weight_sum = np.zeros_like(weighted_sum)
+    for dz in range(-radius, radius + 1):
+        for dy in range(-radius, radius + 1):
+            for dx in range(-radius, radius + 1):
+                spatial = float(np.exp(-0.5 * (dx * dx + dy * dy + dz * dz) / (sigma_space ** 2)))
+                window = (slice(radius + dz, radius + dz + s0),
+                          slice(radius + dy, radius + dy + s1),
+                          slice(radius + dx, radius + dx + s2))
+                neighbor = padded[window]
+                weight = spatial * np.exp(((neighbor - data) ** 2) * range_gauss_coeff) * valid[window]
+                weighted_sum += weight * neighbor
+                weight_sum += weight
+
+    result = np.zeros_like(data)
+    positive = weight_sum > 0
+    result[positive] = weighted_sum[positive] / weight_sum[positive]
+    result[~positive] = data[~positive]
+    return result
+
+
+def anisotropic_diffusion(data, iterations, kappa, lambda_val, progress=None):
+    """Difusión anisotrópica de Perona-Malik (los bordes del volumen no se actualizan)"""
+    result = data.copy()
+
+    def g(gradient):
+        return np.exp(-(gradient / kappa) ** 2)
+
+    for i in range(iterations):
+        if progress is not None:
+            progress(i)
+        updated = result.copy()
+        center = result[1:-1, 1:-1, 1:-1]
+
+        nabla_n = result[1:-1, :-2, 1:-1] - center
+        nabla_s = result[1:-1, 2:, 1:-1] - center
+        nabla_e = result[2:, 1:-1, 1:-1] - center
+        nabla_w = result[:-2, 1:-1, 1:-1] - center
+        nabla_t = result[1:-1, 1:-1, 2:] - center
+        nabla_b = result[1:-1, 1:-1, :-2] - center
+
+        updated[1:-1, 1:-1, 1:-1] = center + lambda_val * (
+            g(nabla_n) * nabla_n + g(nabla_s) * nabla_s +
+            g(nabla_e) * nabla_e + g(nabla_w) * nabla_w +
+            g(nabla_t) * nabla_t + g(nabla_b) * nabla_b
+        )
+        result = updated
+    return result
+
+
+# Kernels 2D
+
+def gaussian_blur(image, kernel_size):
+    """Desenfoque gaussiano separable con borde a cero"""
+    sigma = 0.3 * ((kernel_size - 1) * 0.5 - 1) + 0.8
+    kernel_1d = np.array([np.exp(-(x - kernel_size // 2) ** 2 / (2 * sigma ** 2)) for x in range(kernel_size)])
+    kernel_1d = kernel_1d / kernel_1d.sum()
+    half = kernel_size // 2
+    rows, cols = image.shape
+
+    # Acumulación secuencial en el mismo orden que el bucle de referencia
+    padded = np.pad(image, ((0, 0), (half, half)))
+    temp = np.zeros_like(image)
+    acc = 0
+    for k in range(kernel_size):
+        acc = acc + padded[:, k:k + cols] * kernel_1d[k]
+    temp[...] = acc
+
+    padded = np.pad(temp, ((half, half), (0, 0)))
+    result = np.zeros_like(image)
+    acc = 0
+    for k in range(kernel_size):
+        acc = acc + padded[k:k + rows, :] * kernel_1d[k]
+    result[...] = acc
+    return result
+
+
+def sobel_gradients(image):
+    """Gradientes de Sobel en el interior de la imagen (bordes a cero)"""
+    sobel_x = np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]])
+    sobel_y = np.array([[-1, -2, -1], [0, 0, 0], [1, 2, 1]])
+    shape = (image.shape[0] - 2, image.shape[1] - 2)
+
+    gx = np.zeros_like(image)
+    gy = np.zeros_like(image)
+    if min(shape) > 0:
+        source = image.astype(np.result_type(image.dtype, np.float64))
+        gx[1:-1, 1:-1] = _correlate(source, sobel_x, shape)
+        gy[1:-1, 1:-1] = _correlate(source, sobel_y, shape)
+    return gx, gy
+
+
+def non_maximum_suppression(magnitude, direction):
+    """Supresión de no máximos en la dirección del gradiente"""
+    result = np.zeros_like(magnitude)
+    if min(magnitude.shape) < 3:
+        return result
+    angle = (np.degrees(direction) % 180)[1:-1, 1:-1]
+    m = magnitude
+
+    horizontal = ((0 <= angle) & (angle < 22.5)) | ((157.5 <= angle) & (angle <= 180))
+    diagonal_45 = (22.5 <= angle) & (angle < 67.5)
+    vertical = (67.5 <= angle) & (angle < 112.5)
+    conditions = [horizontal, diagonal_45, vertical]
+
+    neighbor1 = np.select(conditions, [m[1:-1, :-2], m[2:, :-2], m[:-2, 1:-1]], m[:-2, :-2])
+    neighbor2 = np.select(conditions, [m[1:-1, 2:], m[:-2, 2:], m[2:, 1:-1]], m[2:, 2:])
+
+    center = m[1:-1, 1:-1]
+    keep = (center >= neighbor1) & (center >= neighbor2)
+    result[1:-1, 1:-1] = np.where(keep, center, 0)
+    return result
+
+
+def hysteresis_threshold(image, low, high):
+    """Umbralización con histéresis: bordes débiles conectados (8-vecinos) a uno fuerte"""
+    strong = image >= high
+    candidates = ((image >= low) | strong).astype(np.uint8)
+    result = np.zeros_like(image)
+    if not strong.any():
+        return result
+
+    _, labels = cv2.connectedComponents(candidates, connectivity=8)
+    keep = np.zeros(labels.max() + 1, dtype=bool)
+    keep[np.unique(labels[strong])] = True
+    keep[0] = False
+    result[keep[labels]] = 1
+    return result
+
+
+def nlm_2d(image, patch_size, search_radius, h_param):
+    """Non-Local Means 2D; los píxeles a menos de medio parche del borde se copian"""
+    height, width = image.shape
+    result = image.copy()
+    patch_half = patch_size // 2
+    rows, cols = height - 2 * patch_half, width - 2 * patch_half
+    if rows <= 0 or cols <= 0:
+        return result
+    h_squared = h_param ** 2
+
+    pad = search_radius + patch_half
+    padded = np.pad(image, pad)
+    base = pad + patch_half  # fila/columna en padded del primer píxel procesado
+
+    # Un píxel vecino es válido si queda dentro de la zona procesada
+    row_index = np.arange(patch_half, height - patch_half)[:, None]
+    col_index = np.arange(patch_half, width - patch_half)[None, :]
+
+    weighted_sum = 0
+    weight_sum = 0
+    for di in range(-search_radius, search_radius + 1):
+        for dj in range(-search_radius, search_radius + 1):
+            valid = ((row_index + di >= patch_half) & (row_index + di < height - patch_half) &
+                     (col_index + dj >= patch_half) & (col_index + dj < width - patch_half))
+            if not valid.any():
+                continue
+
+            def term(i):
+                a, b = divmod(i, patch_size)
+                center = padded[base + a - patch_half:base + a - patch_half + rows,
+                                base + b - patch_half:base + b - patch_half + cols]
+                search = padded[base + di + a - patch_half:base + di + a - patch_half + rows,
+                                base + dj + b - patch_half:base + dj + b - patch_half + cols]
+                return (center - search) ** 2
+
+            distance = _pairwise(term, 0, patch_size * patch_size)
+            weight = np.exp(-distance / h_squared)
+            value = padded[base + di:base + di + rows, base + dj:base + dj + cols]
+            weighted_sum = weighted_sum + np.where(valid, weight * value, 0)
+            weight_sum = weight_sum + np.where(valid, weight, 0)
+
+    result[patch_half:height - patch_half, patch_half:width - patch_half] = weighted_sum / weight_sum
+    return result
+
+
+def convolution2d(image, kernel):
+    """Convolución 2D (correlación) con relleno de ceros; admite una pila de cortes en el eje 2"""
+    h_offset = kernel.shape[0] // 2
+    w_offset = kernel.shape[1] // 2
+    pad = ((h_offset, h_offset), (w_offset, w_offset)) + ((0, 0),) * (image.ndim - 2)
+    padded = np.pad(image.astype(np.float64), pad)
+
+    result = np.zeros_like(image, dtype=np.float32)
+    result[...] = _correlate(padded, kernel, image.shape)
+    return result
+
+
+def roberts_edge_detection(image_data, threshold):
+    """Operador de Roberts por cortes del eje 0, normalizado y binarizado"""
+    roberts_cross_v = np.array([[1, 0], [0, -1]])
+    roberts_cross_h = np.array([[0, 1], [-1, 0]])
+
+    slices = image_data.astype(np.float32).astype(np.float64)
+    n, rows, cols = slices.shape
+    shape = (rows - 1, cols - 1)
+
+    horizontal = np.zeros(slices.shape, dtype=np.float32)
+    vertical = np.zeros(slices.shape, dtype=np.float32)
+    if min(shape) > 0:
+        # Mover el eje de cortes al final para correlacionar todas las rebanadas a la vez
+        stacked = np.moveaxis(slices, 0, -1)
+        horizontal[:, :-1, :-1] = np.moveaxis(_correlate(stacked, roberts_cross_h, shape), -1, 0)
+        vertical[:, :-1, :-1] = np.moveaxis(_correlate(stacked, roberts_cross_v, shape), -1, 0)
+
+    gradient_magnitude = np.sqrt(np.square(horizontal) + np.square(vertical))
+    maxima = gradient_magnitude.max(axis=(1, 2), initial=0)
+    positive = maxima > 0
+    gradient_magnitude[positive] = gradient_magnitude[positive] / maxima[positive][:, None, None]
+
+    return (gradient_magnitude > threshold).astype(np.uint8)
+
+
+def laplacian_of_gaussian(data, gaussian, laplacian):
+    """LoG por cortes axiales con detección de cruces por cero"""
+    smoothed = convolution2d(data, gaussian)
+    result = convolution2d(smoothed, laplacian)
+
+    # Normalizar cada corte axial a [0, 1]
+    min_val = result.min(axis=(0, 1), keepdims=True)
+    max_val = result.max(axis=(0, 1), keepdims=True)
+    scale = max_val > min_val
+    normalized = np.where(scale, (result - min_val) / np.where(scale, max_val - min_val, 1), 0).astype(np.float32)
+
+    # Cruce por cero: algún vecino de signo opuesto al centro
+    output = np.zeros_like(data, dtype=np.uint8)
+    center = normalized[1:-1, 1:-1]
+    crossing = np.zeros(center.shape, dtype=bool)
+    for di in (-1, 0, 1):
+        for dj in (-1, 0, 1):
+            if di == 0 and dj == 0:
+                continue
+            neighbor = normalized[1 + di:normalized.shape[0] - 1 + di, 1 + dj:normalized.shape[1] - 1 + dj]
+            crossing |= neighbor * center < 0
+    output[1:-1, 1:-1] = crossing
+    return output
@@ -0,0 +1,130 @@
+"""Streamed NIfTI export in the smallest safe data type, on a background thread
+
+The data type is chosen from one chunked pass over the volume: integer
+valued data (masks, labels) goes to uint8, int16 or int32, whichever holds
+its range; continuous data goes to float32, or to int16 with scl_slope /
+scl_inter when quantization is requested. The file is written as the
+header followed by slabs along the last axis, each converted to the output
+type just before it is written (Fortran order, as NIfTI stores voxels), so
+the whole array is never duplicated while it is encoded. Files ending in
+.gz are gzip-compressed at the chosen level, others are written raw.
+"""
+import gzip
+import os
+import threading
+
+import nibabel as nib
+import numpy as np
+
+# Bytes of input converted and written per chunk
+CHUNK_BYTES = 16 * 1024 ** 2
+
+# gzip level used for .nii.gz files when none is given
+DEFAULT_LEVEL = 6
+
+INT16_RANGE = (np.iinfo(np.int16).min, np.iinfo(np.int16).max)
+
+
+def chunks(shape, itemsize, chunk_bytes=CHUNK_BYTES):
+    """Index tuples of consecutive slabs along the last axis, about chunk_bytes each"""
+    plane = int(np.prod(shape[:-1])) * itemsize
+    step = max(1, chunk_bytes // max(plane, 1))
+    for start in range(0, shape[-1], step):
+        yield (slice(None),) * (len(shape) - 1) + (slice(start, start + step),)
+
+
+def storage_type(data, quantize=False):
+    """(dtype, slope, intercept) to store data with: lossless unless quantize is set for continuous data"""
+    if data.dtype == bool:
+        return np.dtype(np.uint8), 1.0, 0.0
+
+    low, high = np.inf, -np.inf
+    integral = True
+    for region in chunks(data.shape, data.itemsize):
+        block = data[region]
+        if block.size == 0:
+            continue
+        low = min(low, float(np.min(block)))
+        high = max(high, float(np.max(block)))
+        if integral and data.dtype.kind == "f":
+            integral = bool(np.all(np.isfinite(block))) and np.array_equal(block, np.rint(block))
+    if low > high:
+        low = high = 0.0
+
+    if integral:
+        for dtype in (np.uint8, np.int16, np.int32):
+            info = np.iinfo(dtype)
+            if info.min <= low and high <= info.max:
+                return np.dtype(dtype), 1.0, 0.0
+    if quantize and np.isfinite(low) and np.isfinite(high):
+        # The full int16 range spans [low, high]
+        slope = (high - low) / (INT16_RANGE[1] - INT16_RANGE[0]) or 1.0
+        return np.dtype(np.int16), slope, low - INT16_RANGE[0] * slope
+    return np.dtype(np.float32), 1.0, 0.0
+
+
+def write_nifti(path, data, affine, header=None, level=DEFAULT_LEVEL, quantize=False, progress=None):
+    """Write data as a .nii or .nii.gz file, chunk by chunk; progress(fraction) is called after each chunk"""
+    dtype, slope, inter = storage_type(data, quantize)
+    scaled = slope != 1.0 or inter != 0.0
+
+    # Keep the source header fields (units, intent, description) but not its layout
+    header = header.copy() if header is not None else nib.Nifti1Header()
+    header.set_data_shape(data.shape)
+    header.set_data_dtype(dtype)
+    header.set_sform(affine)
+    header.set_qform(affine)
+    header.set_slope_inter(slope, inter)
+    header["vox_offset"] = 0
+
+    regions = list(chunks(data.shape, data.itemsize))
+    partial = path + ".part"
+    try:
+        if path.endswith(".gz"):
+            stream = gzip.open(partial, "wb", compresslevel=level)
+        else:
+            stream = open(partial, "wb")
+        with stream:
+            header.write_to(stream)
+            for done, region in enumerate(regions, 1):
+                block = data[region]
+                if scaled:
+                    block = np.clip(np.rint((block - inter) / slope), *INT16_RANGE)
+                stream.write(np.asarray(block, dtype=dtype).tobytes(order="F"))
+                if progress is not None:
+                    progress(done / len(regions))
+        # The destination only ever holds a complete file
+        os.replace(partial, path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    return dtype, slope, inter
+
+
+class ExportJob:
+    """write_nifti running on a worker thread; the UI thread polls done, progress and error"""
+    def __init__(self, path, data, affine, **options):
+        self.path = path
+        self.progress = 0.0
+        self.error = None
+        self.result = None
+        # Not a daemon: quitting the viewer still lets a started file finish
+        self.thread = threading.Thread(target=self._run, args=(data, affine), kwargs=options)
+
+    def _run(self, data, affine, **options):
+        try:
+            self.result = write_nifti(self.path, data, affine, progress=self._set_progress, **options)
+        except Exception as e:
+            self.error = e
+
+    def _set_progress(self, fraction):
+        self.progress = fraction
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    @property
+    def done(self):
+        return not self.thread.is_alive()
@@ -0,0 +1,183 @@
+"""Span profiler for processing jobs, with peak-memory sampling and Chrome-trace export
+
+Spans are opened with `with profiler.span("name"):` or the `@profiler.trace("name")`
+decorator. While the profiler is disabled both return immediately, so the
+instrumentation can stay in place permanently.
+"""
+import collections
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+
+class _NullSpan:
+    """Shared no-op context returned while profiling is disabled"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+        self.peak = 0
+
+    def __enter__(self):
+        self.profiler._push(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.profiler._pop(self, end)
+        return False
+
+
+class Profiler:
+    def __init__(self, max_events=200000):
+        self.enabled = False
+        self.track_memory = False
+        self.events = collections.deque(maxlen=max_events)
+        self._origin = time.perf_counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._started_tracemalloc = False
+
+    def enable(self, track_memory=True):
+        """Start recording spans (and peak memory through tracemalloc if requested)"""
+        self.track_memory = track_memory
+        if track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self.enabled = True
+
+    def disable(self):
+        """Stop recording; recorded events are kept until clear()"""
+        self.enabled = False
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+        self.track_memory = False
+
+    def clear(self):
+        with self._lock:
+            self.events.clear()
+
+    def span(self, name, **args):
+        """Context manager timing a named stage"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def trace(self, name):
+        """Decorator that wraps every call of a function in a span"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with _Span(self, name, {}):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _memory(self):
+        if self.track_memory and tracemalloc.is_tracing():
+            return tracemalloc.get_traced_memory()
+        return None
+
+    def _push(self, span):
+        stack = self._stack()
+        memory = self._memory()
+        if memory is not None:
+            # Fold the peak seen so far into the parent before resetting it for the child
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, memory[1])
+            tracemalloc.reset_peak()
+            span.start_memory = memory[0]
+        else:
+            span.start_memory = None
+        stack.append(span)
+
+    def _pop(self, span, end):
+        stack = self._stack()
+        if stack and stack[-1] is span:
+            stack.pop()
+
+        args = dict(span.args)
+        memory = self._memory()
+        if memory is not None and span.start_memory is not None:
+            peak = max(span.peak, memory[1])
+            args["peak_bytes"] = max(0, peak - span.start_memory)
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+
+        with self._lock:
+            self.events.append({
+                "name": span.name,
+                "start": span.start - self._origin,
+                "duration": end - span.start,
+                "tid": threading.get_ident(),
+                "depth": len(stack),
+                "args": args,
+            })
+
+    def summary(self):
+        """Aggregate the recorded spans by name: calls, total/mean/max seconds and peak bytes"""
+        totals = collections.OrderedDict()
+        with self._lock:
+            events = list(self.events)
+        for event in events:
+            entry = totals.setdefault(event["name"], {"calls": 0, "total": 0.0, "max": 0.0, "peak_bytes": None})
+            entry["calls"] += 1
+            entry["total"] += event["duration"]
+            entry["max"] = max(entry["max"], event["duration"])
+            peak = event["args"].get("peak_bytes")
+            if peak is not None:
+                entry["peak_bytes"] = max(entry["peak_bytes"] or 0, peak)
+        for entry in totals.values():
+            entry["mean"] = entry["total"] / entry["calls"]
+        return totals
+
+    def chrome_trace(self):
+        """Recorded spans in the Chrome trace event format (chrome://tracing, Perfetto)"""
+        with self._lock:
+            events = list(self.events)
+        pid = os.getpid()
+        return {
+            "displayTimeUnit": "ms",
+            "traceEvents": [{
+                "name": event["name"],
+                "cat": event["name"].split(":")[0],
+                "ph": "X",
+                "ts": event["start"] * 1e6,
+                "dur": event["duration"] * 1e6,
+                "pid": pid,
+                "tid": event["tid"],
+                "args": event["args"],
+            } for event in events],
+        }
+
+    def export_chrome_trace(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+
+# Shared instance used by the viewer and the processing code
+profiler = Profiler()
@@ -0,0 +1,164 @@
+"""Thick-slab projections (maximum, minimum, mean) along a volume axis
+
+Slabs are split into whole blocks of slices and at most 2 * (block - 1)
+slices read directly at their ends. Mean slabs sum their whole blocks with
+float32 prefix sums over the block sums (one subtraction whatever the
+thickness). Maximum and minimum slabs use the extrema of the blocks plus a
+sparse table over them, capped at MAX_LEVELS levels (level k holds the
+extremum of 2**k consecutive blocks), so whole blocks take a few table
+lookups. Extrema are stored in the volume type when it has 4 bytes or less
+and as float32 otherwise.
+
+Tables are built lazily per axis and mode and kept in an LRU whose total
+never exceeds max_bytes (TABLE_BYTES by default). A single table is held to
+max_bytes / TABLES_KEPT: along each axis, blocks start at BLOCK slices and
+double until at least the block extrema fit, and the sparse table keeps
+only the levels that still fit, so large volumes trade table memory for
+more lookups and more slices read directly at the slab ends.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+# Smallest number of slices per block
+BLOCK = 8
+
+# Levels of the extrema sparse tables (a lookup covers up to 2 ** (MAX_LEVELS - 1) blocks)
+MAX_LEVELS = 4
+
+# Memory of all the tables of a projector, and how many tables of the largest size fit in it
+TABLE_BYTES = 128 * 1024 ** 2
+TABLES_KEPT = 4
+
+REDUCERS = {"max": np.maximum, "min": np.minimum}
+
+
+def _table_slices(length, block, levels):
+    """Slices held by the first levels of the extrema table of an axis of length slices cut in blocks of block"""
+    blocks = -(-length // block)
+    return sum(max(0, blocks - 2 ** level + 1) for level in range(levels))
+
+
+class SlabProjector:
+    """Slab projections of one volume along any axis, from cached block sums and block extrema"""
+    def __init__(self, volume, max_bytes=TABLE_BYTES):
+        self.volume = volume
+        self.max_bytes = max_bytes
+        self.tables = OrderedDict()  # (mode, axis) -> list of arrays, least recently used first
+        self.layout = {}  # (slices per block, sparse table levels) along each axis
+        # Extrema keep the volume type when it is small enough, sums are always float32
+        self.extrema_dtype = volume.dtype if volume.dtype.itemsize <= 4 else np.dtype(np.float32)
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for table in self.tables.values() for array in table)
+
+    def _slices(self, axis):
+        # Slices along the axis as the first dimension (a view, no copy)
+        return np.moveaxis(self.volume, axis, 0)
+
+    def _layout(self, axis):
+        """(slices per block, table levels) of an axis: the smallest blocks whose extrema fit, then the levels that fit"""
+        layout = self.layout.get(axis)
+        if layout is None:
+            length = self.volume.shape[axis]
+            plane = self.volume.size // max(1, length)
+            # Slices one table may hold (sums are float32, extrema at least as large as the volume type)
+            limit = self.max_bytes // TABLES_KEPT // max(1, plane * max(self.extrema_dtype.itemsize, 4))
+            block = BLOCK
+            # The block sums hold one slice more than the block extrema
+            while block < length and _table_slices(length, block, 1) + 1 > limit:
+                block *= 2
+            levels = 1
+            while levels < MAX_LEVELS and _table_slices(length, block, levels + 1) <= limit:
+                levels += 1
+            layout = self.layout[axis] = (block, levels)
+        return layout
+
+    def _store(self, key, table):
+        size = sum(array.nbytes for array in table)
+        if size > self.max_bytes // TABLES_KEPT:
+            # Too large to keep (a budget below a single block of slices): used once, never cached
+            return table
+        # Make room for the new table: least recently used first
+        while self.tables and self.nbytes + size > self.max_bytes:
+            self.tables.popitem(last=False)
+        self.tables[key] = table
+        return table
+
+    def _cached(self, key):
+        table = self.tables.get(key)
+        if table is not None:
+            self.tables.move_to_end(key)
+        return table
+
+    def _block_sums(self, axis):
+        """Prefix sums over the block sums: entry k sums the first k whole blocks"""
+        table = self._cached(("mean", axis))
+        if table is None:
+            slices = self._slices(axis)
+            block, _ = self._layout(axis)
+            blocks = slices.shape[0] // block
+            sums = np.empty((blocks + 1,) + slices.shape[1:], dtype=np.float32)
+            sums[0] = 0.0
+            total = np.zeros(slices.shape[1:], dtype=np.float64)
+            for index in range(blocks):
+                total += slices[index * block:(index + 1) * block].sum(axis=0, dtype=np.float64)
+                sums[index + 1] = total
+            table = self._store(("mean", axis), [sums])
+        return table[0]
+
+    def _extrema(self, mode, axis):
+        """Sparse table of block extrema: entry i of level k reduces blocks i to i + 2**k - 1"""
+        table = self._cached((mode, axis))
+        if table is None:
+            reduce = REDUCERS[mode]
+            slices = self._slices(axis)
+            block, levels = self._layout(axis)
+            starts = range(0, slices.shape[0], block)
+            level = np.empty((len(starts),) + slices.shape[1:], dtype=self.extrema_dtype)
+            for index, start in enumerate(starts):
+                level[index] = reduce.reduce(slices[start:start + block], axis=0)
+            table = [level]
+            while len(table) < levels and 2 ** len(table) <= len(level):
+                step = 2 ** (len(table) - 1)
+                table.append(reduce(table[-1][:-step], table[-1][step:]))
+            table = self._store((mode, axis), table)
+        return table
+
+    def project(self, mode, axis, start, stop):
+        """Projection of the slices [start, stop) along axis; mode is "max", "min" or "mean\""""
+        slices = self._slices(axis)
+        start, stop = int(start), int(stop)
+        block, _ = self._layout(axis)
+        first_block = -(-start // block)
+        last_block = stop // block
+
+        if mode == "mean":
+            if first_block >= last_block:
+                return slices[start:stop].mean(axis=0, dtype=np.float64)
+            sums = self._block_sums(axis)
+            total = sums[last_block] - sums[first_block].astype(np.float64)
+            total += slices[start:first_block * block].sum(axis=0, dtype=np.float64)
+            total += slices[last_block * block:stop].sum(axis=0, dtype=np.float64)
+            return total / (stop - start)
+
+        reduce = REDUCERS[mode]
+        if first_block >= last_block:
+            # Thinner than a block: reduce the slices directly
+            return reduce.reduce(slices[start:stop], axis=0)
+
+        # Whole blocks: runs of 2**level blocks, the last one overlapping the previous
+        table = self._extrema(mode, axis)
+        count = last_block - first_block
+        level = min(count.bit_length(), len(table)) - 1
+        run = 2 ** level
+        runs = list(range(first_block, last_block - run, run)) + [last_block - run]
+        result = reduce.reduce(table[level][runs], axis=0).astype(np.result_type(slices.dtype, table[0].dtype))
+
+        # Partial blocks at both ends
+        if start < first_block * block:
+            reduce(result, reduce.reduce(slices[start:first_block * block], axis=0), out=result)
+        if last_block * block < stop:
+            reduce(result, reduce.reduce(slices[last_block * block:stop], axis=0), out=result)
+        return result
@@ -0,0 +1,92 @@
+"""Multi-resolution slice pyramid for the 2D views
+
+Level (0, 0) of a slice is the slice normalized to uint8 (per-slice
+min/max, as the viewer always displayed it). Levels are separable: level
+(r, c) is the slice box-downsampled 2**r times along its rows and 2**c
+times along its columns, one axis at a time, so an anisotropic slice shown
+with square pixels in mm is only reduced along the axis that is actually
+minified. Levels are computed on demand, kept in an LRU cache keyed by
+(slice axis, slice index, level, slab) and dropped when the volume changes;
+no resampled copy of the volume is ever made. A slab (mode, start, stop)
+replaces the slice by a thick-slab projection; the projection tables have a
+budget of their own (projections.TABLE_BYTES), so they never evict levels.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+import projections
+
+# Cached pyramid levels (all slices, orientations and levels together)
+CACHE_BYTES = 64 * 1024 ** 2
+
+
+def normalize_slice(img):
+    """Normalize a slice to the 0-255 range"""
+    min_val = np.min(img)
+    max_val = np.max(img)
+    if max_val == min_val:
+        return np.zeros(img.shape, dtype=np.uint8)
+    return ((img - min_val) / (max_val - min_val) * 255).astype(np.uint8)
+
+
+def downsample(image, axis):
+    """2x box downsampling of a uint8 image along one axis (an odd last row or column is replicated)"""
+    image = np.moveaxis(image, axis, 0)
+    if image.shape[0] % 2:
+        image = np.concatenate([image, image[-1:]])
+    pairs = image.reshape(image.shape[0] // 2, 2, image.shape[1]).astype(np.uint16)
+    reduced = ((pairs.sum(axis=1) + 1) // 2).astype(np.uint8)
+    return np.ascontiguousarray(np.moveaxis(reduced, 0, axis))
+
+
+class SlicePyramid:
+    """LRU cache of normalized slices and their downsampled levels for one volume"""
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.volume = None
+        self.projector = None
+        self.levels = OrderedDict()
+        self.nbytes = 0
+
+    def invalidate(self):
+        self.levels.clear()
+        self.nbytes = 0
+
+    def get(self, volume, axis, index, level=(0, 0), slab=None):
+        """(row, column) level of slice volume[..., index, ...] along axis (or of a slab projection) as uint8"""
+        if volume is not self.volume:
+            # A new or replaced volume invalidates every cached level and projection table
+            self.volume = volume
+            self.projector = projections.SlabProjector(volume)
+            self.invalidate()
+
+        key = (axis, index, level, slab)
+        image = self.levels.get(key)
+        if image is not None:
+            self.levels.move_to_end(key)
+            return image
+
+        row_level, col_level = level
+        if row_level > 0 and row_level >= col_level:
+            image = downsample(self.get(volume, axis, index, (row_level - 1, col_level), slab), 0)
+        elif col_level > 0:
+            image = downsample(self.get(volume, axis, index, (row_level, col_level - 1), slab), 1)
+        elif slab is not None:
+            mode, start, stop = slab
+            image = normalize_slice(self.projector.project(mode, axis, start, stop))
+        else:
+            image = normalize_slice(volume[(slice(None),) * axis + (index,)])
+        self.levels[key] = image
+        self.nbytes += image.nbytes
+        while self.nbytes > self.max_bytes and len(self.levels) > 1:
+            _, old = self.levels.popitem(last=False)
+            self.nbytes -= old.nbytes
+        return image
+
+    @staticmethod
+    def level_for(scale):
+        """Coarsest level of one axis whose pixels still cover at least one display pixel (scale: display px per slice px)"""
+        if scale >= 1.0:
+            return 0
+        return int(np.floor(np.log2(1.0 / scale)))
@@ -0,0 +1,498 @@
+"""Persistent VTK scenes for the 3D views, rendered in a child process
+
+A scene renders a uint8 [x, y, z] buffer owned by the caller (see vtk_volume).
+The buffer can be rewritten in place at any time; `modified()` then re-renders
+only what changed on the VTK side instead of rebuilding the pipeline. While the
+camera is being dragged a half-resolution copy with a coarser sample distance is
+shown (level of detail) and the full-resolution volume comes back on release.
+
+`SceneProcess` runs a scene in a child process so the Tk viewer keeps its event
+loop: the buffer lives in multiprocessing.shared_memory (written by the viewer,
+read by VTK, never pickled) and small commands travel over a Pipe.
+"""
+import colorsys
+import multiprocessing
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+import vtk
+
+import surfaces
+import vtk_volume
+
+# Sample distance (in voxels) used for the full-quality and the interactive renders
+STILL_SAMPLE_DISTANCE = 0.5
+INTERACTIVE_SAMPLE_DISTANCE = 2.0
+
+# Downsampling factor of the level-of-detail volume
+LOD_FACTOR = 2
+
+# Frame rates requested while dragging and at rest (the latter means "take all the time needed")
+INTERACTIVE_UPDATE_RATE = 10.0
+STILL_UPDATE_RATE = 0.0001
+
+# Seconds the child process sleeps between two rounds of window events and commands
+POLL_INTERVAL = 0.01
+
+
+def _transfer_functions(overlay_color=None):
+    """CT-like color/opacity transfer functions, with a hint for the drawn regions"""
+    color_function = vtk.vtkColorTransferFunction()
+    opacity_function = vtk.vtkPiecewiseFunction()
+
+    # Setup color transfer function (CT-like grayscale)
+    color_function.AddRGBPoint(0, 0.0, 0.0, 0.0)      # Black for air/background
+    color_function.AddRGBPoint(50, 0.3, 0.3, 0.3)     # Dark gray for soft tissue
+    color_function.AddRGBPoint(150, 0.8, 0.8, 0.8)    # Light gray for bone
+    color_function.AddRGBPoint(255, 1.0, 1.0, 1.0)    # White for dense bone
+
+    # Setup opacity transfer function
+    opacity_function.AddPoint(0, 0.0)     # Fully transparent for background
+    opacity_function.AddPoint(40, 0.0)    # Still transparent for air
+    opacity_function.AddPoint(80, 0.2)    # Slightly visible for soft tissue
+    opacity_function.AddPoint(150, 0.4)   # More opaque for bone
+    opacity_function.AddPoint(255, 0.8)   # Most opaque for dense bone
+
+    # If there are drawn regions, make them more visible
+    if overlay_color is not None:
+        r, g, b = overlay_color
+        color_function.AddRGBPoint(200, r / 255, g / 255, b / 255)
+        opacity_function.AddPoint(200, 0.9)
+
+    return color_function, opacity_function
+
+
+class Scene:
+    """Render window, renderer and non-blocking interactor shared by the 3D scenes"""
+    def __init__(self, title, background, offscreen=False, render_window=None):
+        self.closed = False
+        self.offscreen = offscreen or render_window is not None
+
+        self.renderer = vtk.vtkRenderer()
+        self.renderer.SetBackground(*background)
+
+        # An existing (offscreen) window can be shared so its GL context is created only once
+        self.owns_window = render_window is None
+        if self.owns_window:
+            render_window = vtk.vtkRenderWindow()
+            render_window.SetSize(800, 600)
+            render_window.SetWindowName(title)
+            if offscreen:
+                render_window.SetOffScreenRendering(1)
+        self.render_window = render_window
+        self.render_window.AddRenderer(self.renderer)
+        self.interactor = None
+
+    def _setup_interactor(self):
+        if self.offscreen:
+            return None
+        self.interactor = vtk.vtkRenderWindowInteractor()
+        self.interactor.SetRenderWindow(self.render_window)
+        self.interactor.SetDesiredUpdateRate(INTERACTIVE_UPDATE_RATE)
+        self.interactor.SetStillUpdateRate(STILL_UPDATE_RATE)
+
+        style = vtk.vtkInteractorStyleTrackballCamera()
+        self.interactor.SetInteractorStyle(style)
+
+        # Closing the window must not terminate the caller's event loop
+        self.interactor.AddObserver("ExitEvent", lambda obj, event: self.close())
+        return style
+
+    def render(self):
+        if not self.closed:
+            self.render_window.Render()
+
+    def show(self):
+        """Open the window without blocking; call process_events() periodically afterwards"""
+        self.render()
+        if self.interactor is not None:
+            self.interactor.Initialize()
+
+    def process_events(self):
+        """Handle pending window events (non-blocking alternative to interactor.Start())"""
+        if self.interactor is not None and not self.closed:
+            self.interactor.ProcessEvents()
+        return not self.closed
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if not self.owns_window:
+            # Leave the shared window (and its context) to the next scene
+            self.render_window.RemoveRenderer(self.renderer)
+            return
+        self.render_window.Finalize()
+        if self.interactor is not None:
+            self.interactor.TerminateApp()
+
+    def release(self):
+        """Drop every reference to the caller's buffer"""
+        self.buffer = None
+
+
+class VolumeScene(Scene):
+    def __init__(self, buffer, title="3D Visualization", info="", overlay_color=None,
+                 spacing=(1.0, 1.0, 1.0), offscreen=False, render_window=None):
+        super().__init__(title, (0.1, 0.1, 0.1), offscreen, render_window)  # Dark background
+        self.interacting = False
+        self.spacing = tuple(spacing)
+        self.lod_dirty = True
+        # Sampling steps and opacity are set relative to the finest voxel size (mm)
+        voxel = min(self.spacing)
+
+        # Volume property shared by the full and the level-of-detail volumes
+        self.volume_property = vtk.vtkVolumeProperty()
+        self.volume_property.ShadeOn()
+        self.volume_property.SetInterpolationTypeToLinear()
+        self.volume_property.SetScalarOpacityUnitDistance(voxel)
+        self.set_overlay_color(overlay_color)
+
+        # Set the gradient opacity for edge enhancement
+        gradient_opacity = vtk.vtkPiecewiseFunction()
+        gradient_opacity.AddPoint(0, 0.0)
+        gradient_opacity.AddPoint(90, 0.5)
+        gradient_opacity.AddPoint(255, 1.0)
+        self.volume_property.SetGradientOpacity(gradient_opacity)
+
+        # Full-resolution and level-of-detail volumes; only one is visible at a time
+        self.mapper = vtk.vtkSmartVolumeMapper()
+        self.mapper.SetSampleDistance(STILL_SAMPLE_DISTANCE * voxel)
+        self.mapper.AutoAdjustSampleDistancesOff()
+        self.actor = vtk.vtkVolume()
+        self.actor.SetMapper(self.mapper)
+        self.actor.SetProperty(self.volume_property)
+
+        self.lod_mapper = vtk.vtkSmartVolumeMapper()
+        self.lod_mapper.SetSampleDistance(INTERACTIVE_SAMPLE_DISTANCE * LOD_FACTOR * voxel)
+        # Let VTK also coarsen the image sample distance until the frame rate is met
+        self.lod_mapper.AutoAdjustSampleDistancesOn()
+        self.lod_mapper.InteractiveAdjustSampleDistancesOn()
+        self.lod_mapper.SetInteractiveUpdateRate(INTERACTIVE_UPDATE_RATE)
+        self.lod_actor = vtk.vtkVolume()
+        self.lod_actor.SetMapper(self.lod_mapper)
+        self.lod_actor.SetProperty(self.volume_property)
+        self.lod_actor.SetVisibility(0)
+
+        self.set_buffer(buffer)
+        self.renderer.AddVolume(self.actor)
+        self.renderer.AddVolume(self.lod_actor)
+
+        # Set up camera for a good initial view
+        self.reset_camera()
+
+        # Add a text display for information
+        self.text_actor = vtk.vtkTextActor()
+        self.text_actor.SetInput(info)
+        self.text_actor.GetTextProperty().SetFontSize(12)
+        self.text_actor.GetTextProperty().SetColor(1.0, 1.0, 1.0)
+        self.text_actor.SetPosition(10, 10)
+        self.renderer.AddViewProp(self.text_actor)
+
+        style = self._setup_interactor()
+        if style is not None:
+            # Swap to the level-of-detail volume while dragging
+            style.AddObserver("StartInteractionEvent", self._start_interaction)
+            style.AddObserver("EndInteractionEvent", self._end_interaction)
+            self._add_axes()
+
+    def _add_axes(self):
+        # Add orientation marker (axes)
+        axes = vtk.vtkAxesActor()
+        axes.SetTotalLength(50, 50, 50)
+        axes.SetXAxisLabelText("X")
+        axes.SetYAxisLabelText("Y")
+        axes.SetZAxisLabelText("Z")
+        axes.GetXAxisCaptionActor2D().GetTextActor().SetTextScaleModeToNone()
+        axes.GetYAxisCaptionActor2D().GetTextActor().SetTextScaleModeToNone()
+        axes.GetZAxisCaptionActor2D().GetTextActor().SetTextScaleModeToNone()
+
+        self.axes_widget = vtk.vtkOrientationMarkerWidget()
+        self.axes_widget.SetOrientationMarker(axes)
+        self.axes_widget.SetInteractor(self.interactor)
+        self.axes_widget.SetViewport(0.0, 0.0, 0.2, 0.2)
+        self.axes_widget.SetEnabled(1)
+        self.axes_widget.InteractiveOff()
+
+    def set_buffer(self, buffer):
+        """Point the scene at a (new) uint8 [x, y, z] buffer, e.g. after the volume shape changed"""
+        self.image, self.buffer = vtk_volume.image_from_array(buffer, spacing=self.spacing)
+        self.mapper.SetInputData(self.image)
+        self.lod_dirty = True
+
+    def set_overlay_color(self, overlay_color):
+        """Rebuild the transfer functions (overlay_color None when nothing is drawn)"""
+        color_function, opacity_function = _transfer_functions(overlay_color)
+        self.volume_property.SetColor(color_function)
+        self.volume_property.SetScalarOpacity(opacity_function)
+
+    def reset_camera(self):
+        camera = self.renderer.GetActiveCamera()
+        camera.SetPosition(0, -400, 0)
+        camera.SetFocalPoint(0, 0, 0)
+        camera.SetViewUp(0, 0, 1)
+        self.renderer.ResetCamera()
+
+    def modified(self, render=True):
+        """Tell VTK the shared buffer was rewritten in place"""
+        self.image.GetPointData().GetScalars().Modified()
+        self.image.Modified()
+        self.lod_dirty = True
+        if render:
+            self.render()
+
+    def release(self):
+        self.buffer = self.image = None
+        self.mapper.RemoveAllInputs()
+
+    def _update_lod(self):
+        """Rebuild the downsampled copy shown during interaction"""
+        lod = np.asfortranarray(self.buffer[::LOD_FACTOR, ::LOD_FACTOR, ::LOD_FACTOR])
+        spacing = tuple(s * LOD_FACTOR for s in self.spacing)
+        self.lod_image, self.lod_buffer = vtk_volume.image_from_array(lod, spacing=spacing)
+        self.lod_mapper.SetInputData(self.lod_image)
+        self.lod_dirty = False
+
+    def _start_interaction(self, obj, event):
+        if self.lod_dirty:
+            self._update_lod()
+        self.interacting = True
+        self.render_window.SetDesiredUpdateRate(INTERACTIVE_UPDATE_RATE)
+        self.actor.SetVisibility(0)
+        self.lod_actor.SetVisibility(1)
+
+    def _end_interaction(self, obj, event):
+        self.interacting = False
+        self.render_window.SetDesiredUpdateRate(STILL_UPDATE_RATE)
+        self.lod_actor.SetVisibility(0)
+        self.actor.SetVisibility(1)
+        self.render()
+
+
+class SegmentationScene(Scene):
+    """Superficies de las etiquetas de una segmentación, una malla por etiqueta"""
+    def __init__(self, buffer, title="Visualización 3D de Segmentación", smoothing_iterations=0,
+                 decimation=0.0, spacing=(1.0, 1.0, 1.0), offscreen=False, render_window=None, cache=None):
+        super().__init__(title, (0.2, 0.2, 0.2), offscreen, render_window)  # Fondo gris oscuro
+        self.smoothing_iterations = smoothing_iterations
+        self.decimation = decimation
+        self.spacing = tuple(spacing)  # Tamaño del vóxel (mm)
+        self.cache = cache if cache is not None else surfaces.MeshCache()
+        self.actors = []
+
+        self.set_buffer(buffer)
+
+        self.reset_camera()
+        self._setup_interactor()
+
+    def reset_camera(self):
+        # Inicializar y ajustar cámara
+        self.renderer.ResetCamera()
+        camera = self.renderer.GetActiveCamera()
+        camera.Elevation(30)
+        camera.Azimuth(30)
+        camera.Zoom(1.2)
+
+    def set_buffer(self, buffer):
+        """Enlaza el volumen de etiquetas (uint8 [x, y, z]) y genera sus superficies"""
+        self.buffer = buffer
+        self._update_surfaces()
+
+    def _update_surfaces(self):
+        for actor in self.actors:
+            self.renderer.RemoveActor(actor)
+        self.actors = []
+
+        # Mallas por etiqueta (desde la caché si la segmentación ya se visualizó)
+        meshes = surfaces.extract_surfaces(self.buffer, self.smoothing_iterations, self.decimation,
+                                           spacing=self.spacing, cache=self.cache)
+
+        for i, label in enumerate(sorted(meshes)):
+            mapper = vtk.vtkPolyDataMapper()
+            mapper.SetInputData(meshes[label])
+            mapper.ScalarVisibilityOff()
+
+            # Usar HSV para generar colores distintos
+            actor = vtk.vtkActor()
+            actor.SetMapper(mapper)
+            hue = float(i) / len(meshes)
+            actor.GetProperty().SetColor(*colorsys.hsv_to_rgb(hue, 1.0, 1.0))
+
+            # Configurar propiedades
+            actor.GetProperty().SetOpacity(0.7)
+            actor.GetProperty().SetSpecular(0.3)
+            self.renderer.AddActor(actor)
+            self.actors.append(actor)
+
+    def modified(self, render=True):
+        """El volumen de etiquetas se reescribió en su lugar"""
+        self._update_surfaces()
+        if render:
+            self.render()
+
+    def set_overlay_color(self, overlay_color):
+        pass
+
+
+SCENES = {"volume": VolumeScene, "segmentation": SegmentationScene}
+
+
+def _attach(name, shape):
+    """Map an existing shared memory block as a Fortran-ordered uint8 volume"""
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, order="F")
+
+
+def _run_scene(conn, kind, name, shape, options):
+    """Child process entry point: show the scene and serve commands until it is closed"""
+    shm, buffer = _attach(name, shape)
+    scene = SCENES[kind](buffer, **options)
+    scene.show()
+
+    try:
+        while scene.process_events():
+            while conn.poll():
+                command, *args = conn.recv()
+                if command == "modified":
+                    scene.modified()
+                elif command == "overlay_color":
+                    scene.set_overlay_color(*args)
+                elif command == "buffer":
+                    # The viewer reallocated the volume: attach the new block and drop the old one
+                    new_shm, new_buffer = _attach(*args)
+                    scene.set_buffer(new_buffer)
+                    del buffer
+                    shm.close()
+                    shm, buffer = new_shm, new_buffer
+                    # The viewer can now free the old block
+                    conn.send(("buffer", shm.name))
+                elif command == "close":
+                    scene.close()
+            time.sleep(POLL_INTERVAL)
+    except (EOFError, OSError):
+        # The viewer went away
+        scene.close()
+
+    # Drop every view of the shared block before closing it
+    scene.release()
+    del buffer
+    try:
+        conn.send(("closed",))
+    except (EOFError, OSError):
+        pass
+    try:
+        shm.close()
+    except BufferError:
+        pass
+
+
+class SceneProcess:
+    """Viewer-side handle of a scene running in a child process
+
+    `buffer` is the shared volume: write into it, then call modified().
+    """
+    def __init__(self, kind, shape, **options):
+        self.kind = kind
+        self.options = options
+        self.process = None
+        self.closed = False
+        self._retired = []
+        self._allocate(shape)
+
+    def _allocate(self, shape):
+        size = max(1, int(np.prod(shape)))
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.buffer = np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf, order="F")
+
+    def start(self, **options):
+        """Launch the child process once the buffer holds the first volume"""
+        self.options.update(options)
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_run_scene,
+            args=(child_conn, self.kind, self.shm.name, self.buffer.shape, self.options),
+            daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def send(self, command, *args):
+        if self.closed or self.process is None:
+            return
+        try:
+            self.conn.send((command, *args))
+        except OSError:
+            self._release()
+
+    def modified(self):
+        self.send("modified")
+
+    def set_overlay_color(self, overlay_color):
+        self.send("overlay_color", overlay_color)
+
+    def resize(self, shape):
+        """Allocate a new shared buffer (the volume shape changed) and return it"""
+        # The child keeps mapping the old block until it acknowledges the command
+        self._retired.append(self.shm)
+        self._allocate(shape)
+        if self.process is None:
+            self._unlink(len(self._retired))
+        else:
+            self.send("buffer", self.shm.name, shape)
+        return self.buffer
+
+    def _unlink(self, count):
+        """Free the count oldest retired blocks"""
+        for shm in self._retired[:count]:
+            try:
+                shm.close()
+            except BufferError:
+                # The viewer still holds a view of the block; unlinking frees it once that goes
+                pass
+            shm.unlink()
+        del self._retired[:count]
+
+    def _acknowledged(self, name):
+        # The child maps the block called name: every block retired before it is free
+        names = [shm.name for shm in self._retired]
+        self._unlink(names.index(name) if name in names else len(names))
+
+    def poll(self):
+        """Process messages from the child; return False once the scene is gone"""
+        if self.closed:
+            return False
+        try:
+            while self.conn.poll():
+                message = self.conn.recv()
+                if message[0] == "buffer":
+                    self._acknowledged(message[1])
+                elif message[0] == "closed":
+                    self._release()
+                    return False
+        except (EOFError, OSError):
+            self._release()
+            return False
+        if not self.process.is_alive():
+            self._release()
+            return False
+        return True
+
+    def close(self):
+        """Ask the child to close its window and release the shared memory"""
+        if self.closed:
+            return
+        self.send("close")
+        if self.process is not None:
+            self.process.join(timeout=2.0)
+            if self.process.is_alive():
+                self.process.terminate()
+        self._release()
+
+    def _release(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.buffer = None
+        self._retired.append(self.shm)
+        self._unlink(len(self._retired))
@@ -0,0 +1,180 @@
+"""Offscreen PNG snapshots and turntables of volumes and segmentations (no display needed)
+
+One offscreen render window (EGL or OSMesa, whichever this VTK build provides) is
+created once and reused for every input file, so a batch of QA renders pays the
+OpenGL context setup a single time. On a build with both back ends, set
+VTK_DEFAULT_OPENGL_WINDOW=vtkOSOpenGLRenderWindow to force OSMesa.
+
+Examples:
+    python snapshots.py brain.nii.gz --output-dir renders
+    python snapshots.py seg_*.nii.gz --mode segmentation --smooth --angles 0,0 90,0 0,90
+    python snapshots.py brain.nii.gz --turntable 36 --size 512x512
+"""
+import argparse
+import glob
+import os
+import sys
+
+import nibabel as nib
+import numpy as np
+import vtk
+
+import nifti_export
+import scene3d
+import surfaces
+import vtk_volume
+
+DEFAULT_ANGLES = ((0.0, 0.0), (90.0, 0.0), (180.0, 0.0), (270.0, 0.0), (0.0, 90.0))
+
+
+class SnapshotRenderer:
+    """Offscreen render window, capture filter and PNG writer shared by every snapshot"""
+    def __init__(self, size=(800, 600)):
+        self.render_window = vtk.vtkRenderWindow()
+        self.render_window.SetOffScreenRendering(1)
+        self.render_window.SetSize(*size)
+        self.scene = None
+
+        self.capture = vtk.vtkWindowToImageFilter()
+        self.capture.SetInput(self.render_window)
+        self.capture.SetInputBufferTypeToRGB()
+        self.capture.ReadFrontBufferOff()
+        self.writer = vtk.vtkPNGWriter()
+        self.writer.SetInputConnection(self.capture.GetOutputPort())
+
+    def show_volume(self, data, overlay_mask=None, overlay_color=(255, 0, 0), spacing=(1.0, 1.0, 1.0)):
+        """Replace the current scene by a volume rendering of data (voxel size in mm)"""
+        buffer = vtk_volume.to_uint8(data)
+        if overlay_mask is not None and overlay_mask.any():
+            vtk_volume.blend_overlay(buffer, overlay_mask, overlay_color)
+        else:
+            overlay_color = None
+        self._set_scene(scene3d.VolumeScene(buffer, overlay_color=overlay_color, spacing=spacing,
+                                            render_window=self.render_window))
+
+    def show_segmentation(self, labels, smoothing_iterations=0, decimation=0.0, cache=None,
+                          spacing=(1.0, 1.0, 1.0)):
+        """Replace the current scene by the label surfaces of a segmentation (voxel size in mm)"""
+        self._set_scene(scene3d.SegmentationScene(np.asfortranarray(labels, dtype=np.uint8),
+                                                  smoothing_iterations=smoothing_iterations,
+                                                  decimation=decimation, spacing=spacing,
+                                                  render_window=self.render_window, cache=cache))
+
+    def _set_scene(self, scene):
+        if self.scene is not None:
+            self.scene.close()
+            self.scene.release()
+        self.scene = scene
+
+    def snapshot(self, path, azimuth=0.0, elevation=0.0):
+        """Render from the scene's default camera turned by (azimuth, elevation) degrees and save a PNG"""
+        self.scene.reset_camera()
+        camera = self.scene.renderer.GetActiveCamera()
+        camera.Azimuth(azimuth)
+        camera.Elevation(elevation)
+        camera.OrthogonalizeViewUp()
+        self.scene.renderer.ResetCameraClippingRange()
+        self.render_window.Render()
+
+        self.capture.Modified()
+        self.writer.SetFileName(path)
+        self.writer.Write()
+        return path
+
+    def turntable(self, pattern, frames=36, elevation=0.0):
+        """Render `frames` views evenly spaced around the vertical axis; pattern takes the frame number"""
+        return [self.snapshot(pattern.format(frame), 360.0 * frame / frames, elevation)
+                for frame in range(frames)]
+
+    def close(self):
+        self._set_scene(None)
+        self.render_window.Finalize()
+
+
+def load_volume(path, segmentation=False):
+    """(data, voxel size in mm) of a NIfTI file; labels as uint8 for segmentations"""
+    image = nib.load(path)
+    spacing = vtk_volume.spacing_from_zooms(image.header.get_zooms())
+    if segmentation:
+        labels = np.asarray(image.dataobj)
+        # Labels are meshed as uint8: refuse the ones a cast would wrap or truncate
+        dtype, _, _ = nifti_export.storage_type(labels)
+        if dtype != np.uint8:
+            raise ValueError("segmentation labels must be integers from 0 to 255")
+        return labels.astype(np.uint8), spacing
+    return image.get_fdata(dtype=np.float32), spacing
+
+
+def _angle(text):
+    azimuth, _, elevation = text.partition(",")
+    return float(azimuth), float(elevation or 0.0)
+
+
+def _size(text):
+    width, _, height = text.lower().partition("x")
+    return int(width), int(height or width)
+
+
+def _stem(path):
+    name = os.path.basename(path)
+    for extension in (".nii.gz", ".nii"):
+        if name.endswith(extension):
+            return name[:-len(extension)]
+    return os.path.splitext(name)[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render NIfTI volumes or segmentations to PNG without a display")
+    parser.add_argument("inputs", nargs="+", help="NIfTI files (glob patterns are expanded)")
+    parser.add_argument("--mode", choices=("volume", "segmentation"), default="volume",
+                        help="Volume rendering or per-label surfaces (default: volume)")
+    parser.add_argument("--output-dir", default=".", help="Directory for the PNG files")
+    parser.add_argument("--angles", nargs="+", type=_angle, metavar="AZ,EL",
+                        help="Camera angles in degrees from the default view (default: four sides and top)")
+    parser.add_argument("--turntable", type=int, default=0, metavar="FRAMES",
+                        help="Also render a turntable sequence with this many frames")
+    parser.add_argument("--turntable-elevation", type=float, default=15.0, help="Elevation of the turntable camera")
+    parser.add_argument("--size", type=_size, default=(800, 600), metavar="WxH", help="Image size (default 800x600)")
+    parser.add_argument("--smooth", action="store_true", help="Smooth the segmentation surfaces")
+    parser.add_argument("--decimate", action="store_true", help="Decimate the segmentation surfaces")
+    args = parser.parse_args(argv)
+
+    paths = [path for pattern in args.inputs for path in (sorted(glob.glob(pattern)) or [pattern])]
+    os.makedirs(args.output_dir, exist_ok=True)
+    segmentation = args.mode == "segmentation"
+    # Each file is rendered once: only its own meshes need to stay in memory
+    cache = surfaces.MeshCache(max_memory=1)
+
+    renderer = SnapshotRenderer(args.size)
+    failures = 0
+    try:
+        for path in paths:
+            try:
+                data, spacing = load_volume(path, segmentation)
+                if segmentation:
+                    renderer.show_segmentation(
+                        data,
+                        smoothing_iterations=surfaces.DEFAULT_SMOOTHING_ITERATIONS if args.smooth else 0,
+                        decimation=surfaces.DEFAULT_DECIMATION if args.decimate else 0.0,
+                        cache=cache, spacing=spacing)
+                else:
+                    renderer.show_volume(data, spacing=spacing)
+
+                stem = os.path.join(args.output_dir, _stem(path))
+                for azimuth, elevation in args.angles or DEFAULT_ANGLES:
+                    print(renderer.snapshot(f"{stem}_az{azimuth:g}_el{elevation:g}.png", azimuth, elevation))
+                if args.turntable > 0:
+                    frames = renderer.turntable(f"{stem}_turntable_{{:03d}}.png", args.turntable,
+                                                args.turntable_elevation)
+                    print(f"{len(frames)} turntable frames for {path}")
+            except Exception as e:
+                # One bad file (unreadable, invalid labels, unwritable output) does not stop the batch
+                print(f"{path}: {e}", file=sys.stderr)
+                failures += 1
+    finally:
+        renderer.close()
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
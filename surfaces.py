@@ -0,0 +1,201 @@
+"""Per-label surface extraction for segmentation volumes, with a mesh cache
+
+Each label is meshed on its own bounding box (plus a one-voxel margin) with
+discrete flying edges instead of running marching cubes with one contour value
+per label over the whole volume. Meshes can be smoothed (windowed sinc) and
+decimated, and are cached on disk keyed by the segmentation content and the
+options, so reopening the 3D view of the same result skips the extraction.
+"""
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+import vtk
+
+import vtk_volume
+
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "nifti_viewer_meshes")
+
+# Oldest cached meshes are pruned beyond this many files
+MAX_CACHE_FILES = 500
+
+# Mesh sets kept in memory per cache (least recently used are dropped; the files stay)
+MAX_MEMORY_ENTRIES = 4
+
+# Pass band of the windowed-sinc smoothing (lower is smoother)
+SMOOTHING_PASS_BAND = 0.1
+
+# Settings used by the viewer when smoothing / decimation are switched on
+DEFAULT_SMOOTHING_ITERATIONS = 15
+DEFAULT_DECIMATION = 0.5
+
+
+def label_bounding_boxes(labels):
+    """{label: (slice_x, slice_y, slice_z)} for every non-zero label, in three slab-wise passes"""
+    labels = np.asarray(labels)
+    count = int(labels.max()) + 1 if labels.size else 1
+    presence = []
+    for axis in range(3):
+        # One bincount per slice: which labels appear at each index along this axis
+        slabs = np.moveaxis(labels, axis, 0)
+        present = np.zeros((labels.shape[axis], count), dtype=bool)
+        for i in range(labels.shape[axis]):
+            present[i] = np.bincount(slabs[i].ravel(), minlength=count) > 0
+        presence.append(present)
+
+    boxes = {}
+    for label in np.flatnonzero(presence[0].any(axis=0)):
+        if label == 0:
+            continue
+        box = []
+        for present in presence:
+            indices = np.flatnonzero(present[:, label])
+            box.append(slice(int(indices[0]), int(indices[-1]) + 1))
+        boxes[int(label)] = tuple(box)
+    return boxes
+
+
+def content_key(labels, **options):
+    """Hash of the label volume and the extraction options"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((labels.shape, str(labels.dtype), sorted(options.items()))).encode())
+    # Hash in x-fastest order without materializing a copy of Fortran buffers
+    data = labels.ravel(order="F" if labels.flags.f_contiguous else "C")
+    digest.update(memoryview(np.ascontiguousarray(data)))
+    return digest.hexdigest()
+
+
+def label_surface(labels, label, box, smoothing_iterations=0, decimation=0.0, spacing=(1.0, 1.0, 1.0)):
+    """Surface of one label, extracted on its bounding box, in mm for the given voxel spacing"""
+    # One-voxel margin so the surface closes at the box faces
+    padded = tuple(slice(max(0, s.start - 1), min(n, s.stop + 1)) for s, n in zip(box, labels.shape))
+    mask = np.asfortranarray(labels[padded] == label, dtype=np.uint8)
+    image, buffer = vtk_volume.image_from_array(
+        mask, spacing=spacing, origin=tuple(float(s.start) * d for s, d in zip(padded, spacing)))
+
+    surface = vtk.vtkDiscreteFlyingEdges3D()
+    surface.SetInputData(image)
+    surface.SetValue(0, 1)
+    surface.ComputeNormalsOff()
+    surface.ComputeGradientsOff()
+    output = surface.GetOutputPort()
+
+    if smoothing_iterations > 0:
+        smoother = vtk.vtkWindowedSincPolyDataFilter()
+        smoother.SetInputConnection(output)
+        smoother.SetNumberOfIterations(smoothing_iterations)
+        smoother.SetPassBand(SMOOTHING_PASS_BAND)
+        smoother.BoundarySmoothingOff()
+        smoother.FeatureEdgeSmoothingOff()
+        smoother.NonManifoldSmoothingOn()
+        smoother.NormalizeCoordinatesOn()
+        output = smoother.GetOutputPort()
+
+    if decimation > 0.0:
+        decimate = vtk.vtkQuadricDecimation()
+        decimate.SetInputConnection(output)
+        decimate.SetTargetReduction(decimation)
+        output = decimate.GetOutputPort()
+
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputConnection(output)
+    normals.SplittingOff()
+    # Flying edges already emits consistently oriented triangles
+    normals.ConsistencyOff()
+    normals.Update()
+
+    mesh = vtk.vtkPolyData()
+    mesh.ShallowCopy(normals.GetOutput())
+    return mesh
+
+
+class MeshCache:
+    """Meshes per content key: the last few in memory for this process, as .vtp files across processes"""
+    def __init__(self, directory=CACHE_DIR, max_files=MAX_CACHE_FILES, max_memory=MAX_MEMORY_ENTRIES):
+        self.directory = directory
+        self.max_files = max_files
+        self.max_memory = max_memory
+        self.memory = OrderedDict()
+
+    def _remember(self, key, meshes):
+        self.memory[key] = meshes
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory:
+            self.memory.popitem(last=False)
+
+    def _path(self, key, label):
+        return os.path.join(self.directory, f"{key}_{label}.vtp")
+
+    def get(self, key):
+        """Cached meshes for a content key, or None"""
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        # The label index is written last, so its presence means the entry is complete
+        index = os.path.join(self.directory, f"{key}.labels")
+        if not os.path.exists(index):
+            return None
+        with open(index) as f:
+            labels = [int(label) for label in f.read().split()]
+        meshes = {}
+        for label in labels:
+            path = self._path(key, label)
+            if not os.path.exists(path):
+                return None
+            reader = vtk.vtkXMLPolyDataReader()
+            reader.SetFileName(path)
+            reader.Update()
+            if reader.GetErrorCode():
+                return None
+            meshes[label] = reader.GetOutput()
+        self._remember(key, meshes)
+        return meshes
+
+    def put(self, key, meshes):
+        self._remember(key, meshes)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            for label, mesh in meshes.items():
+                writer = vtk.vtkXMLPolyDataWriter()
+                writer.SetFileName(self._path(key, label))
+                writer.SetInputData(mesh)
+                # Raw appended data: several times faster to write and read than base64/zlib
+                writer.SetDataModeToAppended()
+                writer.EncodeAppendedDataOff()
+                writer.SetCompressorTypeToNone()
+                writer.Write()
+            with open(os.path.join(self.directory, f"{key}.labels"), "w") as f:
+                f.write(" ".join(str(label) for label in meshes))
+            self._prune()
+        except OSError:
+            # A read-only temp dir only costs the on-disk cache
+            pass
+
+    def _prune(self):
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                 if name.endswith((".vtp", ".labels"))]
+        if len(files) <= self.max_files:
+            return
+        # Oldest first; a pruned .vtp makes its entry fail to load and be rebuilt
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self.max_files]:
+            os.remove(path)
+
+
+def extract_surfaces(labels, smoothing_iterations=0, decimation=0.0, spacing=(1.0, 1.0, 1.0), cache=None):
+    """{label: vtkPolyData} for every non-zero label of a [x, y, z] label volume"""
+    options = {"smoothing_iterations": smoothing_iterations, "decimation": decimation,
+               "spacing": tuple(float(d) for d in spacing)}
+    key = content_key(labels, **options) if cache is not None else None
+    if cache is not None:
+        meshes = cache.get(key)
+        if meshes is not None:
+            return meshes
+
+    boxes = label_bounding_boxes(labels)
+    meshes = {label: label_surface(labels, label, box, **options) for label, box in boxes.items()}
+    if cache is not None:
+        cache.put(key, meshes)
+    return meshes
@@ -0,0 +1,73 @@
+"""Zero-copy conversion of numpy volumes to vtkImageData
+
+vtkImageData stores its scalars x-fastest, which is exactly the memory layout of
+a Fortran-ordered numpy array indexed [x, y, z]. Volumes are therefore built as
+Fortran-ordered uint8 buffers and handed to VTK without any copy; the caller
+must keep the buffer alive for as long as VTK uses the image.
+"""
+import numpy as np
+import vtk
+from vtkmodules.util.numpy_support import numpy_to_vtk
+
+# Edge of the (x, y) tiles used when transposing C-ordered volumes
+TILE = 32
+
+
+def to_uint8(data, out=None, value_range=None):
+    """Scale a volume to 0-255 into a Fortran-ordered uint8 buffer, a block at a time"""
+    if out is None:
+        out = np.empty(data.shape, dtype=np.uint8, order="F")
+    if value_range is None:
+        value_range = (float(np.min(data)), float(np.max(data)))
+    volume_min, volume_max = value_range
+    if volume_max <= volume_min:
+        out[...] = 0
+        return out
+
+    scale = volume_max - volume_min
+    if data.flags.f_contiguous:
+        # Same layout as the output: z slabs are contiguous on both sides
+        for z in range(data.shape[2]):
+            out[:, :, z] = (data[:, :, z] - volume_min) / scale * 255
+    else:
+        # C-ordered input: convert in (x, y) tiles so the transpose stays in cache
+        for x in range(0, data.shape[0], TILE):
+            for y in range(0, data.shape[1], TILE):
+                tile = data[x:x + TILE, y:y + TILE]
+                out[x:x + TILE, y:y + TILE] = (tile - volume_min) / scale * 255
+    return out
+
+
+def blend_overlay(volume, mask, color, color_factor=0.8):
+    """Blend the mean of an RGB color into the voxels of a uint8 volume selected by mask (in place)"""
+    r, g, b = color
+    target = (r + g + b) / 3 * color_factor
+    values = volume[mask]
+    volume[mask] = (values * (1 - color_factor) + target).astype(np.uint8)
+    return volume
+
+
+def spacing_from_zooms(zooms):
+    """Voxel size along x, y, z from NIfTI header zooms (1 where missing or invalid)"""
+    zooms = tuple(float(z) for z in zooms[:3])
+    zooms += (1.0,) * (3 - len(zooms))
+    return tuple(z if np.isfinite(z) and z > 0 else 1.0 for z in zooms)
+
+
+def image_from_array(volume, spacing=(1.0, 1.0, 1.0), origin=(0.0, 0.0, 0.0)):
+    """Wrap a uint8 [x, y, z] volume in a vtkImageData sharing its memory
+
+    Returns (image, buffer). `buffer` is the Fortran-ordered array VTK points at;
+    keep a reference to it while the image is in use.
+    """
+    buffer = np.asfortranarray(volume, dtype=np.uint8)
+    image = vtk.vtkImageData()
+    image.SetDimensions(*buffer.shape)
+    image.SetSpacing(*spacing)
+    image.SetOrigin(*origin)
+
+    # ravel(order="F") of a Fortran array is a view: x-fastest, no copy
+    scalars = numpy_to_vtk(buffer.ravel(order="F"), deep=False, array_type=vtk.VTK_UNSIGNED_CHAR)
+    scalars.SetName("scalars")
+    image.GetPointData().SetScalars(scalars)
+    return image, buffer